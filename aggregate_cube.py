@@ -0,0 +1,208 @@
+import os
+import argparse
+import numpy
+
+# precomputed counts of the figfams of every category, subcategory, subsystem and role per genome,
+#  written by collate_data.py, so summaries by category per genome are lookups instead of a pass over
+#  all proteins.
+#
+#  nodes are identified by their full path from the category down (the same subsystem name under two
+#  subcategories is two nodes), and the nodes of each level are ordered by their parent so the children
+#  of node i are the nodes children[i] to children[i + 1] of the level below. for each level there is:
+#
+#  <level>_names    - name of each node
+#  <level>_parents  - index of the parent node in the level above (-1 for categories)
+#  <level>_children - offsets of the children in the level below (not for roles)
+#  <level>_figfams  - number of distinct figfams in each node
+#  <level>_common   - number of figfams in each node present in every genome
+#  <level>_presence - nodes x genomes, number of figfams of the node present in the genome
+#  <level>_unique   - nodes x genomes, number of figfams of the node present only in that genome
+#
+#  a figfam with several annotations counts once in each node any of them is in, so the figfams of the
+#  children of a node can add up to more than its own. figfams without subsystem data are only counted
+#  in the genome_* totals, which cover all figfams.
+
+HIERARCHY_LEVELS = ['category', 'subcategory', 'subsystem', 'role']
+
+def build_cube(all_protein_data):
+
+    fig_list = list(all_protein_data)
+
+    # every (figfam, genome) pair once, genomes in first seen order
+    genome_index = {}
+    pair_figs = []
+    pair_genomes = []
+    for (i, fig) in enumerate(fig_list):
+        for contig_id in dict.fromkeys(all_protein_data[fig]['contig_ids']):
+            if contig_id not in genome_index:
+                genome_index[contig_id] = len(genome_index)
+            pair_figs.append(i)
+            pair_genomes.append(genome_index[contig_id])
+
+    total_genomes = len(genome_index)
+    pair_figs = numpy.array(pair_figs, dtype=numpy.int64)
+    pair_genomes = numpy.array(pair_genomes, dtype=numpy.int64)
+
+    genome_counts = numpy.bincount(pair_figs, minlength=len(fig_list))
+    is_common = genome_counts == total_genomes
+    is_unique_pair = genome_counts[pair_figs] == 1
+
+    cube = {
+        'genomes' : numpy.array(list(genome_index), dtype=str),
+        'genome_presence' : numpy.bincount(pair_genomes, minlength=total_genomes).astype(numpy.uint32),
+        'genome_unique' : numpy.bincount(pair_genomes[is_unique_pair], minlength=total_genomes).astype(numpy.uint32),
+        'total_figfams' : numpy.uint32(len(fig_list)),
+        'common_figfams' : numpy.uint32(is_common.sum())
+    }
+
+    # (figfam, role path) of every distinct annotation, a figfam counts once in each node any of its
+    #  annotations is in, as in the figfam_roles of query_store.py
+    fig_paths = [(i, tuple(path)) for (i, fig) in enumerate(fig_list) for path in all_protein_data[fig].get('annotations', []) if isinstance(path[-1], str)]
+
+    parent_index = {(): 0}
+    for (depth, level) in enumerate(HIERARCHY_LEVELS):
+
+        paths = set(path[:depth + 1] for (i, path) in fig_paths)
+        paths = sorted(paths, key=lambda path: (parent_index[path[:-1]], path[-1]))
+        node_index = {path : n for (n, path) in enumerate(paths)}
+        total_nodes = len(paths)
+
+        # distinct (figfam, node) memberships of this level, ordered by figfam
+        memberships = sorted(set((i, node_index[path[:depth + 1]]) for (i, path) in fig_paths))
+        member_figs = numpy.array([i for (i, n) in memberships], dtype=numpy.int64)
+        member_nodes = numpy.array([n for (i, n) in memberships], dtype=numpy.int64)
+
+        # every (figfam, genome) pair repeated for each node of its figfam
+        member_counts = numpy.bincount(member_figs, minlength=len(fig_list))
+        member_offsets = numpy.concatenate([[0], numpy.cumsum(member_counts)[:-1]]).astype(numpy.int64)
+        repeats = member_counts[pair_figs]
+        pair_starts = numpy.repeat(numpy.cumsum(repeats) - repeats, repeats)
+        expanded = numpy.repeat(member_offsets[pair_figs], repeats) + numpy.arange(len(pair_starts), dtype=numpy.int64) - pair_starts
+        pair_nodes = member_nodes[expanded]
+        node_genomes = numpy.repeat(pair_genomes, repeats)
+        node_unique = numpy.repeat(is_unique_pair, repeats)
+
+        def count_cells(mask):
+            cells = pair_nodes[mask] * total_genomes + node_genomes[mask]
+            return numpy.bincount(cells, minlength=total_nodes * total_genomes).reshape(total_nodes, total_genomes).astype(numpy.uint32)
+
+        cube[level + '_names'] = numpy.array([path[-1] for path in paths], dtype=str)
+        cube[level + '_parents'] = numpy.array([parent_index[path[:-1]] if depth > 0 else -1 for path in paths], dtype=numpy.int32)
+        cube[level + '_figfams'] = numpy.bincount(member_nodes, minlength=total_nodes).astype(numpy.uint32)
+        cube[level + '_common'] = numpy.bincount(member_nodes[is_common[member_figs]], minlength=total_nodes).astype(numpy.uint32)
+        cube[level + '_presence'] = count_cells(numpy.ones(len(pair_nodes), dtype=bool))
+        cube[level + '_unique'] = count_cells(node_unique)
+
+        if depth > 0:
+            # parents are sorted already, so their children are contiguous
+            parent_level = HIERARCHY_LEVELS[depth - 1]
+            num_parents = len(cube[parent_level + '_names'])
+            children = numpy.zeros(num_parents + 1, dtype=numpy.int32)
+            children[1:] = numpy.cumsum(numpy.bincount(cube[level + '_parents'], minlength=num_parents))
+            cube[parent_level + '_children'] = children
+
+        parent_index = node_index
+
+    return cube
+
+def write_cube(cube_file_path, cube):
+    numpy.savez_compressed(cube_file_path, **cube)
+
+# loads a cube written by write_cube, with lookups from genome id and node path to index added
+def load_cube(cube_file_path):
+    with numpy.load(cube_file_path) as f:
+        cube = {key : f[key] for key in f.files}
+    cube['genome_index'] = {genome : g for (g, genome) in enumerate(cube['genomes'].tolist())}
+    cube['node_index'] = {}
+    for (depth, level) in enumerate(HIERARCHY_LEVELS):
+        parents = cube[level + '_parents'].tolist()
+        for (n, name) in enumerate(cube[level + '_names'].tolist()):
+            parent_path = node_path(cube, depth - 1, parents[n]) if depth > 0 else ()
+            cube['node_index'][parent_path + (name,)] = n
+    return cube
+
+def node_path(cube, depth, n):
+    path = []
+    while depth >= 0:
+        level = HIERARCHY_LEVELS[depth]
+        path.append(str(cube[level + '_names'][n]))
+        n = cube[level + '_parents'][n]
+        depth -= 1
+    return tuple(reversed(path))
+
+def find_node(cube, path):
+    path = tuple(path)
+    if path not in cube['node_index']:
+        raise Exception("no node: %s in aggregate cube" % " / ".join(path))
+    return (len(path) - 1, cube['node_index'][path])
+
+# counts of a node (given by its level and index), or of all figfams when depth is -1, for one genome
+#  or as arrays over all genomes
+def node_counts(cube, depth, n, genome=None):
+    if depth < 0:
+        counts = {
+            'figfams' : int(cube['total_figfams']),
+            'common' : int(cube['common_figfams']),
+            'presence' : cube['genome_presence'],
+            'unique' : cube['genome_unique']
+        }
+    else:
+        level = HIERARCHY_LEVELS[depth]
+        counts = {
+            'figfams' : int(cube[level + '_figfams'][n]),
+            'common' : int(cube[level + '_common'][n]),
+            'presence' : cube[level + '_presence'][n],
+            'unique' : cube[level + '_unique'][n]
+        }
+    if genome is not None:
+        if genome not in cube['genome_index']:
+            raise Exception("no genome with id: %s in aggregate cube" % genome)
+        g = cube['genome_index'][genome]
+        counts['presence'] = int(counts['presence'][g])
+        counts['unique'] = int(counts['unique'][g])
+    return counts
+
+# drill down, the (depth, index) of the children of a node, depth -1 is the root above the categories
+def node_children(cube, depth, n):
+    if depth + 1 >= len(HIERARCHY_LEVELS):
+        return []
+    if depth < 0:
+        return [(0, c) for c in range(len(cube['category_names']))]
+    children = cube[HIERARCHY_LEVELS[depth] + '_children']
+    return [(depth + 1, c) for c in range(children[n], children[n + 1])]
+
+# roll up, the (depth, index) of the parent of a node
+def node_parent(cube, depth, n):
+    if depth <= 0:
+        return (-1, 0)
+    return (depth - 1, int(cube[HIERARCHY_LEVELS[depth] + '_parents'][n]))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Prints the precomputed counts of a category/subcategory/subsystem/role and its children from the aggregate cube written by collate_data.py.')
+    parser.add_argument(
+        'path', type=str, nargs='*',
+        help='category, subcategory, subsystem and role of the node to show, as far down as wanted (defaults to the top, all categories)'
+    )
+    parser.add_argument(
+        '--cube', metavar='cube', type=str, default=os.path.join(os.getcwd(), 'output/aggregate_cube.npz'),
+        help='the aggregate cube to read (defaults to output/aggregate_cube.npz)'
+    )
+    parser.add_argument(
+        '--genome', metavar='genome', type=str, default=None,
+        help='contig id of the genome to show counts for (defaults to the sum over all genomes)'
+    )
+
+    args = parser.parse_args()
+    cube = load_cube(args.cube)
+
+    def show(depth, n, name, indent):
+        counts = node_counts(cube, depth, n, args.genome)
+        presence = counts['presence'] if args.genome is not None else int(counts['presence'].sum())
+        unique = counts['unique'] if args.genome is not None else int(counts['unique'].sum())
+        print("%s%s: %d figfams, %d common, %d present, %d unique" % (indent, name, counts['figfams'], counts['common'], presence, unique))
+
+    (depth, n) = find_node(cube, args.path) if len(args.path) > 0 else (-1, 0)
+    show(depth, n, " / ".join(args.path) if len(args.path) > 0 else "all", "")
+    for (child_depth, c) in node_children(cube, depth, n):
+        show(child_depth, c, str(cube[HIERARCHY_LEVELS[child_depth] + '_names'][c]), "  ")
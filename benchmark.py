@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import subprocess
+
+# our utils
+import synthetic_data
+
+# times every stage of the analysis on a synthetic dataset (see synthetic_data.py), recording wall time,
+#  peak resident memory, rows per second and output sizes, and compares them against a stored baseline.
+#
+#  each stage runs as its own process in the work directory, the same way it is run by hand, its
+#  output goes to a log file there. peak memory is that of the stage process and the worker processes
+#  it started, as reported by the os when it exits.
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# name, script and arguments, the input rows it reads (from the dataset counts) and what it writes
+STAGES = [
+    {
+        'name' : 'proteins',
+        'args' : lambda a: ['proteins.py', a.data_dir, '--jobs', str(a.jobs)],
+        'rows' : 'classification_rows',
+        'outputs' : ['common_proteins.csv', 'unique_proteins.csv', 'unique_column_proteins.csv', 'output_stats.csv', 'partitions.csv', 'frequency_histogram.csv', 'all_proteins.bin']
+    },
+    {
+        'name' : 'collate_data',
+        'args' : lambda a: ['collate_data.py', '--all-proteins', 'output/all_proteins.bin', '--subsystems-dir', a.subsystems_dir, '--jobs', str(a.jobs)],
+        'rows' : 'subsystem_rows',
+        'outputs' : ['proteins.json', 'categories.json', 'genomes.json', 'aggregate_cube.npz']
+    },
+    {
+        'name' : 'similarity_heatmap',
+        'args' : lambda a: ['similarity_heatmap.py'] + a.similarity_args.split(),
+        'rows' : 'genomes',
+        'outputs' : ['similarity_matrix.npy', 'similarity_labels.json', 'similarity_sparse.npz', 'similarity_nearest.csv', 'genome_sketches.npz']
+    },
+    {
+        'name' : 'rarefaction',
+        'args' : lambda a: ['rarefaction.py', a.data_dir, '--jobs', str(a.jobs), '--permutations', str(a.permutations)],
+        'rows' : 'classification_rows',
+        'outputs' : ['rarefaction_curves.csv', 'rarefaction_curves.png']
+    }
+]
+
+def count_rows(directory, ext):
+    total = 0
+    for entry in os.listdir(directory):
+        if os.path.splitext(entry)[1] == ext:
+            with open(os.path.join(directory, entry), 'rb') as f:
+                # minus the header
+                total += sum(1 for _ in f) - 1
+    return total
+
+def run_stage(stage, args, work_dir, log_file):
+    stage_args = stage['args'](args)
+    command = [sys.executable, os.path.join(script_dir, stage_args[0])] + stage_args[1:]
+    log_file.write("[benchmark] running: %s\n" % " ".join(command))
+    log_file.flush()
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=work_dir, stdout=log_file, stderr=subprocess.STDOUT)
+    # wait4 gives the resource usage of this process (and the workers it waited for) alone
+    (_, status, usage) = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if process.returncode != 0:
+        raise Exception("stage %s failed with status %d, see %s" % (stage['name'], process.returncode, log_file.name))
+    # ru_maxrss is in kilobytes on linux
+    return elapsed, usage.ru_maxrss * 1024
+
+# only counts the outputs written since the stage started, not ones left from earlier runs
+def output_sizes(work_dir, outputs, since):
+    sizes = {}
+    for name in outputs:
+        path = os.path.join(work_dir, 'output', name)
+        if os.path.exists(path) and os.path.getmtime(path) >= since:
+            sizes[name] = os.path.getsize(path)
+    return sizes
+
+def compare_to_baseline(results, baseline, tolerance):
+    # returns a list of (stage, metric, baseline value, current value) that got worse beyond tolerance
+    regressions = []
+    baseline_stages = {stage['name'] : stage for stage in baseline['stages']}
+    for stage in results['stages']:
+        if stage['name'] not in baseline_stages:
+            continue
+        previous = baseline_stages[stage['name']]
+        for metric in ['seconds', 'peak_rss_bytes', 'output_bytes']:
+            if previous[metric] > 0 and stage[metric] > previous[metric] * (1.0 + tolerance):
+                regressions.append((stage['name'], metric, previous[metric], stage[metric]))
+    return regressions
+
+if __name__ == '__main__':
+
+    defaults = synthetic_data.default_parameters()
+
+    parser = argparse.ArgumentParser(description='Benchmarks every stage of the analysis on synthetic data, optionally comparing against a stored baseline.')
+    parser.add_argument(
+        '--work-dir', metavar='work_dir', type=str, default=os.path.join(os.getcwd(), 'output', 'benchmark'),
+        help='directory to generate the data in and run the stages from (defaults to output/benchmark)'
+    )
+    parser.add_argument(
+        '--genomes', metavar='genomes', type=int, default=defaults['genomes'],
+        help='number of genomes to generate (defaults to %d)' % defaults['genomes']
+    )
+    parser.add_argument(
+        '--proteins', metavar='proteins', type=int, default=defaults['proteins'],
+        help='number of distinct figfams in the generated pan genome (defaults to %d)' % defaults['proteins']
+    )
+    parser.add_argument(
+        '--seed', metavar='seed', type=int, default=defaults['seed'],
+        help='seed to generate the data from (defaults to %d)' % defaults['seed']
+    )
+    parser.add_argument(
+        '--stages', metavar='stages', type=str, default=",".join(stage['name'] for stage in STAGES),
+        help='comma separated stages to run, in order (defaults to all: %s)' % ",".join(stage['name'] for stage in STAGES)
+    )
+    parser.add_argument(
+        '--jobs', metavar='jobs', type=int, default=1,
+        help='number of worker processes for the stages which take --jobs (defaults to 1)'
+    )
+    parser.add_argument(
+        '--similarity-args', metavar='similarity_args', type=str, default='--mode sketch',
+        help='arguments to run similarity_heatmap.py with (defaults to "--mode sketch", the exact mode also plots)'
+    )
+    parser.add_argument(
+        '--permutations', metavar='permutations', type=int, default=100,
+        help='number of orderings for rarefaction.py (defaults to 100)'
+    )
+    parser.add_argument(
+        '--output', metavar='output', type=str, default='benchmark_results.json',
+        help='file to write the results to, relative to the work directory (defaults to benchmark_results.json)'
+    )
+    parser.add_argument(
+        '--baseline', metavar='baseline', type=str, default=None,
+        help='results of an earlier run to compare against, exits with status 1 on any regression'
+    )
+    parser.add_argument(
+        '--tolerance', metavar='tolerance', type=float, default=0.2,
+        help='how much worse than the baseline a stage may be before it counts as a regression (defaults to 0.2, 20%%)'
+    )
+    parser.add_argument(
+        '--regenerate', default=False, action='store_true',
+        help='generate the data again even if the work directory already has data for the same sizes and seed'
+    )
+
+    args = parser.parse_args()
+    work_dir = os.path.abspath(args.work_dir)
+    args.data_dir = os.path.join(work_dir, 'data')
+    args.subsystems_dir = os.path.join(args.data_dir, 'subsystems')
+
+    stage_names = args.stages.split(",")
+    unknown_stages = [name for name in stage_names if name not in [stage['name'] for stage in STAGES]]
+    if len(unknown_stages) > 0:
+        parser.error("unknown stages: %s, expected any of: %s" % (", ".join(unknown_stages), ", ".join(stage['name'] for stage in STAGES)))
+
+    params = synthetic_data.default_parameters()
+    params['genomes'] = args.genomes
+    params['proteins'] = args.proteins
+    params['seed'] = args.seed
+
+    # the data only has to be generated once for the same parameters
+    dataset_file_path = os.path.join(work_dir, 'dataset.json')
+    dataset = None
+    if os.path.exists(dataset_file_path) and not args.regenerate:
+        with open(dataset_file_path, 'r') as f:
+            dataset = json.load(f)
+        if dataset['parameters'] != params:
+            dataset = None
+
+    if dataset is None:
+        print("[benchmark] generating %d genomes with %d proteins (seed %d) in: %s" % (args.genomes, args.proteins, args.seed, args.data_dir))
+        if not os.path.exists(os.path.join(work_dir, 'output')):
+            os.makedirs(os.path.join(work_dir, 'output'))
+        synthetic_data.generate_dataset(params, args.data_dir, args.subsystems_dir, jobs=args.jobs)
+        dataset = {
+            'parameters' : params,
+            'genomes' : args.genomes,
+            'classification_rows' : count_rows(args.data_dir, '.csv'),
+            'subsystem_rows' : count_rows(args.subsystems_dir, '.tsv')
+        }
+        with open(dataset_file_path, 'w') as f:
+            json.dump(dataset, f)
+
+    results = {
+        'date' : datetime.datetime.now().isoformat(),
+        'python' : sys.version.split()[0],
+        'dataset' : dataset,
+        'jobs' : args.jobs,
+        'stages' : []
+    }
+
+    with open(os.path.join(work_dir, 'benchmark.log'), 'w') as log_file:
+        for stage in [s for name in stage_names for s in STAGES if s['name'] == name]:
+            started_at = time.time()
+            (seconds, peak_rss) = run_stage(stage, args, work_dir, log_file)
+            rows = dataset[stage['rows']]
+            sizes = output_sizes(work_dir, stage['outputs'], started_at)
+            results['stages'].append({
+                'name' : stage['name'],
+                'seconds' : seconds,
+                'peak_rss_bytes' : peak_rss,
+                'rows' : rows,
+                'rows_unit' : stage['rows'],
+                'rows_per_second' : rows / seconds,
+                'output_bytes' : sum(sizes.values()),
+                'outputs' : sizes
+            })
+            print("[benchmark] %s: %.2f s, peak rss %.1f MB, %.0f %s/s, %.1f MB output" % (
+                stage['name'], seconds, peak_rss / float(1 << 20), rows / seconds, stage['rows'], sum(sizes.values()) / float(1 << 20)
+            ))
+
+    results_file_path = os.path.join(work_dir, args.output)
+    with open(results_file_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("[benchmark] wrote results to: %s" % results_file_path)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['dataset']['parameters'] != dataset['parameters']:
+            print("[benchmark] warning: baseline was run on a different dataset: %s" % baseline['dataset']['parameters'])
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for (name, metric, previous, current) in regressions:
+            print("[benchmark] regression in %s: %s went from %s to %s (%+.1f %%)" % (name, metric, previous, current, (current / float(previous) - 1.0) * 100.0))
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("[benchmark] no regressions against baseline: %s" % args.baseline)
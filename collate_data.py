@@ -1,139 +1,231 @@
 import os
 import sys
 import csv
-import json
+import array
 import argparse
+import numpy
 
 # our utils
 import util
+import protein_store
+import compact_payload
+import aggregate_cube
+import subsystems
 
-# FIXME: this is probably the wrong way to go about this..
+# FIXME: this is probably the wrong way to go about this.. only needed for the csv export of all proteins
 csv.field_size_limit(sys.maxsize)
 
 # the only purpose of this file is to collate the various data into a unified format
 #  for feeding into our javascript visualization, so we can depend on the format we specify here
 #  instead of a spread of various data files whose format may change.
-
-parser = argparse.ArgumentParser(description='Collate protein data for use in js visualization.')
-parser.add_argument(
-    '--all-proteins', metavar='all_proteins', type=str, required=True,
-    help='the csv file with all proteins in it.'
-)
-
-parser.add_argument(
-    '--subsystems-dir', metavar='subsystems_dir', type=str, required=True,
-    help='the directory with the files containing the subsystem data in it.'
-)
-
-args = parser.parse_args()
-cur_dir = os.getcwd()
-
-protein_data = {}
-
-all_proteins_file = args.all_proteins
-subsystems_dir = args.subsystems_dir
-
-# slightly hacky, but necessary
-feature_id_to_fig_mapping = {}
-
-all_protein_data = {}
-all_category_data = {}
-
-with open(all_proteins_file, 'r') as csvfile:
-
-    reader = csv.DictReader(csvfile)
-
-    for row in reader:
-
-        figfam_id = row['figfam']
-        functions_list = [f.strip() for f in row['function'].split(";")]
-        features_list = [f.strip() for f in row['feature_ids'].split(";")]
-        contigs_list = [c.strip() for c in row['contig_ids'].split(";")]
-        all_protein_data[figfam_id] = {
-            'functions' : functions_list,
-            'feature_ids' : features_list,
-            'contig_ids' : contigs_list
-        }
-
-        for f in features_list:
-            feature_id_to_fig_mapping[f] = figfam_id
-
-
-os.chdir(args.subsystems_dir)
-files_in_subsystems_dir = util.get_files_in_folder_with_ext(".tsv")
-print("[collate_data] got: %d files with subsystems data to process..." % len(files_in_subsystems_dir))
-
-skipped_rows = 0
-processed_rows = 0
-for entry in files_in_subsystems_dir:
-
-    with open(entry, 'r') as csvfile:
-
-        reader = csv.DictReader(csvfile, delimiter='\t')
-        skipped_rows = 0
-
-        for row in reader:
-
-            category = row['Category']
-            subcategory = row['Subcategory']
-            subsystem = row['Subsystem']
-            role = row['Role']
-
-            features = [f.strip() for f in row['Features'].split(",")]
-            if features[0] not in feature_id_to_fig_mapping:
-                skipped_rows += 1
-                continue
-            else:
-                processed_rows += 1
-                figfam_id = feature_id_to_fig_mapping[features[0]]
-
-            # append our category data
-            data = all_protein_data[figfam_id]
-            data['category'] = category
-            data['subcategory'] = subcategory
-            data['subsystem'] = subsystem
-            data['role'] = role
-
-            all_category_data[subcategory] = category
-            all_category_data[subsystem] = subcategory
-            all_category_data[role] = subsystem
-
-            all_protein_data[figfam_id] = data
-
-total_rows = skipped_rows + processed_rows
-total_percentage_skipped = (skipped_rows / float(total_rows)) * 100.0
-print("[collate_data] skipped %d rows from total of %d entries, skipped %f procent" \
-      % (skipped_rows, total_rows, total_percentage_skipped))
-
-output_file_path = os.path.join(cur_dir, 'output/proteins.json')
-with open(output_file_path, 'w') as f:
-    json.dump(all_protein_data, f)
-    print("[collate_data] wrote data with %d proteins to: %s" % (len(all_protein_data), output_file_path))
-
-output_category_file_path = os.path.join(cur_dir, 'output/categories.json')
-with open(output_category_file_path, 'w') as f:
-    json.dump(all_category_data, f)
-    print("[collate_data] wrote data with %d categories/subcategories/subsystems/roles to: %s" % (len(all_category_data), output_category_file_path))
-
-output_genomes_file_path = os.path.join(cur_dir, 'output/genomes.json')
-with open(output_genomes_file_path, 'w') as f:
-
-    all_genome_data = {}
-    total_proteins = 0
-
-    for (figfam_id, data)  in all_protein_data.items():
-        for contig_id in data['contig_ids']:
-            if contig_id not in all_genome_data:
-                all_genome_data[contig_id] = {
-                    'proteins' : set([figfam_id])
-                }
-            else:
-                all_genome_data[contig_id]['proteins'].add(figfam_id)
-        total_proteins += 1
-
-    # json no has sets, so we turn sets into list at end
-    for (contig_id, data) in all_genome_data.items():
-        data['proteins'] = list(data['proteins'])
-
-    json.dump(all_genome_data, f)
-    print("[collate_data] wrote data with %d genomes (%d proteins) to: %s" % (len(all_genome_data), total_proteins, output_genomes_file_path))
+#
+#  load_all_proteins, collate_subsystems and write_collated_outputs can be used from other scripts in
+#  the same process, the command line below only strings them together.
+
+def add_protein(all_protein_data, feature_id_to_fig_mapping, figfam_id, functions_list, features_list, contigs_list):
+    all_protein_data[figfam_id] = {
+        'functions' : functions_list,
+        'feature_ids' : features_list,
+        'contig_ids' : contigs_list
+    }
+    for f in features_list:
+        feature_id_to_fig_mapping[f] = figfam_id
+
+# returns (all_protein_data, feature id -> figfam mapping), from the binary store proteins.py writes or the
+#  csv export of it. the binary store holds the lists as they are, the csv export has them joined with ;
+def load_all_proteins(all_proteins_file):
+
+    all_protein_data = {}
+    feature_id_to_fig_mapping = {}
+
+    if protein_store.is_protein_store(all_proteins_file):
+
+        for (figfam_id, function, features_list, contigs_list) in protein_store.iter_proteins(all_proteins_file):
+            functions_list = [f.strip() for f in function.split(";")]
+            add_protein(all_protein_data, feature_id_to_fig_mapping, figfam_id, functions_list, features_list, contigs_list)
+
+    else:
+
+        # every contig id is kept once and shared by all its features, as the store decodes them
+        contig_ids = {}
+
+        with util.open_text(all_proteins_file, 'r') as csvfile:
+
+            reader = csv.DictReader(csvfile)
+
+            for row in reader:
+
+                figfam_id = row['figfam']
+                functions_list = [f.strip() for f in row['function'].split(";")]
+                features_list = [f.strip() for f in row['feature_ids'].split(";")]
+                contigs_list = [contig_ids.setdefault(c, c) for c in (c.strip() for c in row['contig_ids'].split(";"))]
+                add_protein(all_protein_data, feature_id_to_fig_mapping, figfam_id, functions_list, features_list, contigs_list)
+
+    return (all_protein_data, feature_id_to_fig_mapping)
+
+# the same from the protein registry of proteins.analyse_proteins, without going through a file
+def proteins_from_analysis(analysis_protein_data):
+    all_protein_data = {}
+    feature_id_to_fig_mapping = {}
+    for (figfam_id, data) in analysis_protein_data.items():
+        functions_list = [f.strip() for f in data['function'].split(";")]
+        add_protein(all_protein_data, feature_id_to_fig_mapping, figfam_id, functions_list, data['feature_ids'], data['contig_ids'])
+    return (all_protein_data, feature_id_to_fig_mapping)
+
+# joins the subsystem tables in subsystems_dir onto all_protein_data (in place), returns the category data
+#  and the row totals
+def collate_subsystems(all_protein_data, feature_id_to_fig_mapping, subsystems_dir, jobs=1, metrics=None, recursive=False):
+
+    metrics = metrics if metrics is not None else util.Metrics('collate_data')
+    all_category_data = {}
+
+    # sorted, so which annotation of a figfam comes last does not depend on the directory listing
+    tsv_files = util.get_files_in_folder_with_ext(".tsv", subsystems_dir, recursive=recursive, compressed=True)
+    files_in_subsystems_dir = [os.path.join(subsystems_dir, f) for f in sorted(tsv_files)]
+    print("[collate_data] got: %d files with subsystems data to process..." % len(files_in_subsystems_dir))
+
+    with metrics.phase('join subsystems') as phase:
+        subsystem_results = subsystems.join_subsystems_tsvs(files_in_subsystems_dir, feature_id_to_fig_mapping, jobs=jobs)
+        phase['rows'] = sum(r['processed_rows'] + r['skipped_rows'] for r in subsystem_results)
+        phase['bytes'] = sum(os.path.getsize(f) for f in files_in_subsystems_dir)
+
+    for result in subsystem_results:
+        file_rows = result['processed_rows'] + result['skipped_rows']
+        if file_rows > 0:
+            print("[collate_data] skipped %d rows from total of %d entries in %s, skipped %f procent" \
+                  % (result['skipped_rows'], file_rows, os.path.basename(result['file_name']), (result['skipped_rows'] / float(file_rows)) * 100.0))
+
+    with metrics.phase('merge subsystems') as phase:
+        totals = subsystems.merge_subsystem_results(subsystem_results, all_protein_data, all_category_data)
+        phase['rows'] = len(subsystem_results)
+
+    skipped_rows = totals['skipped_rows']
+    processed_rows = totals['processed_rows']
+
+    total_rows = skipped_rows + processed_rows
+    if total_rows == 0:
+        raise Exception("expected subsystem data in: %s, found no rows!" % subsystems_dir)
+    total_percentage_skipped = (skipped_rows / float(total_rows)) * 100.0
+    print("[collate_data] skipped %d rows from total of %d entries, skipped %f procent" \
+          % (skipped_rows, total_rows, total_percentage_skipped))
+    metrics.count('processed_rows', processed_rows)
+    metrics.count('skipped_rows', skipped_rows)
+
+    return (all_category_data, totals)
+
+# (contig id, {'proteins' : [figfams]}) of every genome, in the order the genomes first appear in
+#  all_protein_data and with their figfams in its order. only (genome, figfam) pairs of integers are
+#  held while they are sorted, each genome's list is built when it is yielded
+def iter_genome_data(all_protein_data):
+
+    contig_index = {}
+    figfams = []
+    pair_contigs = array.array('q')
+    fig_counts = array.array('q')
+    for (figfam_id, data) in all_protein_data.items():
+        figfams.append(figfam_id)
+        pair_contigs.extend([contig_index.setdefault(contig_id, len(contig_index)) for contig_id in data['contig_ids']])
+        fig_counts.append(len(data['contig_ids']))
+
+    # sorted by genome then figfam, without the duplicates of genomes with a figfam more than once
+    total_figfams = max(1, len(figfams))
+    pairs = numpy.frombuffer(pair_contigs, dtype=numpy.int64) * total_figfams
+    pairs += numpy.repeat(numpy.arange(len(figfams), dtype=numpy.int64), numpy.frombuffer(fig_counts, dtype=numpy.int64))
+    del pair_contigs
+    pairs.sort()
+    pairs = pairs[numpy.concatenate(([True], pairs[1:] != pairs[:-1]))] if len(pairs) > 0 else pairs
+    bounds = numpy.searchsorted(pairs, numpy.arange(len(contig_index) + 1, dtype=numpy.int64) * total_figfams)
+
+    for (contig_code, contig_id) in enumerate(contig_index):
+        fig_codes = (pairs[bounds[contig_code]:bounds[contig_code + 1]] % total_figfams).tolist()
+        yield (contig_id, {'proteins' : [figfams[f] for f in fig_codes]})
+
+# contig id -> {'proteins' : [figfams]}
+def genome_data(all_protein_data):
+    return dict(iter_genome_data(all_protein_data))
+
+# the json outputs are written a protein, category or genome at a time (see util.write_json_object), so
+#  the whole document is never built as one string
+def write_collated_outputs(all_protein_data, all_category_data, output_dir, output_format='json', metrics=None, compression=None):
+
+    metrics = metrics if metrics is not None else util.Metrics('collate_data')
+
+    if output_format in ('json', 'both'):
+        output_file_path = util.compressed_path(os.path.join(output_dir, 'proteins.json'), compression)
+        with metrics.phase('json dump proteins.json', output=output_file_path) as phase, util.open_text(output_file_path, 'w') as f:
+            phase['rows'] = util.write_json_object(f, all_protein_data.items())
+            print("[collate_data] wrote data with %d proteins to: %s" % (len(all_protein_data), output_file_path))
+
+    if output_format in ('compact', 'both'):
+        output_manifest_file_path = os.path.join(output_dir, 'proteins.manifest.json')
+        output_binary_file_path = os.path.join(output_dir, 'proteins.bin')
+        with metrics.phase('write compact proteins.bin', output=output_binary_file_path) as phase:
+            compact_payload.write_compact_proteins(output_manifest_file_path, output_binary_file_path, all_protein_data)
+            phase['rows'] = len(all_protein_data)
+        print("[collate_data] wrote compact data with %d proteins to: %s (and %s)" % (len(all_protein_data), output_manifest_file_path, output_binary_file_path))
+
+    output_category_file_path = util.compressed_path(os.path.join(output_dir, 'categories.json'), compression)
+    with metrics.phase('json dump categories.json', output=output_category_file_path) as phase, util.open_text(output_category_file_path, 'w') as f:
+        phase['rows'] = util.write_json_object(f, all_category_data.items())
+        print("[collate_data] wrote data with %d categories/subcategories/subsystems/roles to: %s" % (len(all_category_data), output_category_file_path))
+
+    output_genomes_file_path = util.compressed_path(os.path.join(output_dir, 'genomes.json'), compression)
+    with metrics.phase('json dump genomes.json', output=output_genomes_file_path) as phase, util.open_text(output_genomes_file_path, 'w') as f:
+        phase['rows'] = util.write_json_object(f, iter_genome_data(all_protein_data))
+        print("[collate_data] wrote data with %d genomes (%d proteins) to: %s" % (phase['rows'], len(all_protein_data), output_genomes_file_path))
+
+    output_cube_file_path = os.path.join(output_dir, 'aggregate_cube.npz')
+    with metrics.phase('write aggregate_cube.npz', output=output_cube_file_path) as phase:
+        cube = aggregate_cube.build_cube(all_protein_data)
+        aggregate_cube.write_cube(output_cube_file_path, cube)
+        phase['rows'] = len(all_protein_data)
+    print("[collate_data] wrote aggregate counts of %d categories, %d subcategories, %d subsystems and %d roles over %d genomes to: %s" \
+          % (len(cube['category_names']), len(cube['subcategory_names']), len(cube['subsystem_names']), len(cube['role_names']), len(cube['genomes']), output_cube_file_path))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Collate protein data for use in js visualization.')
+    parser.add_argument(
+        '--all-proteins', metavar='all_proteins', type=str, required=True,
+        help='the file with all proteins in it, output/all_proteins.bin from proteins.py (or the csv export of it).'
+    )
+
+    parser.add_argument(
+        '--subsystems-dir', metavar='subsystems_dir', type=str, required=True,
+        help='the directory with the files containing the subsystem data in it.'
+    )
+
+    parser.add_argument(
+        '--output-format', metavar='output_format', type=str, choices=['json', 'compact', 'both'], default='json',
+        help='json writes output/proteins.json, compact writes the dictionary encoded output/proteins.manifest.json and output/proteins.bin for faster loading in the visualization (defaults to json)'
+    )
+
+    parser.add_argument(
+        '--jobs', metavar='jobs', type=int, default=1,
+        help='number of worker processes to join the subsystem files with (defaults to 1, no worker processes)'
+    )
+
+    parser.add_argument(
+        '--recursive', default=False, action='store_true',
+        help='also read the subsystem files in the directories below the subsystems directory'
+    )
+
+    util.add_compression_arguments(parser)
+
+    util.add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    cur_dir = os.getcwd()
+    metrics = util.create_metrics('collate_data', args, cur_dir)
+
+    with metrics.phase('load all proteins', output=args.all_proteins) as phase:
+        (all_protein_data, feature_id_to_fig_mapping) = load_all_proteins(args.all_proteins)
+        phase['rows'] = len(all_protein_data)
+
+    (all_category_data, totals) = collate_subsystems(
+        all_protein_data, feature_id_to_fig_mapping, args.subsystems_dir, jobs=args.jobs, metrics=metrics, recursive=args.recursive
+    )
+
+    write_collated_outputs(all_protein_data, all_category_data, os.path.join(cur_dir, 'output'), output_format=args.output_format, metrics=metrics, compression=args.compress)
+
+    metrics.write_report()
@@ -0,0 +1,107 @@
+import os
+import json
+import numpy
+
+# compact form of proteins.json for the js visualization, a small json manifest plus a binary sidecar.
+#
+#  the category, subcategory, subsystem, role, function and contig id strings are each stored once in a
+#  dictionary in the manifest, and every figfam refers to them by integer code (-1 when it has none).
+#  the functions and contig ids of each figfam are flat code arrays with offsets, the codes of figfam i
+#  are codes[offsets[i]:offsets[i + 1]]. contig ids are stored once per figfam (the visualization
+#  deduplicates them anyway), feature ids are left out as the visualization does not use them.
+#
+#  all buffers in the sidecar are little endian 32 bit integers, so they can be viewed as typed arrays
+#  in the browser without copying, see load_compact_proteins in js/main.js for the decoder.
+
+PAYLOAD_VERSION = 1
+HIERARCHY_LEVELS = ['category', 'subcategory', 'subsystem', 'role']
+
+def encode(value, index, table):
+    if value is None:
+        return -1
+    if value not in index:
+        index[value] = len(table)
+        table.append(value)
+    return index[value]
+
+def write_compact_proteins(manifest_file_path, binary_file_path, all_protein_data):
+
+    dictionaries = {name : [] for name in HIERARCHY_LEVELS + ['function', 'contig']}
+    indexes = {name : {} for name in dictionaries}
+
+    total_figs = len(all_protein_data)
+    level_codes = {level : numpy.full(total_figs, -1, dtype='<i4') for level in HIERARCHY_LEVELS}
+    function_offsets = numpy.zeros(total_figs + 1, dtype='<u4')
+    contig_offsets = numpy.zeros(total_figs + 1, dtype='<u4')
+    function_codes = []
+    contig_codes = []
+
+    for (i, data) in enumerate(all_protein_data.values()):
+        for level in HIERARCHY_LEVELS:
+            level_codes[level][i] = encode(data.get(level), indexes[level], dictionaries[level])
+        function_codes += [encode(f, indexes['function'], dictionaries['function']) for f in data['functions']]
+        function_offsets[i + 1] = len(function_codes)
+        # keep first seen order of the contigs, without duplicates
+        contig_codes += [encode(c, indexes['contig'], dictionaries['contig']) for c in dict.fromkeys(data['contig_ids'])]
+        contig_offsets[i + 1] = len(contig_codes)
+
+    buffers = [(level, level_codes[level]) for level in HIERARCHY_LEVELS] + [
+        ('function_offsets', function_offsets),
+        ('function_codes', numpy.array(function_codes, dtype='<u4')),
+        ('contig_offsets', contig_offsets),
+        ('contig_codes', numpy.array(contig_codes, dtype='<u4'))
+    ]
+
+    buffer_layout = {}
+    byte_offset = 0
+    with open(binary_file_path, 'wb') as f:
+        for (name, arr) in buffers:
+            buffer_layout[name] = {
+                'type' : 'Int32' if arr.dtype == numpy.dtype('<i4') else 'Uint32',
+                'offset' : byte_offset,
+                'length' : len(arr)
+            }
+            f.write(arr.tobytes())
+            byte_offset += arr.nbytes
+
+    manifest = {
+        'version' : PAYLOAD_VERSION,
+        'binary' : os.path.basename(binary_file_path),
+        'count' : total_figs,
+        'figfams' : list(all_protein_data),
+        'dictionaries' : dictionaries,
+        'buffers' : buffer_layout
+    }
+
+    with open(manifest_file_path, 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+
+# reads the files write_compact_proteins wrote back into the shape of proteins.json, without feature ids,
+#  as load_compact_proteins in js/main.js does
+def read_compact_proteins(manifest_file_path):
+
+    with open(manifest_file_path, 'r') as f:
+        manifest = json.load(f)
+    binary_file_path = os.path.join(os.path.dirname(manifest_file_path), manifest['binary'])
+
+    buffers = {}
+    with open(binary_file_path, 'rb') as f:
+        for (name, layout) in manifest['buffers'].items():
+            dtype = '<i4' if layout['type'] == 'Int32' else '<u4'
+            f.seek(layout['offset'])
+            buffers[name] = numpy.fromfile(f, dtype=dtype, count=layout['length']).tolist()
+
+    dictionaries = manifest['dictionaries']
+    all_protein_data = {}
+    for (i, fig) in enumerate(manifest['figfams']):
+        data = {
+            'functions' : [dictionaries['function'][c] for c in buffers['function_codes'][buffers['function_offsets'][i]:buffers['function_offsets'][i + 1]]],
+            'contig_ids' : [dictionaries['contig'][c] for c in buffers['contig_codes'][buffers['contig_offsets'][i]:buffers['contig_offsets'][i + 1]]]
+        }
+        for level in HIERARCHY_LEVELS:
+            code = buffers[level][i]
+            if code >= 0:
+                data[level] = dictionaries[level][code]
+        all_protein_data[fig] = data
+
+    return all_protein_data
@@ -0,0 +1,192 @@
+import os
+import json
+import argparse
+import functools
+import posixpath
+import socketserver
+import http.server
+import urllib.parse
+import numpy
+
+# our utils
+import util
+import compact_payload
+
+# serves the js visualization together with a windowed query api over the output of collate_data.py,
+#  so the browser only ever holds the window of proteins it shows instead of all of proteins.json.
+#
+#  GET /api/filters                              - all categories, subcategories, subsystems and roles
+#  GET /api/proteins?filters=...&start=..&end=.. - the proteins from start to end (sorted by figfam) of
+#                                                  those matching all filters, filters is a json object
+#                                                  of filter type -> list of values, ie.
+#                                                  {"category": ["Virulence"], "contig_id": ["1234"]}
+#  GET /data/...                                 - files in the data directory
+#  GET /...                                      - files of the visualization
+
+FILTER_TYPES = ['category', 'subcategory', 'subsystem', 'role', 'contig_id']
+
+parser = argparse.ArgumentParser(description='Serves the js visualization and a windowed, filtered query api over the output of collate_data.py.')
+parser.add_argument(
+    '--data-dir', metavar='data_dir', type=str, default=os.path.join(os.getcwd(), 'output'),
+    help='the directory with the proteins.json (or the compact proteins.manifest.json) from collate_data.py in it (defaults to output)'
+)
+parser.add_argument(
+    '--port', metavar='port', type=int, default=8000,
+    help='port to listen on (defaults to 8000)'
+)
+parser.add_argument(
+    '--host', metavar='host', type=str, default='127.0.0.1',
+    help='address to listen on (defaults to 127.0.0.1)'
+)
+parser.add_argument(
+    '--cache-size', metavar='cache_size', type=int, default=128,
+    help='number of recent filter results to keep (defaults to 128)'
+)
+
+# prefers the compact payload if collate_data.py wrote one, else proteins.json, compressed or not, as the
+#  visualization does
+def load_proteins(data_dir):
+    manifest_file_path = os.path.join(data_dir, 'proteins.manifest.json')
+    json_file_paths = [os.path.join(data_dir, 'proteins.json' + ext) for ext in [''] + list(util.COMPRESSED_EXTENSIONS)]
+    if os.path.exists(manifest_file_path):
+        protein_data = compact_payload.read_compact_proteins(manifest_file_path)
+    else:
+        existing = [path for path in json_file_paths if os.path.exists(path)]
+        if len(existing) == 0:
+            raise Exception("no proteins.manifest.json or proteins.json in %s, run collate_data.py first" % data_dir)
+        with util.open_text(existing[0]) as f:
+            protein_data = json.load(f)
+    # same order as the visualization, sorted by figfam
+    proteins = []
+    for fig in sorted(protein_data):
+        entry = protein_data[fig]
+        entry['fig'] = fig
+        proteins.append(entry)
+    return proteins
+
+# filter type -> value -> sorted positions of the proteins with that value
+def build_indexes(proteins):
+    indexes = {filter_type : {} for filter_type in FILTER_TYPES}
+    for (i, entry) in enumerate(proteins):
+        for level in ['category', 'subcategory', 'subsystem', 'role']:
+            if isinstance(entry.get(level), str):
+                indexes[level].setdefault(entry[level], []).append(i)
+        for contig_id in dict.fromkeys(entry['contig_ids']):
+            indexes['contig_id'].setdefault(contig_id, []).append(i)
+    for filter_type in indexes:
+        for (value, positions) in indexes[filter_type].items():
+            indexes[filter_type][value] = numpy.array(positions, dtype=numpy.int64)
+    return indexes
+
+# raises ValueError (answered with a 400) for anything but a json object of filter type to list of strings
+def parse_filters(filters_json):
+    filters = json.loads(filters_json) if filters_json else {}
+    if not isinstance(filters, dict):
+        raise ValueError("expected filters to be a json object of filter type to list of values")
+    parsed_filters = []
+    for (filter_type, values) in filters.items():
+        if filter_type not in FILTER_TYPES:
+            raise ValueError("unknown filter type: %s, expected one of: %s" % (filter_type, ", ".join(FILTER_TYPES)))
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            raise ValueError("expected the values of filter %s to be a list of strings" % filter_type)
+        parsed_filters += [(filter_type, v) for v in values]
+    # canonical form, so the same filters in any order share a cache entry
+    return tuple(sorted(set(parsed_filters)))
+
+def create_query(proteins, indexes, cache_size):
+
+    all_positions = numpy.arange(len(proteins), dtype=numpy.int64)
+
+    # a protein has to match every filter, as in the visualization
+    @functools.lru_cache(maxsize=cache_size)
+    def matching_positions(filters):
+        if len(filters) == 0:
+            return all_positions
+        matches = [indexes[filter_type].get(value, all_positions[:0]) for (filter_type, value) in filters]
+        matches.sort(key=len)
+        result = matches[0]
+        for positions in matches[1:]:
+            if len(result) == 0:
+                break
+            result = numpy.intersect1d(result, positions, assume_unique=True)
+        return result
+
+    def query(filters, start, end):
+        positions = matching_positions(filters)
+        window = positions[max(0, start):max(0, end)]
+        return {
+            'total' : len(proteins),
+            'filtered' : len(positions),
+            'start' : start,
+            'end' : end,
+            'proteins' : [proteins[i] for i in window.tolist()]
+        }
+
+    return query, matching_positions
+
+class DataServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class DataRequestHandler(http.server.SimpleHTTPRequestHandler):
+
+    # set up before the server starts
+    static_dir = None
+    data_dir = None
+    query = None
+    filter_values = None
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == '/api/filters':
+            self.send_json(200, self.filter_values)
+        elif url.path == '/api/proteins':
+            params = urllib.parse.parse_qs(url.query)
+            try:
+                filters = parse_filters(params.get('filters', [''])[0])
+                start = int(params.get('start', ['0'])[0])
+                end = int(params.get('end', ['100'])[0])
+            except ValueError as e:
+                self.send_json(400, {'error' : str(e)})
+                return
+            self.send_json(200, self.query(filters, start, end))
+        else:
+            super().do_GET()
+
+    # /data/ is served from the data directory, everything else from the visualization
+    def translate_path(self, path):
+        path = posixpath.normpath(urllib.parse.unquote(urllib.parse.urlparse(path).path))
+        parts = [p for p in path.split('/') if p not in ('', '.', '..')]
+        if len(parts) > 0 and parts[0] == 'data':
+            return os.path.join(self.data_dir, *parts[1:])
+        return os.path.join(self.static_dir, *parts)
+
+    def log_message(self, format, *args):
+        print("[data_server] %s - %s" % (self.address_string(), format % args))
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    proteins = load_proteins(args.data_dir)
+    indexes = build_indexes(proteins)
+    (query, matching_positions) = create_query(proteins, indexes, args.cache_size)
+    print("[data_server] loaded %d proteins from: %s" % (len(proteins), args.data_dir))
+
+    DataRequestHandler.static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'js')
+    DataRequestHandler.data_dir = os.path.abspath(args.data_dir)
+    DataRequestHandler.query = staticmethod(query)
+    DataRequestHandler.filter_values = {
+        level : sorted(indexes[level]) for level in ['category', 'subcategory', 'subsystem', 'role']
+    }
+
+    server = DataServer((args.host, args.port), DataRequestHandler)
+    print("[data_server] serving on http://%s:%d/?server" % (args.host, args.port))
+    server.serve_forever()
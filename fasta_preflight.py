@@ -0,0 +1,259 @@
+import os
+import csv
+import mmap
+import hashlib
+import argparse
+import datetime
+import multiprocessing
+
+# our utils
+import util
+import rast_cli
+
+# pre-flight checks of fasta files before they are submitted to RAST, so empty, truncated or duplicate
+#  assemblies are caught before a job is started for them rather than when it fails hours later.
+#
+#  every file is scanned through a memory map (in worker processes when asked to) for its number of
+#  contigs, total length, N50, GC content, number of ambiguous (N and other IUPAC codes) and invalid
+#  characters, and a hash of its sequences. the sequence hash ignores headers, line wrapping and case,
+#  so the same assembly written out again is still caught as a duplicate of the one submitted before.
+#
+#  the stats of every file scanned are written to output/fasta_stats.csv next to submitted_jobs.csv,
+#  they are read back on the next run to know the hashes of assemblies submitted before.
+
+STATS_FIELDS = [
+    'file_name', 'contigs', 'total_length', 'n50', 'gc_content', 'ambiguous_characters',
+    'invalid_characters', 'empty_contigs', 'sequence_sha1', 'status', 'reasons'
+]
+
+NUCLEOTIDES = b'ACGT'
+AMBIGUOUS = b'NRYKMSWBDHV'
+WHITESPACE = b' \t\r\n'
+TO_UPPER = bytes.maketrans(b'acgtnrykmswbdhvu', b'ACGTNRYKMSWBDHVU')
+
+def default_thresholds():
+    return {
+        'min_total_length' : 100000,
+        'max_contigs' : 10000,
+        'min_n50' : 0,
+        'max_ambiguous_fraction' : 0.05,
+        'max_invalid_characters' : 0
+    }
+
+def n50(lengths):
+    half = sum(lengths) / 2.0
+    total = 0
+    for length in sorted(lengths, reverse=True):
+        total += length
+        if total >= half:
+            return length
+    return 0
+
+def scan_fasta(file_name):
+
+    lengths = []
+    gc = 0
+    acgt = 0
+    ambiguous = 0
+    invalid = 0
+    leading_garbage = False
+    sequence_hash = hashlib.sha1()
+
+    with open(file_name, 'rb') as f:
+        # an empty file can not be memory mapped
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else b''
+
+    try:
+        size = len(buf)
+        pos = 0
+        # anything but whitespace before the first header is not fasta
+        first_header = buf.find(b'>')
+        if first_header == -1 or len(buf[0:first_header].translate(None, WHITESPACE)) > 0:
+            leading_garbage = size > 0
+            first_header = size if first_header == -1 else first_header
+        pos = first_header
+
+        while pos < size:
+            header_end = buf.find(b'\n', pos)
+            if header_end == -1:
+                header_end = size
+            next_header = buf.find(b'\n>', header_end)
+            sequence_end = size if next_header == -1 else next_header + 1
+            sequence = buf[header_end:sequence_end].translate(TO_UPPER, WHITESPACE)
+            lengths.append(len(sequence))
+            sequence_hash.update(sequence)
+            sequence_hash.update(b'\n')
+            contig_gc = sequence.count(b'G') + sequence.count(b'C')
+            gc += contig_gc
+            acgt += contig_gc + sequence.count(b'A') + sequence.count(b'T')
+            remaining = sequence.translate(None, NUCLEOTIDES + AMBIGUOUS + b'U')
+            invalid += len(remaining)
+            ambiguous += len(sequence) - len(sequence.translate(None, AMBIGUOUS))
+            pos = sequence_end
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+    return {
+        'file_name' : file_name,
+        'contigs' : len(lengths),
+        'total_length' : sum(lengths),
+        'n50' : n50(lengths),
+        # over the unambiguous bases only
+        'gc_content' : gc / float(acgt) if acgt > 0 else 0.0,
+        'ambiguous_characters' : ambiguous,
+        'invalid_characters' : invalid,
+        'empty_contigs' : sum(1 for length in lengths if length == 0),
+        'leading_garbage' : leading_garbage,
+        'sequence_sha1' : sequence_hash.hexdigest() if len(lengths) > 0 else ''
+    }
+
+def scan_fasta_files(file_names, jobs=1):
+    if jobs <= 1 or len(file_names) <= 1:
+        return [scan_fasta(f) for f in file_names]
+    with multiprocessing.Pool(processes=min(jobs, len(file_names))) as pool:
+        return pool.map(scan_fasta, file_names, chunksize=max(1, len(file_names) // (jobs * 4)))
+
+# reasons a scanned file should not be submitted, empty if none
+def check_thresholds(stats, thresholds):
+    reasons = []
+    if stats['contigs'] == 0:
+        reasons.append('no contigs')
+    if stats['leading_garbage']:
+        reasons.append('data before the first header')
+    if stats['empty_contigs'] > 0:
+        reasons.append('%d empty contigs' % stats['empty_contigs'])
+    if stats['total_length'] < thresholds['min_total_length']:
+        reasons.append('total length %d below %d' % (stats['total_length'], thresholds['min_total_length']))
+    if stats['contigs'] > thresholds['max_contigs']:
+        reasons.append('%d contigs above %d' % (stats['contigs'], thresholds['max_contigs']))
+    if stats['n50'] < thresholds['min_n50']:
+        reasons.append('N50 %d below %d' % (stats['n50'], thresholds['min_n50']))
+    if stats['total_length'] > 0 and stats['ambiguous_characters'] / float(stats['total_length']) > thresholds['max_ambiguous_fraction']:
+        reasons.append('%d ambiguous characters above %.2f of total length' % (stats['ambiguous_characters'], thresholds['max_ambiguous_fraction']))
+    if stats['invalid_characters'] > thresholds['max_invalid_characters']:
+        reasons.append('%d invalid characters' % stats['invalid_characters'])
+    return reasons
+
+def read_stats(stats_path):
+    if not os.path.exists(stats_path):
+        return {}
+    with open(stats_path, 'r') as csvfile:
+        return {row['file_name'] : row for row in csv.DictReader(csvfile)}
+
+def write_stats(stats_path, rows):
+    with open(stats_path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=STATS_FIELDS, dialect="excel", extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+# scans the fasta files (names relative to directory) and returns the ones which may be submitted, files
+#  already in the journal are always let through. rejected files are those failing a threshold or with
+#  the same sequences as a file submitted before or earlier in file_names
+def preflight(directory, file_names, journal_path, stats_path, thresholds, jobs=1):
+
+    already_submitted = rast_cli.read_journal(journal_path)
+    previous_stats = read_stats(stats_path)
+
+    scanned = scan_fasta_files([os.path.join(directory, f) for f in file_names], jobs=jobs)
+    for (stats, file_name) in zip(scanned, file_names):
+        stats['file_name'] = file_name
+
+    # hashes of everything submitted so far, including files no longer in the directory
+    submitted_hashes = {}
+    for (file_name, row) in previous_stats.items():
+        if file_name in already_submitted and row['sequence_sha1'] != '':
+            submitted_hashes.setdefault(row['sequence_sha1'], file_name)
+    for stats in scanned:
+        if stats['file_name'] in already_submitted and stats['sequence_sha1'] != '':
+            submitted_hashes[stats['sequence_sha1']] = stats['file_name']
+
+    accepted = []
+    rows = {file_name : row for (file_name, row) in previous_stats.items() if file_name not in file_names}
+    for stats in sorted(scanned, key=lambda s: s['file_name']):
+        file_name = stats['file_name']
+        if file_name in already_submitted:
+            stats['status'] = 'submitted'
+            stats['reasons'] = ''
+            accepted.append(file_name)
+        else:
+            reasons = check_thresholds(stats, thresholds)
+            duplicate_of = submitted_hashes.get(stats['sequence_sha1'])
+            if duplicate_of is not None:
+                reasons.append('same sequences as %s' % duplicate_of)
+            stats['status'] = 'rejected' if len(reasons) > 0 else 'accepted'
+            stats['reasons'] = '; '.join(reasons)
+            if len(reasons) == 0:
+                accepted.append(file_name)
+                # later files with the same sequences are duplicates of this one
+                submitted_hashes[stats['sequence_sha1']] = file_name
+            else:
+                print("[preflight] rejected %s: %s" % (file_name, stats['reasons']))
+        stats['gc_content'] = '%.4f' % stats['gc_content']
+        rows[file_name] = stats
+
+    write_stats(stats_path, [rows[f] for f in sorted(rows)])
+    print("[preflight] scanned %d fasta files, %d rejected, wrote stats to: %s" % (len(scanned), len(scanned) - len(accepted), stats_path))
+
+    # in the order they were given
+    accepted = set(accepted)
+    return [f for f in file_names if f in accepted]
+
+def add_preflight_arguments(parser):
+    defaults = default_thresholds()
+    parser.add_argument(
+        '--min-total-length', metavar='min_total_length', type=int, default=defaults['min_total_length'],
+        help='reject assemblies shorter than this in total (defaults to %d)' % defaults['min_total_length']
+    )
+    parser.add_argument(
+        '--max-contigs', metavar='max_contigs', type=int, default=defaults['max_contigs'],
+        help='reject assemblies with more contigs than this (defaults to %d)' % defaults['max_contigs']
+    )
+    parser.add_argument(
+        '--min-n50', metavar='min_n50', type=int, default=defaults['min_n50'],
+        help='reject assemblies with a lower N50 than this (defaults to %d)' % defaults['min_n50']
+    )
+    parser.add_argument(
+        '--max-ambiguous-fraction', metavar='max_ambiguous_fraction', type=float, default=defaults['max_ambiguous_fraction'],
+        help='reject assemblies with a larger fraction of N and other ambiguous bases than this (defaults to %.2f)' % defaults['max_ambiguous_fraction']
+    )
+    parser.add_argument(
+        '--max-invalid-characters', metavar='max_invalid_characters', type=int, default=defaults['max_invalid_characters'],
+        help='reject assemblies with more characters that are not nucleotide codes than this (defaults to %d)' % defaults['max_invalid_characters']
+    )
+    parser.add_argument(
+        '--preflight-jobs', metavar='preflight_jobs', type=int, default=1,
+        help='number of worker processes to scan the fasta files with (defaults to 1, no worker processes)'
+    )
+
+def thresholds_from_args(args):
+    return {
+        'min_total_length' : args.min_total_length,
+        'max_contigs' : args.max_contigs,
+        'min_n50' : args.min_n50,
+        'max_ambiguous_fraction' : args.max_ambiguous_fraction,
+        'max_invalid_characters' : args.max_invalid_characters
+    }
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Scans a directory of fasta files and writes their stats, marking which would be rejected before submission to RAST.')
+    parser.add_argument(
+        'directory', type=str, default=os.getcwd(), nargs="?",
+        help='the directory with the fasta (.fa) files in it (defaults to current directory)'
+    )
+    add_preflight_arguments(parser)
+
+    args = parser.parse_args()
+    cur_dir = os.getcwd()
+    util.create_output_directory_if_not_exists(cur_dir)
+
+    fasta_files = sorted(util.get_files_in_folder_with_ext(".fa", args.directory))
+    print("[preflight] got %d fasta files to scan at %s" % (len(fasta_files), datetime.datetime.now()))
+    accepted = preflight(
+        args.directory, fasta_files,
+        os.path.join(cur_dir, 'output/submitted_jobs.csv'), os.path.join(cur_dir, 'output/fasta_stats.csv'),
+        thresholds_from_args(args), jobs=args.preflight_jobs
+    )
+    print("[preflight] %d of %d fasta files can be submitted" % (len(accepted), len(fasta_files)))
@@ -1,18 +1,12 @@
 import os
-import csv
 import datetime
-import subprocess
 import argparse
-import shutil
-import re
+import concurrent.futures
 
 # our utils
 import util
-
-path_to_submit_fasta_cmd = shutil.which("svr_submit_RAST_job")
-submit_fasta_job_cmd = " --domain Bacteria --user %s --passwd %s --fasta %s"
-absolute_cmd_path = path_to_submit_fasta_cmd + submit_fasta_job_cmd
-fasta_job_output_regex = re.compile(r"'(\d+)'")
+import rast_cli
+import fasta_preflight
 
 parser = argparse.ArgumentParser(description='Batch upload a directory of fasta files.')
 parser.add_argument(
@@ -27,44 +21,76 @@ parser.add_argument(
     'directory', type=str, default=os.getcwd(), nargs="?",
     help='the directory with the fasta (.fa) files in it to upload'
 )
+parser.add_argument(
+    '--workers', metavar='workers', type=int, default=4,
+    help='number of submissions to run at once (defaults to 4)'
+)
+parser.add_argument(
+    '--retries', metavar='retries', type=int, default=3,
+    help='number of times to retry a failed submission (defaults to 3)'
+)
+parser.add_argument(
+    '--backoff', metavar='backoff', type=float, default=5.0,
+    help='seconds to wait before the first retry, doubled for every retry after (defaults to 5)'
+)
+parser.add_argument(
+    '--submit-cmd', metavar='submit_cmd', type=str, default="svr_submit_RAST_job",
+    help='path to svr_submit_RAST_job (defaults to the one on PATH)'
+)
+parser.add_argument(
+    '--skip-preflight', default=False, action='store_true',
+    help='submit every fasta file without scanning it first (see fasta_preflight.py)'
+)
+fasta_preflight.add_preflight_arguments(parser)
 
-def write_job_id_to_file(job_id, file_name, success):
-    output_filename = 'output/submitted_jobs.csv'
-    if not os.path.exists(output_filename):
-        print("[batch] writing id: %s to new file: %s" % (job_id, output_filename))
-        with open(output_filename, 'w') as csvfile:
-            our_writer = csv.writer(csvfile)
-            our_writer.writerow(['job_id', 'file_name', 'success'])
-            our_writer.writerow([job_id, file_name, success])
-    else:
-        print("[batch] writing id: %s to existing file: %s" % (job_id, output_filename))
-        with open(output_filename, 'a') as csvfile:
-            our_writer = csv.writer(csvfile)
-            our_writer.writerow([job_id, file_name, success])
-
-def submit_fasta_files_in_dir(username, password, directory):
+def submit_fasta_files_in_dir(args, journal_path):
     os.chdir(args.directory)
     all_job_paths = util.get_files_in_folder_with_ext(".fa")
-    total_jobs_in_folder = len(all_job_paths)
-    print("[batch] total jobs to submit: %d at: %s" % (total_jobs_in_folder, datetime.datetime.now()))
+    already_submitted = rast_cli.read_journal(journal_path)
+    job_paths = [entry for entry in all_job_paths if entry not in already_submitted]
+    # empty, truncated and duplicate assemblies are rejected before any job is started for them
+    if not args.skip_preflight:
+        stats_path = os.path.join(os.path.dirname(journal_path), 'fasta_stats.csv')
+        accepted = set(fasta_preflight.preflight(
+            os.getcwd(), all_job_paths, journal_path, stats_path, fasta_preflight.thresholds_from_args(args), jobs=args.preflight_jobs
+        ))
+        job_paths = [entry for entry in job_paths if entry in accepted]
+    total_already_submitted = sum(1 for entry in all_job_paths if entry in already_submitted)
+    print("[batch] total jobs to submit: %d at: %s (%d already submitted, %d rejected)" \
+          % (len(job_paths), datetime.datetime.now(), total_already_submitted, len(all_job_paths) - total_already_submitted - len(job_paths)))
     total_successful_jobs = 0
     total_failed_jobs = 0
-    for entry in all_job_paths:
-        try:
-            print("[batch] trying to submit: %s at %s" % (entry, datetime.datetime.now()))
-            output = subprocess.getoutput(absolute_cmd_path % (args.username, args.password, entry))
-            our_match = fasta_job_output_regex.search(output)
-            submitted_job_id = our_match.group(1)
-            write_job_id_to_file(submitted_job_id, entry, success = True)
-            total_successful_jobs += 1
-        except:
-            total_failed_jobs += 1
-            print("[batch] failed to submit: %s at %s" % (entry, datetime.datetime.now()))
-            write_job_id_to_file(-1, entry, success = False)
+    (journal_file, journal_writer) = rast_cli.open_journal(journal_path)
+    with journal_file, concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(rast_cli.submit_with_retries, args.submit_cmd, args.username, args.password, entry, args.retries, args.backoff) : entry
+            for entry in job_paths
+        }
+        # only this thread writes to the journal, in the order submissions finish
+        for future in concurrent.futures.as_completed(futures):
+            entry = futures[future]
+            try:
+                submitted_job_id = future.result()
+                rast_cli.write_job_id_to_journal(journal_file, journal_writer, submitted_job_id, entry, success = True)
+                total_successful_jobs += 1
+            except Exception as e:
+                total_failed_jobs += 1
+                print("[batch] failed to submit: %s at %s (%s)" % (entry, datetime.datetime.now(), e))
+                rast_cli.write_job_id_to_journal(journal_file, journal_writer, -1, entry, success = False)
     print("[batch] total successful jobs: %d" % total_successful_jobs)
     print("[batch] total failed jobs: %d" % total_failed_jobs)
     print("[batch] finished at %s" % datetime.datetime.now())
 
-args = parser.parse_args()
-util.create_output_directory_if_not_exists()
-submit_fasta_files_in_dir(args.username, args.password, args.directory)
+# the pre-flight worker processes import this module again, so only the command line runs anything
+def main():
+
+    args = parser.parse_args()
+    # we change directory to the fasta files later, so resolve it first
+    args.submit_cmd = rast_cli.resolve_cmd(args.submit_cmd, "svr_submit_RAST_job", "--submit-cmd")
+
+    cur_dir = os.getcwd()
+    util.create_output_directory_if_not_exists(cur_dir)
+    submit_fasta_files_in_dir(args, os.path.join(cur_dir, 'output/submitted_jobs.csv'))
+
+if __name__ == '__main__':
+    main()
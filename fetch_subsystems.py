@@ -1,54 +1,11 @@
 import os
-import csv
-import requests
 import datetime
 import argparse
-import webbrowser
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
-from selenium.webdriver.support import expected_conditions as EC
-from bs4 import BeautifulSoup
+import concurrent.futures
 
 # our utils
 import util
-
-base_url = "https://rast.nmpdr.org/"
-login_url = "https://rast.nmpdr.org/rast.cgi"
-download_url = "https://rast.nmpdr.org/download.cgi"
-job_page_url = "https://rast.nmpdr.org/rast.cgi?page=JobDetails&job=%s"
-
-login_headers = {
-    'User-Agent': 'Mozilla/5.0'
-}
-
-def login_to_rast_selenium(driver, username, password):
-    driver.get(login_url)
-    userfield = driver.find_element_by_name("login")
-    passfield = driver.find_element_by_name("password")
-    submit = driver.find_element_by_xpath("//input[@title='Click here to login!']")
-    userfield.send_keys(username)
-    passfield.send_keys(password)
-    submit.click()
-
-def extract_genome_url_for_job_id(driver, job_id):
-    driver.get(job_page_url % job_id)
-    soup = BeautifulSoup(driver.page_source, "lxml")
-    e = soup.find('a', string="Browse annotated genome in SEED Viewer")
-    return base_url + "/" + e['href']
-
-def extract_subsystem_data(driver, url):
-    driver.get(url) # first go to the right page
-    are_we_ready = False
-    while not are_we_ready:
-        tab_button = driver.find_element_by_xpath("//td[text()='Features in Subsystems']")
-        tab_button.click()
-        export_button = driver.find_element_by_xpath("//input[@value='export to file']")
-        if export_button.is_displayed():
-            are_we_ready = True
-    export_button.click()
+import rast_web
 
 parser = argparse.ArgumentParser(description='Fetches all feature subsystem data for a given job.')
 parser.add_argument(
@@ -65,32 +22,42 @@ parser.add_argument(
 )
 parser.add_argument(
     '--output-dir', metavar='output_dir', type=str, default=os.getcwd(),
-    help='csv with submitted jobs'
+    help='directory to write the subsystem tables to (defaults to current directory)'
+)
+parser.add_argument(
+    '--concurrency', metavar='concurrency', type=int, default=8,
+    help='number of jobs to fetch at once (defaults to 8)'
+)
+parser.add_argument(
+    '--retries', metavar='retries', type=int, default=3,
+    help='number of times to retry a request which failed with a server error (defaults to 3)'
+)
+parser.add_argument(
+    '--base-url', metavar='base_url', type=str, default=rast_web.default_base_url,
+    help='base url of the RAST server (defaults to %s)' % rast_web.default_base_url
 )
 
 args = parser.parse_args()
 
-# else we'll be loading forever due to google analytics shite
-capabilities = DesiredCapabilities().FIREFOX
-capabilities["pageLoadStrategy"] = "eager"
-
-# save file shite
-profile = webdriver.FirefoxProfile()
-profile.set_preference("browser.download.dir", args.output_dir);
-profile.set_preference("browser.download.folderList", 2);
-profile.set_preference("browser.helperApps.neverAsk.saveToDisk", "application/x-download")
-profile.set_preference("browser.download.manager.showWhenStarting", False)
-profile.set_preference("browser.download.panel.shown", False)
-
-driver = webdriver.Firefox(desired_capabilities=capabilities, firefox_profile=profile)
-login_to_rast_selenium(driver, args.username, args.password)
+session = rast_web.create_session(args.concurrency, args.retries)
+rast_web.login_to_rast(session, args.base_url, args.username, args.password)
 
 all_job_ids = util.collect_job_ids_from_csv(args.filename)
 print("[fetch_subsystems] got %d job ids to fetch" % len(all_job_ids))
 
-for i, job_id in enumerate(all_job_ids):
-    genome_url = extract_genome_url_for_job_id(driver, job_id)
-    extract_subsystem_data(driver, genome_url)
-    print("[fetch_subsystems] downloaded table for %d of %d" % (i + 1, len(all_job_ids)))
-
-driver.quit()
+total_fetched = 0
+total_failed = 0
+with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+    futures = {executor.submit(rast_web.fetch_subsystems_for_job, session, args.base_url, job_id, args.output_dir) : job_id for job_id in all_job_ids}
+    for future in concurrent.futures.as_completed(futures):
+        job_id = futures[future]
+        try:
+            output_path = future.result()
+            total_fetched += 1
+            print("[fetch_subsystems] downloaded table for job %s to %s (%d of %d)" % (job_id, output_path, total_fetched, len(all_job_ids)))
+        except Exception as e:
+            total_failed += 1
+            print("[fetch_subsystems] failed to fetch table for job %s: %s" % (job_id, e))
+
+print("[fetch_subsystems] fetched %d tables, %d failed at %s" % (total_fetched, total_failed, datetime.datetime.now()))
+session.close()
@@ -0,0 +1,115 @@
+import csv
+import multiprocessing
+
+# our utils
+import util
+import protein_registry
+
+# parsing of RAST classification csv files, each file is parsed into a partial result on its own
+#  so files can be parsed in worker processes, partial results are then merged in file order
+
+# bump when which rows are kept or how they are read changes, cached parses (see parse_cache.py) made
+#  by another version are parsed again
+PARSER_VERSION = 1
+
+# contig id may look like 58282 but also 28582_5929_etc
+def get_leading_id(s):
+    return s.split("_", 1)[0]
+
+def has_valid_figfam_id(p):
+    return 'figfam' in p and not p['figfam'].isspace() and not p['figfam'] == ""
+
+def is_hypothetical_protein(p):
+    return 'hypothetical' in p['function']
+
+def parse_genome_csv(file_name):
+
+    proteins = set() # to automatically eliminate duplicates
+    protein_data = protein_registry.ProteinRegistry()
+    total_entries = 0
+    skipped_entries = 0
+    skipped_entries_with_figs = 0
+    have_fetched_contig_id = False
+    contig_id = -1
+
+    # .csv.gz and .csv.xz files are decompressed while they are read
+    with util.open_text(file_name) as csvfile:
+
+        reader = csv.DictReader(csvfile)
+
+        for row in reader:
+
+            # keep track of total number of entries
+            total_entries += 1
+            if not have_fetched_contig_id:
+                have_fetched_contig_id = True
+                contig_id = get_leading_id(row['contig_id'])
+
+            # we only care about the row if it has a figfam entry, and it is nonempty
+            if has_valid_figfam_id(row):
+
+                if is_hypothetical_protein(row):
+                    skipped_entries_with_figs += 1
+                    continue
+
+                fig = row['figfam']
+                proteins.add(fig)
+                # registry of proteins in set
+                protein_data.add(fig, row['function'], contig_id, (row['feature_id'],))
+            else:
+                skipped_entries += 1
+
+    return {
+        'file_name' : file_name,
+        'contig_id' : contig_id,
+        'proteins' : proteins,
+        'protein_data' : protein_data,
+        'total_entries' : total_entries,
+        'skipped_entries' : skipped_entries,
+        'skipped_entries_with_figs' : skipped_entries_with_figs
+    }
+
+def parse_genome_csvs(file_names, jobs=1):
+    if jobs <= 1 or len(file_names) <= 1:
+        return [parse_genome_csv(f) for f in file_names]
+    with multiprocessing.Pool(processes=min(jobs, len(file_names))) as pool:
+        # map keeps the order of the input files, so the merge below stays deterministic
+        return pool.map(parse_genome_csv, file_names, chunksize=max(1, len(file_names) // (jobs * 4)))
+
+# all proteins go into one protein_registry.ProteinRegistry, the 'protein_data' of each result is
+#  taken out of it on the way
+def merge_genome_results(results):
+
+    merged = {
+        'all_genome_ids' : {},
+        'all_protein_data' : protein_registry.ProteinRegistry(),
+        'data_files' : [],
+        'total_entries' : 0,
+        'skipped_entries' : 0,
+        'skipped_entries_with_figs' : 0
+    }
+
+    all_genome_ids = merged['all_genome_ids']
+    all_protein_data = merged['all_protein_data']
+
+    for result in results:
+
+        entry = result['file_name']
+        contig_id = result['contig_id']
+
+        merged['total_entries'] += result['total_entries']
+        merged['skipped_entries'] += result['skipped_entries']
+        merged['skipped_entries_with_figs'] += result['skipped_entries_with_figs']
+
+        # the per file registries are dropped once they are in the merged one, so they are never all
+        #  alive next to it
+        all_protein_data.extend(result.pop('protein_data'))
+
+        if contig_id in all_genome_ids:
+            prev_file_name = all_genome_ids[contig_id]['file_name']
+            raise Exception("found duplicate id: %s in %s, previously encountered in file: %s" % (contig_id, entry, prev_file_name))
+        else:
+            all_genome_ids[contig_id] = {'file_name' : entry}
+            merged['data_files'].append({'file_name' : entry, 'contig_id' : contig_id, 'proteins' : result['proteins']})
+
+    return merged
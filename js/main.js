@@ -27,6 +27,88 @@ document.addEventListener("DOMContentLoaded", function(event) {
         colours : d3.map()
     };
 
+    /* decodes the compact output of collate_data.py (--output-format compact) into the same shape as proteins.json,
+     * a json manifest with the string dictionaries and a binary sidecar of little endian 32 bit code arrays */
+    function load_compact_proteins(manifest_url) {
+
+        return d3.json(manifest_url).then(function(manifest) {
+
+            let binary_url = manifest_url.substring(0, manifest_url.lastIndexOf("/") + 1) + manifest.binary;
+
+            return fetch(binary_url).then(function(response) {
+                if (!response.ok) throw new Error("could not load: " + binary_url);
+                return response.arrayBuffer();
+            }).then(function(buffer) {
+
+                let views = {};
+                for (let name in manifest.buffers) {
+                    let layout = manifest.buffers[name];
+                    let array_type = (layout.type === "Int32") ? Int32Array : Uint32Array;
+                    views[name] = new array_type(buffer, layout.offset, layout.length);
+                }
+
+                let dicts = manifest.dictionaries;
+                let levels = ["category", "subcategory", "subsystem", "role"];
+                let data = {};
+
+                for (let i = 0; i < manifest.count; ++i) {
+
+                    let entry = {
+                        functions: Array.from(views.function_codes.subarray(views.function_offsets[i], views.function_offsets[i + 1]), c => dicts.function[c]),
+                        contig_ids: Array.from(views.contig_codes.subarray(views.contig_offsets[i], views.contig_offsets[i + 1]), c => dicts.contig[c])
+                    };
+
+                    levels.forEach(function(level) {
+                        let code = views[level][i];
+                        if (code >= 0) entry[level] = dicts[level][code];
+                    });
+
+                    data[manifest.figfams[i]] = entry;
+
+                }
+
+                return data;
+
+            });
+
+        });
+
+    }
+
+    /* prefer the compact payload if collate_data.py wrote one, else the plain json */
+    function load_protein_data() {
+        return load_compact_proteins("data/proteins.manifest.json").catch(function(error) {
+            return d3.json("data/proteins.json");
+        });
+    }
+
+    /* when served by data_server.py (index.html?server) only the shown window of proteins is fetched,
+     * filtering and windowing happen on the server, the query box still only works on the static files */
+    let data_server_mode = new URLSearchParams(window.location.search).has("server");
+    let data_server_request = 0;
+
+    function fetch_protein_window(start, end) {
+        let filters = {};
+        for (let type in active_filters) {
+            if (!active_filters[type].empty()) {
+                filters[type] = active_filters[type].values();
+            }
+        }
+        let params = new URLSearchParams({filters: JSON.stringify(filters), start: start, end: end});
+        return d3.json("api/proteins?" + params.toString());
+    }
+
+    function load_protein_window() {
+        let offset = +d3.select("#data-range-offset-input").property("value");
+        let start_offset = +d3.select("#data-range-start-input").property("value") + offset;
+        let end_offset = +d3.select("#data-range-end-input").property("value") + offset;
+        return fetch_protein_window(start_offset, end_offset).then(function(result) {
+            let data = {};
+            result.proteins.forEach(p => data[p.fig] = p);
+            return data;
+        });
+    }
+
     function set_of_property(arr, property) {
         return d3.set(arr.flatMap(x => x[property]).filter(x => typeof x === 'string'));
     }
@@ -252,6 +334,18 @@ document.addEventListener("DOMContentLoaded", function(event) {
         let offset = +d3.select("#data-range-offset-input").property("value");
         let start_offset = +d3.select("#data-range-start-input").property("value") + offset;
         let end_offset = +d3.select("#data-range-end-input").property("value") + offset;
+
+        if (data_server_mode) {
+            let request = ++data_server_request;
+            fetch_protein_window(start_offset, end_offset).then(function(result) {
+                /* a newer window was asked for in the meantime */
+                if (request !== data_server_request) return;
+                result.proteins.forEach(p => all_data[p.fig] = p);
+                update_from_data(svg, x, y, result.proteins, all_data);
+                update_ranges(start_offset, end_offset, result.proteins.length, result.filtered);
+            });
+            return end_offset - start_offset;
+        }
         
         let filtered_data = array.filter(function (e) {
 
@@ -454,8 +548,9 @@ document.addEventListener("DOMContentLoaded", function(event) {
     Promise.all([
         d3.json("deps/colours.json"),
         d3.json("data/categories.json"),
-        d3.json("data/proteins.json")
-    ]).then(function([colour_data, category_data, protein_data]) {
+        data_server_mode ? load_protein_window() : load_protein_data(),
+        data_server_mode ? d3.json("api/filters") : null
+    ]).then(function([colour_data, category_data, protein_data, filter_values]) {
 
         let colours = Object.values(colour_data);
         let category_mapping = category_data;
@@ -474,12 +569,13 @@ document.addEventListener("DOMContentLoaded", function(event) {
         let all_data_arr = Object.values(data).sort((a, b) => d3.ascending(a.fig, b.fig));
         let original_array = all_data_arr;
 
-        let sliced_arr = all_data_arr.slice(initial_start_offset + initial_offset, initial_end_offset + initial_offset);
+        /* from the data server we only got the window to begin with, and the filters separately */
+        let sliced_arr = data_server_mode ? all_data_arr : all_data_arr.slice(initial_start_offset + initial_offset, initial_end_offset + initial_offset);
 
-        let categories = set_of_property(all_data_arr, 'category');
-        let subcategories = set_of_property(all_data_arr, 'subcategory');
-        let subsystems = set_of_property(all_data_arr, 'subsystem');
-        let roles = set_of_property(all_data_arr, 'role');
+        let categories = data_server_mode ? d3.set(filter_values.category) : set_of_property(all_data_arr, 'category');
+        let subcategories = data_server_mode ? d3.set(filter_values.subcategory) : set_of_property(all_data_arr, 'subcategory');
+        let subsystems = data_server_mode ? d3.set(filter_values.subsystem) : set_of_property(all_data_arr, 'subsystem');
+        let roles = data_server_mode ? d3.set(filter_values.role) : set_of_property(all_data_arr, 'role');
 
         let [svg, x, y] = create_from_data(sliced_arr, data);
         update_with_filters(svg, x, y, all_data_arr, data); /* HACK */
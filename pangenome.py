@@ -0,0 +1,466 @@
+import os
+import csv
+import sqlite3
+import argparse
+import numpy
+
+# our utils
+import util
+import ingest
+import presence
+import proteins
+import protein_registry
+
+# persistent pan-genome state, lets genomes be added to or removed from an existing analysis
+#  without recomputing everything. the state is an sqlite database, so every update only reads and
+#  writes the rows of the genome in question and of the figfams it has:
+#
+#  genomes         - contig id, the order it was added in, file name and entry/skip counts
+#  genome_figfams  - contig id, figfam, the order the genome was added in, the position of the figfam
+#                    in the genome, function and feature ids (; separated) of the figfam in it
+#  figfams         - figfam, the first genome (by order added) with it and its position in that genome
+#                    (outputs are ordered by these, as proteins.py orders them), the number of genomes
+#                    it is in and the genome owning it when that is one
+#  meta            - the partition thresholds
+#
+#  the index on figfams by number of genomes are the count buckets: the common figfams are the bucket
+#  of all genomes, and the figfams whose partition changes when a genome is added or removed are those
+#  of the genome plus the buckets of the counts whose partition moves with the total.
+#
+#  every add or remove writes what changed (figfams new to or gone from the pan genome, becoming or no
+#  longer common or unique, moving partition) to output/pangenome_delta.csv. the spreadsheets cover the
+#  whole collection, so rewriting them takes time proportional to it, they are only written by build,
+#  write and with --write-outputs.
+
+SCHEMA = """
+CREATE TABLE genomes (contig_id TEXT PRIMARY KEY, seq INTEGER NOT NULL UNIQUE, file_name TEXT, total_entries INTEGER, skipped_entries INTEGER, skipped_entries_with_figs INTEGER);
+CREATE TABLE genome_figfams (contig_id TEXT NOT NULL, figfam TEXT NOT NULL, seq INTEGER NOT NULL, position INTEGER NOT NULL, function TEXT, feature_ids TEXT, PRIMARY KEY (contig_id, figfam)) WITHOUT ROWID;
+CREATE TABLE figfams (figfam TEXT PRIMARY KEY, first_seq INTEGER NOT NULL, first_position INTEGER NOT NULL, genome_count INTEGER NOT NULL, owner TEXT);
+CREATE TABLE meta (key TEXT PRIMARY KEY, value);
+"""
+
+INDEXES = """
+CREATE INDEX genome_figfams_figfam ON genome_figfams (figfam, seq, position);
+CREATE INDEX figfams_count ON figfams (genome_count);
+"""
+
+FEATURE_SEPARATOR = ';'
+DELTA_FIELDS = ['genome', 'change', 'figfam', 'contig_id', 'partition']
+
+def get_meta(conn, key):
+    return conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0]
+
+def set_meta(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+def thresholds(conn):
+    return (get_meta(conn, 'core_threshold'), get_meta(conn, 'soft_core_threshold'), get_meta(conn, 'shell_threshold'))
+
+def total_genomes(conn):
+    return conn.execute("SELECT COUNT(*) FROM genomes").fetchone()[0]
+
+def total_figfams(conn):
+    return conn.execute("SELECT COUNT(*) FROM figfams").fetchone()[0]
+
+# a new empty state at state_file_path, replacing the one there. check_same_thread is passed on to
+#  sqlite3.connect, for callers which use the connection from one thread other than the one opening it
+def create_state(state_file_path, core_threshold=proteins.DEFAULT_CORE_THRESHOLD, soft_core_threshold=proteins.DEFAULT_SOFT_CORE_THRESHOLD, shell_threshold=proteins.DEFAULT_SHELL_THRESHOLD, check_same_thread=True):
+    if os.path.exists(state_file_path):
+        os.remove(state_file_path)
+    conn = sqlite3.connect(state_file_path, check_same_thread=check_same_thread)
+    conn.executescript(SCHEMA + INDEXES)
+    set_meta(conn, 'core_threshold', core_threshold)
+    set_meta(conn, 'soft_core_threshold', soft_core_threshold)
+    set_meta(conn, 'shell_threshold', shell_threshold)
+    conn.commit()
+    return conn
+
+def open_state(state_file_path, check_same_thread=True):
+    if not os.path.exists(state_file_path):
+        raise Exception("no pan-genome state at: %s, build it with: python pangenome.py build" % state_file_path)
+    return sqlite3.connect(state_file_path, check_same_thread=check_same_thread)
+
+def genome_file_names(conn):
+    return set(file_name for (file_name,) in conn.execute("SELECT file_name FROM genomes"))
+
+def insert_genome(conn, result, seq):
+    conn.execute(
+        "INSERT INTO genomes (contig_id, seq, file_name, total_entries, skipped_entries, skipped_entries_with_figs) VALUES (?, ?, ?, ?, ?, ?)",
+        (result['contig_id'], seq, result['file_name'], result['total_entries'], result['skipped_entries'], result['skipped_entries_with_figs'])
+    )
+    registry = result['protein_data']
+    conn.executemany(
+        "INSERT INTO genome_figfams (contig_id, figfam, seq, position, function, feature_ids) VALUES (?, ?, ?, ?, ?, ?)",
+        ((result['contig_id'], fig, seq, i, registry.function_of(i), FEATURE_SEPARATOR.join(registry.feature_ids_of(i))) for (i, fig) in enumerate(registry.figfams))
+    )
+
+def check_new_genome(conn, result):
+    row = conn.execute("SELECT file_name FROM genomes WHERE contig_id = ?", (result['contig_id'],)).fetchone()
+    if row is not None:
+        raise Exception("found duplicate id: %s in %s, previously encountered in file: %s" % (result['contig_id'], result['file_name'], row[0]))
+
+# builds a new state from parsed genomes (see proteins.load_genomes) in bulk, returns the analysis of
+#  proteins.analyse_proteins so the spreadsheets can be written from it as proteins.py would
+def build_state(state_file_path, parsed_files, core_threshold=proteins.DEFAULT_CORE_THRESHOLD, soft_core_threshold=proteins.DEFAULT_SOFT_CORE_THRESHOLD, shell_threshold=proteins.DEFAULT_SHELL_THRESHOLD, metrics=None):
+
+    metrics = metrics if metrics is not None else util.Metrics('pangenome')
+
+    tmp_path = state_file_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        # nothing to recover if the build fails half way, the temporary file is just built again
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.executescript(SCHEMA)
+        set_meta(conn, 'core_threshold', core_threshold)
+        set_meta(conn, 'soft_core_threshold', soft_core_threshold)
+        set_meta(conn, 'shell_threshold', shell_threshold)
+
+        # the genomes have to go in before the analysis, it takes the protein records out of them
+        with metrics.phase('load genomes') as phase:
+            first_seen = {}
+            for (seq, result) in enumerate(parsed_files):
+                check_new_genome(conn, result)
+                insert_genome(conn, result, seq)
+                for (i, fig) in enumerate(result['protein_data'].figfams):
+                    first_seen.setdefault(fig, (seq, i))
+            phase['rows'] = sum(len(result['protein_data']) for result in parsed_files)
+
+        analysis = proteins.analyse_proteins(parsed_files, core_threshold, soft_core_threshold, shell_threshold, metrics=metrics)
+
+        with metrics.phase('load figfams') as phase:
+            owners = {}
+            for (contig_id, unique_figs) in analysis['unique_proteins'].values():
+                for fig in unique_figs:
+                    owners[fig] = contig_id
+            conn.executemany(
+                "INSERT INTO figfams (figfam, first_seq, first_position, genome_count, owner) VALUES (?, ?, ?, ?, ?)",
+                ((fig,) + first_seen[fig] + (count, owners.get(fig)) for (fig, count) in zip(analysis['fig_list'], analysis['fig_genome_counts'].tolist()))
+            )
+            phase['rows'] = len(analysis['fig_list'])
+
+        with metrics.phase('index'):
+            conn.executescript(INDEXES)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, state_file_path)
+
+    return analysis
+
+# index into presence.PARTITIONS of a figfam in count of total genomes
+def partition_of(count, total, partition_thresholds):
+    return int(presence.partition_by_frequency(numpy.array([count]), total, *partition_thresholds)[0])
+
+# the genome counts, up to old_total, which fall in another partition with new_total genomes
+def moved_counts(old_total, new_total, partition_thresholds):
+    if old_total == 0 or new_total == 0:
+        return []
+    counts = numpy.arange(1, old_total + 1)
+    old_partitions = presence.partition_by_frequency(counts, old_total, *partition_thresholds)
+    new_partitions = presence.partition_by_frequency(counts, new_total, *partition_thresholds)
+    return counts[old_partitions != new_partitions].tolist()
+
+# the figfams not in genome_figs whose partition or common status changes when the number of genomes
+#  goes from old_total to new_total, their genome counts stay the same. read from the count buckets
+#  before the figfams of the genome are updated
+def bucket_changes(conn, genome, genome_figs, old_total, new_total, partition_thresholds, delta):
+    for count in moved_counts(old_total, new_total, partition_thresholds):
+        partition = presence.PARTITIONS[partition_of(count, new_total, partition_thresholds)]
+        for (fig,) in conn.execute("SELECT figfam FROM figfams WHERE genome_count = ?", (count,)):
+            if fig not in genome_figs:
+                delta.append((genome, 'partition', fig, '', partition))
+    # common is the bucket of all genomes, ie. on add the figfams in all other genomes but not this one
+    #  stop being common, on remove the figfams in all other genomes but not this one become common
+    (count, change) = (old_total, 'not_common') if new_total > old_total else (new_total, 'common')
+    if count > 0:
+        for (fig,) in conn.execute("SELECT figfam FROM figfams WHERE genome_count = ?", (count,)):
+            if fig not in genome_figs:
+                delta.append((genome, change, fig, '', ''))
+
+# takes a parsed genome, as returned by ingest.parse_genome_csv. what changed is appended to delta as
+#  (genome, change, figfam, contig id, partition) when given, the caller commits
+def add_genome(conn, result, delta=None):
+
+    delta = delta if delta is not None else []
+    contig_id = result['contig_id']
+    check_new_genome(conn, result)
+
+    partition_thresholds = thresholds(conn)
+    old_total = total_genomes(conn)
+    new_total = old_total + 1
+    genome_figs = set(result['protein_data'])
+
+    bucket_changes(conn, contig_id, genome_figs, old_total, new_total, partition_thresholds, delta)
+
+    seq = conn.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM genomes").fetchone()[0]
+    for (i, fig) in enumerate(result['protein_data'].figfams):
+        row = conn.execute("SELECT genome_count, owner FROM figfams WHERE figfam = ?", (fig,)).fetchone()
+        if row is None:
+            conn.execute("INSERT INTO figfams (figfam, first_seq, first_position, genome_count, owner) VALUES (?, ?, ?, 1, ?)", (fig, seq, i, contig_id))
+            delta.append((contig_id, 'new', fig, '', presence.PARTITIONS[partition_of(1, new_total, partition_thresholds)]))
+            delta.append((contig_id, 'unique', fig, contig_id, ''))
+            if new_total == 1:
+                delta.append((contig_id, 'common', fig, '', ''))
+            continue
+        (old_count, owner) = row
+        conn.execute("UPDATE figfams SET genome_count = ?, owner = NULL WHERE figfam = ?", (old_count + 1, fig))
+        # was unique to another genome, no longer is
+        if old_count == 1:
+            delta.append((contig_id, 'not_unique', fig, owner, ''))
+        new_partition = partition_of(old_count + 1, new_total, partition_thresholds)
+        if partition_of(old_count, old_total, partition_thresholds) != new_partition:
+            delta.append((contig_id, 'partition', fig, '', presence.PARTITIONS[new_partition]))
+
+    insert_genome(conn, result, seq)
+    return delta
+
+def remove_genome(conn, contig_id, delta=None):
+
+    delta = delta if delta is not None else []
+    if conn.execute("SELECT 1 FROM genomes WHERE contig_id = ?", (contig_id,)).fetchone() is None:
+        raise Exception("no genome with id: %s in pan-genome state" % contig_id)
+
+    partition_thresholds = thresholds(conn)
+    old_total = total_genomes(conn)
+    new_total = old_total - 1
+    (seq,) = conn.execute("SELECT seq FROM genomes WHERE contig_id = ?", (contig_id,)).fetchone()
+    genome_figs = [fig for (fig,) in conn.execute("SELECT figfam FROM genome_figfams WHERE contig_id = ?", (contig_id,))]
+
+    bucket_changes(conn, contig_id, set(genome_figs), old_total, new_total, partition_thresholds, delta)
+
+    conn.execute("DELETE FROM genome_figfams WHERE contig_id = ?", (contig_id,))
+    conn.execute("DELETE FROM genomes WHERE contig_id = ?", (contig_id,))
+
+    for fig in genome_figs:
+        (old_count, first_seq) = conn.execute("SELECT genome_count, first_seq FROM figfams WHERE figfam = ?", (fig,)).fetchone()
+        if old_count == 1:
+            conn.execute("DELETE FROM figfams WHERE figfam = ?", (fig,))
+            delta.append((contig_id, 'gone', fig, '', ''))
+            continue
+        # first seen in this genome, it is now first seen where it is in the next genome with it
+        if first_seq == seq:
+            conn.execute(
+                "UPDATE figfams SET (first_seq, first_position) = (SELECT seq, position FROM genome_figfams WHERE figfam = ? ORDER BY seq LIMIT 1) WHERE figfam = ?",
+                (fig, fig)
+            )
+        owner = None
+        if old_count == 2:
+            # only one genome left with it, which now has it as unique
+            (owner,) = conn.execute("SELECT contig_id FROM genome_figfams WHERE figfam = ?", (fig,)).fetchone()
+            delta.append((contig_id, 'unique', fig, owner, ''))
+        conn.execute("UPDATE figfams SET genome_count = ?, owner = ? WHERE figfam = ?", (old_count - 1, owner, fig))
+        new_partition = partition_of(old_count - 1, new_total, partition_thresholds)
+        if partition_of(old_count, old_total, partition_thresholds) != new_partition:
+            delta.append((contig_id, 'partition', fig, '', presence.PARTITIONS[new_partition]))
+    return delta
+
+def find_genome_id(conn, id_or_file_name):
+    row = conn.execute(
+        "SELECT contig_id FROM genomes WHERE contig_id = ? OR file_name = ? OR file_name = ? ORDER BY seq LIMIT 1",
+        (id_or_file_name, id_or_file_name, os.path.basename(id_or_file_name))
+    ).fetchone()
+    if row is None:
+        raise Exception("no genome with id or file name: %s in pan-genome state" % id_or_file_name)
+    return row[0]
+
+# materializes the full figfam -> function/feature ids/contig ids registry, as built by proteins.py,
+#  the function of a figfam is the one in the first genome added with it
+def all_protein_data(conn, fig_list, genomes):
+    functions = {fig : function for (fig, function, seq) in conn.execute(
+        "SELECT figfam, function, MIN(seq) FROM genome_figfams GROUP BY figfam"
+    )}
+    registry = protein_registry.ProteinRegistry()
+    for fig in fig_list:
+        registry.fig_code(fig, functions[fig])
+    for (contig_id, file_name) in genomes:
+        for (fig, feature_ids) in conn.execute("SELECT figfam, feature_ids FROM genome_figfams WHERE contig_id = ?", (contig_id,)):
+            registry.add(fig, functions[fig], contig_id, feature_ids.split(FEATURE_SEPARATOR))
+    return registry
+
+# the same dict proteins.analyse_proteins returns, for proteins.write_protein_outputs, read from the
+#  whole state
+def state_analysis(conn):
+
+    genomes = conn.execute("SELECT contig_id, file_name FROM genomes ORDER BY seq").fetchall()
+    if len(genomes) == 0:
+        raise Exception("expected at least one genome in pan-genome state to write outputs for! got none.")
+    (total_entries, skipped_entries, skipped_entries_with_figs) = conn.execute(
+        "SELECT SUM(total_entries), SUM(skipped_entries), SUM(skipped_entries_with_figs) FROM genomes"
+    ).fetchone()
+
+    fig_list = []
+    fig_genome_counts = []
+    owned = {contig_id : [] for (contig_id, file_name) in genomes}
+    for (fig, count, owner) in conn.execute("SELECT figfam, genome_count, owner FROM figfams ORDER BY first_seq, first_position"):
+        fig_list.append(fig)
+        fig_genome_counts.append(count)
+        if count == 1:
+            owned[owner].append(fig)
+    fig_genome_counts = numpy.array(fig_genome_counts, dtype=numpy.int64)
+
+    total = len(genomes)
+    partition_thresholds = thresholds(conn)
+    return {
+        'all_protein_data' : all_protein_data(conn, fig_list, genomes),
+        'total_genomes' : total,
+        'all_common_proteins' : [fig for (fig, count) in zip(fig_list, fig_genome_counts.tolist()) if count == total],
+        'all_unique_proteins' : fig_list,
+        'unique_proteins' : {file_name : (contig_id, owned[contig_id]) for (contig_id, file_name) in genomes},
+        'fig_list' : fig_list,
+        'fig_genome_counts' : fig_genome_counts,
+        'fig_partitions' : presence.partition_by_frequency(fig_genome_counts, total, *partition_thresholds),
+        'histogram_counts' : presence.frequency_histogram(fig_genome_counts, total),
+        'histogram_partitions' : presence.partition_by_frequency(numpy.arange(total + 1), total, *partition_thresholds),
+        'total_entries' : total_entries,
+        'skipped_entries' : skipped_entries,
+        'skipped_entries_with_figs' : skipped_entries_with_figs,
+        # files without any rows have nothing to skip
+        'percentage_skipped' : (skipped_entries / total_entries) * 100 if total_entries > 0 else 0.0
+    }
+
+# the same spreadsheets as proteins.py, for every genome in the state
+def write_outputs(conn, output_dir, export_csv=False, metrics=None, compression=None):
+    metrics = metrics if metrics is not None else util.Metrics('pangenome')
+    with metrics.phase('read state') as phase:
+        analysis = state_analysis(conn)
+        phase['rows'] = len(analysis['fig_list'])
+    proteins.write_protein_outputs(analysis, output_dir, export_csv=export_csv, metrics=metrics, compression=compression)
+
+def write_delta(delta_file_path, delta):
+    with util.open_text(delta_file_path, 'w') as csvfile:
+        print("[pangenome] wrote %d changes to: %s" % (len(delta), delta_file_path))
+        writer = csv.writer(csvfile, dialect="excel")
+        writer.writerow(DELTA_FIELDS)
+        for row in delta:
+            writer.writerow(row)
+
+# builds a new state from the csv files in directory (as proteins.load_genomes reads them) and writes
+#  the proteins.py spreadsheets to output_dir
+def build_from_directory(state_file_path, directory, output_dir, jobs=1, cache_dir=None, recursive=False, core_threshold=proteins.DEFAULT_CORE_THRESHOLD, soft_core_threshold=proteins.DEFAULT_SOFT_CORE_THRESHOLD, shell_threshold=proteins.DEFAULT_SHELL_THRESHOLD, export_csv=False, compression=None, metrics=None):
+
+    metrics = metrics if metrics is not None else util.Metrics('pangenome')
+    parsed_files = proteins.load_genomes(directory, jobs=jobs, cache_dir=cache_dir, metrics=metrics, recursive=recursive)
+    if len(parsed_files) == 0:
+        raise Exception("expected at least one data file in %s to read from! got none." % directory)
+    analysis = build_state(state_file_path, parsed_files, core_threshold, soft_core_threshold, shell_threshold, metrics=metrics)
+    print("[pangenome] built state with %d genomes (%d proteins) in: %s" % (analysis['total_genomes'], len(analysis['fig_list']), state_file_path))
+    proteins.write_protein_outputs(analysis, output_dir, export_csv=export_csv, metrics=metrics, compression=compression)
+    return analysis
+
+# adds the genome csv files in add_files to the state and then removes the genomes (contig ids or file
+#  names) in remove_genomes from it, in one transaction. what changed is written to pangenome_delta.csv
+#  in output_dir and returned, with write_all the spreadsheets for the whole state are rewritten too
+def update_state(state_file_path, output_dir, add_files=(), remove_genomes=(), write_all=False, export_csv=False, compression=None, metrics=None):
+
+    metrics = metrics if metrics is not None else util.Metrics('pangenome')
+    conn = open_state(state_file_path)
+    try:
+        delta = []
+        with metrics.phase('update state') as phase:
+            for path in add_files:
+                # keep the file name as proteins.py would, relative to the directory it is in
+                result = ingest.parse_genome_csv(path)
+                result['file_name'] = os.path.basename(path)
+                add_genome(conn, result, delta)
+                print("[pangenome] added %s (id: %s) with %d proteins" % (path, result['contig_id'], len(result['proteins'])))
+            for id_or_file_name in remove_genomes:
+                contig_id = find_genome_id(conn, id_or_file_name)
+                remove_genome(conn, contig_id, delta)
+                print("[pangenome] removed genome %s" % contig_id)
+            conn.commit()
+            phase['rows'] = len(delta)
+        print("[pangenome] state now has %d genomes (%d proteins)" % (total_genomes(conn), total_figfams(conn)))
+
+        delta_file_path = util.compressed_path(os.path.join(output_dir, 'pangenome_delta.csv'), compression)
+        with metrics.phase('write pangenome_delta.csv', output=delta_file_path) as phase:
+            write_delta(delta_file_path, delta)
+            phase['rows'] = len(delta)
+
+        if write_all:
+            write_outputs(conn, output_dir, export_csv=export_csv, metrics=metrics, compression=compression)
+    finally:
+        conn.close()
+    return delta
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Maintains a persistent pan-genome state, adding or removing genomes updates the common and unique proteins without recomputing everything and writes what changed.')
+    parser.add_argument(
+        '--state', metavar='state', type=str, default='output/pangenome_state.sqlite',
+        help='the sqlite file the pan-genome state is kept in (defaults to output/pangenome_state.sqlite)'
+    )
+    parser.add_argument(
+        '--export-csv', default=False, action='store_true',
+        help='also write all proteins as output/all_proteins.csv, next to the binary output/all_proteins.bin'
+    )
+    util.add_compression_arguments(parser)
+    util.add_metrics_arguments(parser)
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help='build a new state from a directory of genome csv files and write the spreadsheets')
+    build_parser.add_argument(
+        'directory', type=str, default=os.getcwd(), nargs="?",
+        help='the directory with the csv files of the genomes in it (defaults to current directory)'
+    )
+    build_parser.add_argument(
+        '--jobs', metavar='jobs', type=int, default=1,
+        help='number of worker processes to parse the csv files with (defaults to 1, no worker processes)'
+    )
+    build_parser.add_argument(
+        '--cache-dir', metavar='cache_dir', type=str, default=None,
+        help='directory to cache parsed csv files in (defaults to no cache)'
+    )
+    build_parser.add_argument(
+        '--recursive', default=False, action='store_true',
+        help='also read the csv files in the directories below directory'
+    )
+    proteins.add_partition_arguments(build_parser)
+
+    add_parser = subparsers.add_parser('add', help='add genome csv files to the state')
+    add_parser.add_argument('files', type=str, nargs='+', help='the genome csv files to add')
+
+    remove_parser = subparsers.add_parser('remove', help='remove genomes from the state')
+    remove_parser.add_argument('genomes', type=str, nargs='+', help='contig ids or file names of the genomes to remove')
+
+    for update_parser in (add_parser, remove_parser):
+        update_parser.add_argument(
+            '--write-outputs', default=False, action='store_true',
+            help='also rewrite the proteins.py spreadsheets for the whole collection after adding or removing genomes'
+        )
+
+    subparsers.add_parser('write', help='write the spreadsheets for every genome in the state')
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("expected one of: build, add, remove, write")
+    if args.command == 'build' and not (0.0 <= args.shell_threshold <= args.soft_core_threshold <= args.core_threshold <= 1.0):
+        parser.error("expected 0 <= --shell-threshold <= --soft-core-threshold <= --core-threshold <= 1")
+
+    cur_dir = os.getcwd()
+    output_dir = os.path.join(cur_dir, 'output')
+    state_file_path = os.path.join(cur_dir, args.state)
+    metrics = util.create_metrics('pangenome', args, cur_dir)
+    util.create_output_directory_if_not_exists(cur_dir)
+
+    if args.command == 'build':
+        cache_dir = os.path.join(cur_dir, args.cache_dir) if args.cache_dir is not None else None
+        build_from_directory(
+            state_file_path, args.directory, output_dir, jobs=args.jobs, cache_dir=cache_dir, recursive=args.recursive,
+            core_threshold=args.core_threshold, soft_core_threshold=args.soft_core_threshold, shell_threshold=args.shell_threshold,
+            export_csv=args.export_csv, compression=args.compress, metrics=metrics
+        )
+    elif args.command == 'write':
+        conn = open_state(state_file_path)
+        write_outputs(conn, output_dir, export_csv=args.export_csv, metrics=metrics, compression=args.compress)
+        conn.close()
+    else:
+        update_state(
+            state_file_path, output_dir,
+            add_files=args.files if args.command == 'add' else (), remove_genomes=args.genomes if args.command == 'remove' else (),
+            write_all=args.write_outputs, export_csv=args.export_csv, compression=args.compress, metrics=metrics
+        )
+
+    metrics.write_report()
@@ -0,0 +1,184 @@
+import os
+import json
+import mmap
+import struct
+import hashlib
+
+# our utils
+import ingest
+import protein_registry
+
+# on-disk cache of parsed genome csv files, so reruns only parse new or changed files.
+#  the index maps each absolute source path to its size, mtime, content hash, cache version and entry
+#  file, each entry is one binary file (see write_entry) that is loaded through a memory map.
+
+CACHE_MAGIC = b'RPC2'
+INDEX_FILE_NAME = 'index.json'
+
+# magic, then: has contig id, total entries, skipped entries, skipped entries with figs,
+#  number of figfams, functions, contigs and features, string table size
+HEADER_FORMAT = '<4s9Q'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# entries written by another format or parser are parsed again
+def cache_version():
+    return '%s/%d' % (CACHE_MAGIC.decode('ascii'), ingest.PARSER_VERSION)
+
+def hash_file_contents(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def entry_file_name(path):
+    return hashlib.sha1(path.encode('utf-8')).hexdigest() + '.bin'
+
+def load_index(cache_dir):
+    index_path = os.path.join(cache_dir, INDEX_FILE_NAME)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+def save_index(cache_dir, index):
+    index_path = os.path.join(cache_dir, INDEX_FILE_NAME)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+# the columns of the protein_registry.ProteinRegistry of a result are written as they are: the contig
+#  id, figfams, functions and contigs as one NUL separated utf-8 string table (decoded in one go), then the function code of every figfam, the
+#  figfam and contig code and feature offset of every feature row, and the feature bytes
+def write_entry(entry_path, result):
+
+    registry = result['protein_data']
+    has_contig_id = result['contig_id'] != -1
+    strings = '\0'.join([str(result['contig_id'])] + registry.figfams + registry.functions + registry.contigs).encode('utf-8')
+
+    header = struct.pack(
+        HEADER_FORMAT, CACHE_MAGIC, has_contig_id,
+        result['total_entries'], result['skipped_entries'], result['skipped_entries_with_figs'],
+        len(registry.figfams), len(registry.functions), len(registry.contigs), len(registry.row_figs), len(strings)
+    )
+
+    tmp_path = entry_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(strings)
+        f.write(registry.function_codes.tobytes())
+        f.write(registry.row_figs.tobytes())
+        f.write(registry.row_contigs.tobytes())
+        f.write(registry.feature_offsets.tobytes())
+        f.write(registry.feature_blob)
+    os.replace(tmp_path, entry_path)
+
+def read_entry(entry_path, file_name):
+
+    with open(entry_path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # every column is a view over the map, released again before it is closed
+    views = [memoryview(buf)]
+    try:
+        (magic, has_contig_id, total_entries, skipped_entries, skipped_entries_with_figs,
+            num_figs, num_functions, num_contigs, num_features, strings_size) = struct.unpack_from(HEADER_FORMAT, buf, 0)
+        if magic != CACHE_MAGIC:
+            raise Exception("cache entry: %s has unexpected format, expected magic %s got %s" % (entry_path, CACHE_MAGIC, magic))
+
+        offset = HEADER_SIZE
+        def take(item_size, count):
+            nonlocal offset
+            views.append(views[0][offset:offset + item_size * count])
+            offset += item_size * count
+            return views[-1]
+
+        strings = str(take(1, strings_size), 'utf-8').split('\0')
+        if len(strings) != 1 + num_figs + num_functions + num_contigs:
+            raise Exception("cache entry: %s has %d strings, expected %d" % (entry_path, len(strings), 1 + num_figs + num_functions + num_contigs))
+
+        function_codes = take(4, num_figs)
+        row_figs = take(4, num_features)
+        row_contigs = take(4, num_features)
+        feature_offsets = take(8, num_features + 1)
+        feature_blob = take(1, feature_offsets.cast('Q')[-1])
+
+        contig_id = strings[0] if has_contig_id else -1
+        figs_end = 1 + num_figs
+        functions_end = figs_end + num_functions
+        protein_data = protein_registry.registry_from_columns(
+            strings[1:figs_end], strings[figs_end:functions_end], function_codes, strings[functions_end:],
+            row_figs, row_contigs, feature_offsets, feature_blob
+        )
+    finally:
+        for view in reversed(views):
+            view.release()
+        buf.close()
+
+    return {
+        'file_name' : file_name,
+        'contig_id' : contig_id,
+        'proteins' : set(protein_data.figfams),
+        'protein_data' : protein_data,
+        'total_entries' : total_entries,
+        'skipped_entries' : skipped_entries,
+        'skipped_entries_with_figs' : skipped_entries_with_figs
+    }
+
+def parse_genome_csvs_cached(file_names, cache_dir, jobs=1):
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    index = load_index(cache_dir)
+
+    # evict entries whose source file no longer exists
+    evicted_entries = 0
+    for path in list(index):
+        if not os.path.isfile(path):
+            entry_path = os.path.join(cache_dir, index[path]['entry'])
+            if os.path.exists(entry_path):
+                os.remove(entry_path)
+            del index[path]
+            evicted_entries += 1
+
+    results = [None] * len(file_names)
+    stale_files = []
+
+    for (i, file_name) in enumerate(file_names):
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+        cached = index.get(path)
+        entry_path = os.path.join(cache_dir, entry_file_name(path))
+        if cached is not None and cached.get('version') == cache_version() and os.path.exists(entry_path) and cached['size'] == stat.st_size:
+            # same size and mtime, or touched but with the same contents
+            if cached['mtime'] != stat.st_mtime_ns:
+                content_hash = hash_file_contents(path)
+                if content_hash != cached['hash']:
+                    stale_files.append(i)
+                    continue
+                cached['mtime'] = stat.st_mtime_ns
+            results[i] = read_entry(entry_path, file_name)
+        else:
+            stale_files.append(i)
+
+    parsed_files = ingest.parse_genome_csvs([file_names[i] for i in stale_files], jobs=jobs)
+    for (i, result) in zip(stale_files, parsed_files):
+        path = os.path.abspath(file_names[i])
+        stat = os.stat(path)
+        entry = entry_file_name(path)
+        write_entry(os.path.join(cache_dir, entry), result)
+        index[path] = {
+            'size' : stat.st_size,
+            'mtime' : stat.st_mtime_ns,
+            'hash' : hash_file_contents(path),
+            'version' : cache_version(),
+            'entry' : entry
+        }
+        results[i] = result
+
+    save_index(cache_dir, index)
+    print("[parse_cache] %d cached, %d parsed, %d evicted" % (len(file_names) - len(stale_files), len(stale_files), evicted_entries))
+
+    return results
@@ -0,0 +1,288 @@
+import os
+import asyncio
+import argparse
+import datetime
+import functools
+import concurrent.futures
+
+# our utils
+import util
+import ingest
+import rast_cli
+import rast_web
+import pangenome
+import collate_data
+import fasta_preflight
+
+# streaming submit -> poll -> fetch -> analyse pipeline, every job moves on to the next stage as soon
+#  as its previous stage finishes, instead of each stage being a separate batch script run by hand.
+#  stages are connected by bounded queues, each stage runs a fixed number of workers, and blocking
+#  work (the RAST command line tools, http requests, parsing) runs on a thread pool.
+
+parser = argparse.ArgumentParser(description='Submits a directory of fasta files to RAST, polls the jobs, downloads their classifications and subsystem tables and adds each genome to the analysis as soon as it is done.')
+parser.add_argument(
+    '--username', metavar='username', type=str, required=True,
+    help='your login username'
+)
+parser.add_argument(
+    '--password', metavar='password', type=str, required=True,
+    help='your login password'
+)
+parser.add_argument(
+    'directory', type=str, default=os.getcwd(), nargs="?",
+    help='the directory with the fasta (.fa) files in it to upload'
+)
+parser.add_argument(
+    '--queue-depth', metavar='queue_depth', type=int, default=16,
+    help='maximum number of jobs waiting between two stages (defaults to 16)'
+)
+parser.add_argument(
+    '--submit-concurrency', metavar='submit_concurrency', type=int, default=4,
+    help='number of submissions to run at once (defaults to 4)'
+)
+parser.add_argument(
+    '--poll-concurrency', metavar='poll_concurrency', type=int, default=32,
+    help='number of jobs to poll for completion at once (defaults to 32)'
+)
+parser.add_argument(
+    '--fetch-concurrency', metavar='fetch_concurrency', type=int, default=8,
+    help='number of finished jobs to download at once (defaults to 8)'
+)
+parser.add_argument(
+    '--poll-interval', metavar='poll_interval', type=float, default=60.0,
+    help='seconds between polling the status of a job (defaults to 60)'
+)
+parser.add_argument(
+    '--retries', metavar='retries', type=int, default=3,
+    help='number of times to retry a failed submission or request (defaults to 3)'
+)
+parser.add_argument(
+    '--backoff', metavar='backoff', type=float, default=5.0,
+    help='seconds to wait before the first retry of a submission, doubled for every retry after (defaults to 5)'
+)
+parser.add_argument(
+    '--submit-cmd', metavar='submit_cmd', type=str, default="svr_submit_RAST_job",
+    help='path to svr_submit_RAST_job (defaults to the one on PATH)'
+)
+parser.add_argument(
+    '--status-cmd', metavar='status_cmd', type=str, default="svr_status_of_RAST_job",
+    help='path to svr_status_of_RAST_job (defaults to the one on PATH)'
+)
+parser.add_argument(
+    '--retrieve-cmd', metavar='retrieve_cmd', type=str, default="svr_retrieve_RAST_job",
+    help='path to svr_retrieve_RAST_job (defaults to the one on PATH)'
+)
+parser.add_argument(
+    '--retrieve-format', metavar='retrieve_format', type=str, default="spreadsheet_tab",
+    help='format to retrieve the classification of a job in, must be tab separated with a header (defaults to spreadsheet_tab)'
+)
+parser.add_argument(
+    '--base-url', metavar='base_url', type=str, default=rast_web.default_base_url,
+    help='base url of the RAST server (defaults to %s)' % rast_web.default_base_url
+)
+parser.add_argument(
+    '--collate', default=False, action='store_true',
+    help='run collate_data.py on the results once all jobs are done'
+)
+parser.add_argument(
+    '--skip-preflight', default=False, action='store_true',
+    help='submit every fasta file without scanning it first (see fasta_preflight.py)'
+)
+fasta_preflight.add_preflight_arguments(parser)
+
+class Pipeline:
+
+    def __init__(self, args, output_dir):
+        self.args = args
+        self.output_dir = output_dir
+        self.classifications_dir = os.path.join(output_dir, 'classifications')
+        self.subsystems_dir = os.path.join(output_dir, 'subsystems')
+        self.journal_path = os.path.join(output_dir, 'submitted_jobs.csv')
+        # our own state, not the one pangenome.py keeps in output/pangenome_state.sqlite, kept between runs
+        self.state_path = os.path.join(output_dir, 'pipeline_state.sqlite')
+        if os.path.exists(self.state_path):
+            self.state = pangenome.open_state(self.state_path, check_same_thread=False)
+        else:
+            self.state = pangenome.create_state(self.state_path, check_same_thread=False)
+        self.session = None
+        self.counters = {}
+        total_threads = args.submit_concurrency + args.poll_concurrency + 2 * args.fetch_concurrency + 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=total_threads)
+        # the state is only ever touched from this one thread while the stages run
+        self.state_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def run_blocking(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args))
+
+    def run_on_state(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.state_executor, functools.partial(fn, *args))
+
+    async def submit(self, job):
+        if job['job_id'] is not None:
+            print("[pipeline] %s already submitted as job %s" % (job['file_name'], job['job_id']))
+            return job
+        args = self.args
+        try:
+            job['job_id'] = await self.run_blocking(
+                rast_cli.submit_with_retries, args.submit_cmd, args.username, args.password,
+                os.path.join(args.directory, job['file_name']), args.retries, args.backoff
+            )
+        except Exception:
+            rast_cli.write_job_id_to_journal(self.journal_file, self.journal_writer, -1, job['file_name'], success = False)
+            raise
+        rast_cli.write_job_id_to_journal(self.journal_file, self.journal_writer, job['job_id'], job['file_name'], success = True)
+        return job
+
+    async def poll(self, job):
+        args = self.args
+        while True:
+            status = await self.run_blocking(rast_cli.job_status, args.status_cmd, args.username, args.password, job['job_id'])
+            if status == 'complete':
+                return job
+            if rast_cli.is_failed_job_status(status):
+                raise Exception("job %s ended with status: %s" % (job['job_id'], status))
+            await asyncio.sleep(args.poll_interval)
+
+    def classification_name(self, file_name):
+        name, ext = os.path.splitext(file_name)
+        return name + '.csv'
+
+    def fetch_classification(self, job):
+        args = self.args
+        spreadsheet = rast_cli.retrieve_job(args.retrieve_cmd, args.username, args.password, job['job_id'], args.retrieve_format)
+        output_path = os.path.join(self.classifications_dir, self.classification_name(job['file_name']))
+        rast_cli.write_classification_csv(spreadsheet, output_path)
+        return output_path
+
+    async def fetch(self, job):
+        (job['classification_path'], job['subsystems_path']) = await asyncio.gather(
+            self.run_blocking(self.fetch_classification, job),
+            self.run_blocking(rast_web.fetch_subsystems_for_job, self.session, self.args.base_url, job['job_id'], self.subsystems_dir)
+        )
+        return job
+
+    def add_to_state(self, result):
+        pangenome.add_genome(self.state, result)
+        self.state.commit()
+        return pangenome.total_genomes(self.state)
+
+    async def analyse(self, job):
+        result = await self.run_blocking(ingest.parse_genome_csv, job['classification_path'])
+        result['file_name'] = os.path.basename(job['classification_path'])
+        total_genomes = await self.run_on_state(self.add_to_state, result)
+        print("[pipeline] added %s (id: %s) to analysis, %d genomes so far" % (result['file_name'], result['contig_id'], total_genomes))
+        return job
+
+    async def stage_worker(self, name, handler, in_queue, out_queue):
+        while True:
+            job = await in_queue.get()
+            if job is None:
+                return
+            try:
+                job = await handler(job)
+                self.counters[name]['done'] += 1
+                if out_queue is not None:
+                    await out_queue.put(job)
+            except Exception as e:
+                self.counters[name]['failed'] += 1
+                print("[pipeline] %s failed for %s: %s" % (name, job['file_name'], e))
+
+    # runs the workers of a stage until its input is exhausted, then tells the next stage it is done
+    async def run_stage(self, name, handler, concurrency, in_queue, out_queue, downstream_concurrency):
+        self.counters[name] = {'done' : 0, 'failed' : 0}
+        await asyncio.gather(*[self.stage_worker(name, handler, in_queue, out_queue) for _ in range(concurrency)])
+        print("[pipeline] stage %s finished at %s: %d done, %d failed" % (name, datetime.datetime.now(), self.counters[name]['done'], self.counters[name]['failed']))
+        if out_queue is not None:
+            for _ in range(downstream_concurrency):
+                await out_queue.put(None)
+
+    async def feed(self, jobs, queue, concurrency):
+        for job in jobs:
+            await queue.put(job)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def run(self, fasta_files):
+        args = self.args
+
+        # genomes added to the state by an earlier run are done, their classification and table are there
+        analysed = pangenome.genome_file_names(self.state)
+        for f in fasta_files:
+            if self.classification_name(f) in analysed:
+                print("[pipeline] %s already in the analysis, skipping it" % f)
+        fasta_files = [f for f in fasta_files if self.classification_name(f) not in analysed]
+
+        already_submitted = rast_cli.read_journal(self.journal_path)
+        jobs = [{'file_name' : f, 'job_id' : already_submitted.get(f)} for f in fasta_files]
+
+        self.session = rast_web.create_session(args.fetch_concurrency, args.retries)
+        await self.run_blocking(rast_web.login_to_rast, self.session, args.base_url, args.username, args.password)
+
+        submit_queue = asyncio.Queue(maxsize=args.queue_depth)
+        poll_queue = asyncio.Queue(maxsize=args.queue_depth)
+        fetch_queue = asyncio.Queue(maxsize=args.queue_depth)
+        analyse_queue = asyncio.Queue(maxsize=args.queue_depth)
+
+        (self.journal_file, self.journal_writer) = rast_cli.open_journal(self.journal_path)
+        with self.journal_file:
+            await asyncio.gather(
+                self.feed(jobs, submit_queue, args.submit_concurrency),
+                self.run_stage('submit', self.submit, args.submit_concurrency, submit_queue, poll_queue, args.poll_concurrency),
+                self.run_stage('poll', self.poll, args.poll_concurrency, poll_queue, fetch_queue, args.fetch_concurrency),
+                self.run_stage('fetch', self.fetch, args.fetch_concurrency, fetch_queue, analyse_queue, 1),
+                self.run_stage('analyse', self.analyse, 1, analyse_queue, None, 0)
+            )
+
+        self.session.close()
+        self.executor.shutdown()
+        self.state_executor.shutdown()
+
+def main():
+
+    args = parser.parse_args()
+
+    # we run the tools from other directories, so resolve them first
+    args.submit_cmd = rast_cli.resolve_cmd(args.submit_cmd, "svr_submit_RAST_job", "--submit-cmd")
+    args.status_cmd = rast_cli.resolve_cmd(args.status_cmd, "svr_status_of_RAST_job", "--status-cmd")
+    args.retrieve_cmd = rast_cli.resolve_cmd(args.retrieve_cmd, "svr_retrieve_RAST_job", "--retrieve-cmd")
+
+    cur_dir = os.getcwd()
+    output_dir = os.path.join(cur_dir, 'output')
+    util.create_output_directory_if_not_exists(cur_dir)
+
+    pipeline = Pipeline(args, output_dir)
+    for d in (pipeline.classifications_dir, pipeline.subsystems_dir):
+        if not os.path.exists(d):
+            os.mkdir(d)
+
+    os.chdir(args.directory)
+    fasta_files = util.get_files_in_folder_with_ext(".fa")
+    os.chdir(cur_dir)
+    args.directory = os.path.abspath(args.directory)
+    print("[pipeline] got %d fasta files to process at %s" % (len(fasta_files), datetime.datetime.now()))
+
+    # files already submitted go on as they are, new ones are only submitted if they pass the pre-flight checks
+    if not args.skip_preflight:
+        fasta_files = fasta_preflight.preflight(
+            args.directory, fasta_files, pipeline.journal_path, os.path.join(output_dir, 'fasta_stats.csv'),
+            fasta_preflight.thresholds_from_args(args), jobs=args.preflight_jobs
+        )
+
+    asyncio.run(pipeline.run(fasta_files))
+
+    if pangenome.total_genomes(pipeline.state) == 0:
+        raise Exception("no genomes made it through the pipeline, nothing to analyse!")
+
+    print("[pipeline] wrote state with %d genomes to: %s" % (pangenome.total_genomes(pipeline.state), pipeline.state_path))
+    pangenome.write_outputs(pipeline.state, output_dir)
+    pipeline.state.close()
+
+    if args.collate:
+        (all_protein_data, feature_id_to_fig_mapping) = collate_data.load_all_proteins(os.path.join(output_dir, 'all_proteins.bin'))
+        (all_category_data, _) = collate_data.collate_subsystems(all_protein_data, feature_id_to_fig_mapping, pipeline.subsystems_dir)
+        collate_data.write_collated_outputs(all_protein_data, all_category_data, output_dir)
+
+    print("[pipeline] finished at %s" % datetime.datetime.now())
+
+if __name__ == '__main__':
+    main()
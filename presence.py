@@ -0,0 +1,69 @@
+import numpy
+
+# genome x figfam presence matrix, figfam ids are interned to row indexes and each row
+#  holds one bit per genome, packed 8 genomes to a byte (same bit order as numpy.packbits)
+
+# number of set bits for every possible byte value
+POPCOUNT_TABLE = numpy.array([bin(i).count("1") for i in range(256)], dtype=numpy.uint16)
+
+def intern_figfams(figfams):
+    fig_index = {}
+    fig_list = []
+    for fig in figfams:
+        if fig not in fig_index:
+            fig_index[fig] = len(fig_list)
+            fig_list.append(fig)
+    return fig_index, fig_list
+
+def build_presence_matrix(protein_sets, fig_index):
+    total_genomes = len(protein_sets)
+    packed = numpy.zeros((len(fig_index), (total_genomes + 7) // 8), dtype=numpy.uint8)
+    for genome_idx, proteins in enumerate(protein_sets):
+        rows = numpy.fromiter((fig_index[fig] for fig in proteins), dtype=numpy.int64, count=len(proteins))
+        packed[rows, genome_idx >> 3] |= numpy.uint8(0x80 >> (genome_idx & 7))
+    return packed
+
+def genome_counts(packed):
+    # popcount of every figfam row, ie. in how many genomes each figfam occurs
+    if packed.shape[1] == 0:
+        return numpy.zeros(packed.shape[0], dtype=numpy.int64)
+    return POPCOUNT_TABLE[packed].sum(axis=1, dtype=numpy.int64)
+
+def unpack_rows(packed, rows, total_genomes):
+    return numpy.unpackbits(packed[rows], axis=1, count=total_genomes)
+
+def common_unique_union(packed, total_genomes, counts=None):
+    # returns (common figfam indexes, unique figfam indexes, owning genome per unique figfam, union figfam indexes)
+    if counts is None:
+        counts = genome_counts(packed)
+    common = numpy.flatnonzero(counts == total_genomes)
+    unique = numpy.flatnonzero(counts == 1)
+    union = numpy.flatnonzero(counts > 0)
+    owners = unpack_rows(packed, unique, total_genomes).argmax(axis=1)
+    return common, unique, owners, union
+
+# pan-genome partitions by the fraction of genomes a figfam occurs in, from most to least frequent
+PARTITIONS = ['core', 'soft_core', 'shell', 'cloud']
+
+def partition_by_frequency(counts, total_genomes, core_threshold, soft_core_threshold, shell_threshold):
+    # returns the index into PARTITIONS of every figfam, a figfam falls in the first partition whose
+    #  threshold its fraction of genomes reaches, cloud takes the rest
+    fractions = counts / float(total_genomes)
+    thresholds = numpy.array([shell_threshold, soft_core_threshold, core_threshold])
+    return len(thresholds) - numpy.searchsorted(thresholds, fractions, side='right')
+
+def frequency_histogram(counts, total_genomes):
+    # number of figfams present in exactly 0, 1, .. total_genomes genomes
+    return numpy.bincount(counts, minlength=total_genomes + 1)
+
+def genome_major(packed, total_genomes, chunk_rows=8192):
+    # the same presence bits transposed, one row per genome holding one bit per figfam, built a chunk
+    #  of figfams at a time so the unpacked matrix never has to fit in memory at once
+    total_figs = packed.shape[0]
+    result = numpy.zeros((total_genomes, (total_figs + 7) // 8), dtype=numpy.uint8)
+    for start in range(0, total_figs, chunk_rows):
+        rows = numpy.arange(start, min(start + chunk_rows, total_figs))
+        bits = unpack_rows(packed, rows, total_genomes)
+        # chunk_rows is a multiple of 8, so every chunk starts on a byte boundary
+        result[:, start // 8:start // 8 + (len(rows) + 7) // 8] = numpy.packbits(bits, axis=0).T
+    return result
@@ -0,0 +1,124 @@
+import csv
+
+# our utils
+import util
+import protein_store
+
+# the spreadsheets written by proteins.py, unique_proteins maps each file name to a tuple of
+#  (contig_id, figfams unique to that genome), all_protein_data maps figfam to its function,
+#  feature ids and contig ids. every sheet is written a row at a time, compressed when its path
+#  ends in .gz or .xz (see util.open_text)
+
+def write_common_proteins(common_file_path, all_common_proteins, all_protein_data):
+    with util.open_text(common_file_path, 'w') as csvfile:
+        print("[protein] wrote common proteins to: %s" % common_file_path)
+        writer = csv.DictWriter(csvfile, fieldnames=['figfam', 'function'], dialect="excel")
+        writer.writeheader()
+        for fig in all_common_proteins:
+            cur_fig_data = all_protein_data[fig]
+            writer.writerow(
+                {
+                    'figfam' : fig,
+                    'function' : cur_fig_data['function']
+                }
+            )
+
+def write_unique_proteins(unique_file_path, unique_proteins, all_protein_data):
+    with util.open_text(unique_file_path, 'w') as csvfile:
+        print("[protein] wrote unique proteins to: %s" % unique_file_path)
+        writer = csv.DictWriter(csvfile, fieldnames=['file_name', 'contig_id', 'figfam', 'function'], dialect="excel")
+        writer.writeheader()
+        for (file_name, (contig_id, proteins)) in unique_proteins.items():
+            for fig in proteins:
+                cur_fig_data = all_protein_data[fig]
+                writer.writerow(
+                    {
+                        'file_name' : file_name,
+                        'contig_id' : contig_id,
+                        'figfam' : fig,
+                        'function' : cur_fig_data['function']
+                    }
+                )
+
+def write_unique_column_proteins(unique_column_file_path, unique_proteins, all_protein_data):
+
+    # one column of 5 cells per genome with any unique proteins
+    columns = [(file_name, contig_id, proteins) for (file_name, (contig_id, proteins)) in unique_proteins.items() if len(proteins) > 0]
+    column_lengths = [len(proteins) for (file_name, contig_id, proteins) in columns]
+
+    # write in column form, a row at a time, the columns with fewer proteins are padded with empty
+    #  cells up to the last column with a protein in that row
+    with util.open_text(unique_column_file_path, 'w') as csvfile:
+        print("[protein] wrote unique proteins to: %s" % unique_column_file_path)
+        writer = csv.writer(csvfile, dialect="excel")
+        writer.writerow(['file_name', 'contig_id', 'figfam', 'function', ''] * len(columns))
+        for cur_row in range(max(column_lengths, default=0)):
+            last_column = max(c for (c, length) in enumerate(column_lengths) if length > cur_row)
+            row = []
+            for (file_name, contig_id, proteins) in columns[:last_column + 1]:
+                if cur_row < len(proteins):
+                    fig = proteins[cur_row]
+                    row += [file_name, contig_id, fig, all_protein_data[fig]['function'], '']
+                else:
+                    row += [''] * 5
+            writer.writerow(row)
+
+# output a sheet with the stats also shown in console
+def write_output_stats(stats_file_path, total_different_proteins, total_common_proteins, percentage_skipped, unique_proteins):
+    with util.open_text(stats_file_path, 'w') as csvfile:
+        print("[protein] wrote output stats to: %s" % stats_file_path)
+        writer = csv.writer(csvfile, dialect="excel")
+        writer.writerow(['Total Different Proteins', total_different_proteins])
+        writer.writerow(['Total Common Proteins', total_common_proteins])
+        writer.writerow(['Total % of Discarded Proteins', percentage_skipped])
+        writer.writerow(['Filename', 'Genome', 'Unique Proteins'])
+        for (file_name, (contig_id, proteins)) in unique_proteins.items():
+            writer.writerow([file_name, contig_id, len(proteins)])
+
+# figfam_partitions is a list of (figfam, number of genomes it is in, partition)
+def write_partitions(partitions_file_path, figfam_partitions, total_genomes, all_protein_data):
+    with util.open_text(partitions_file_path, 'w') as csvfile:
+        print("[protein] wrote pan-genome partitions to: %s" % partitions_file_path)
+        writer = csv.DictWriter(csvfile, fieldnames=['figfam', 'function', 'genomes', 'frequency', 'partition'], dialect="excel")
+        writer.writeheader()
+        for (fig, count, partition) in figfam_partitions:
+            writer.writerow(
+                {
+                    'figfam' : fig,
+                    'function' : all_protein_data[fig]['function'],
+                    'genomes' : count,
+                    'frequency' : count / float(total_genomes),
+                    'partition' : partition
+                }
+            )
+
+# histogram is a list of (number of genomes, number of figfams in exactly that many genomes, partition)
+def write_frequency_histogram(histogram_file_path, histogram):
+    with util.open_text(histogram_file_path, 'w') as csvfile:
+        print("[protein] wrote genome frequency histogram to: %s" % histogram_file_path)
+        writer = csv.writer(csvfile, dialect="excel")
+        writer.writerow(['Genomes', 'Proteins', 'Partition'])
+        for row in histogram:
+            writer.writerow(row)
+
+# also output _all proteins_ so we can do this same analysis in the browser (or well, most of it)
+def write_all_proteins(all_file_path, all_protein_data):
+    with util.open_text(all_file_path, 'w') as csvfile:
+        print("[protein] wrote all proteins to: %s (%d proteins)" % (all_file_path, len(all_protein_data)))
+        writer = csv.DictWriter(csvfile, dialect="excel", fieldnames=['figfam', 'function', 'feature_ids', 'contig_ids'])
+        writer.writeheader()
+        for fig in all_protein_data:
+            cur_fig_data = all_protein_data[fig]
+            cur_feature_ids = ';'.join(cur_fig_data['feature_ids'])
+            cur_contig_ids = ';'.join(cur_fig_data['contig_ids'])
+            writer.writerow({
+                'figfam' : fig,
+                'function' : cur_fig_data['function'],
+                'feature_ids' : cur_feature_ids,
+                'contig_ids' : cur_contig_ids
+            })
+
+# the same as all_proteins.csv, in the binary columnar format collate_data.py reads (see protein_store.py)
+def write_all_proteins_store(all_store_file_path, all_protein_data):
+    protein_store.write_protein_store(all_store_file_path, all_protein_data)
+    print("[protein] wrote all proteins to: %s (%d proteins)" % (all_store_file_path, len(all_protein_data)))
@@ -0,0 +1,164 @@
+import array
+import numpy
+
+# compact registry of all proteins, figfam -> function, feature ids and contig ids, in place of a dict
+#  of per figfam dicts of lists of strings.
+#
+#  functions and contig ids are interned into string tables and stored as integer codes, feature ids
+#  are stored as utf-8 bytes in one buffer with an offset per feature. features are appended in any
+#  order as (figfam, contig, feature) rows and grouped by figfam, keeping the order they were added in,
+#  the first time the registry is read after adding (see group_rows), the rows of figfam i are then
+#  order[fig_offsets[i]:fig_offsets[i + 1]].
+#
+#  it reads like the dict it replaces: iterating gives the figfams in the order they were first added,
+#  registry[fig]['function'], ['feature_ids'] and ['contig_ids'] only decode what is asked for and
+#  items() decodes one figfam at a time.
+
+def intern(value, index, table):
+    code = index.get(value)
+    if code is None:
+        code = len(table)
+        index[value] = code
+        table.append(value)
+    return code
+
+class ProteinRecord:
+
+    __slots__ = ('registry', 'code')
+
+    def __init__(self, registry, code):
+        self.registry = registry
+        self.code = code
+
+    def __getitem__(self, key):
+        if key == 'function':
+            return self.registry.function_of(self.code)
+        elif key == 'feature_ids':
+            return self.registry.feature_ids_of(self.code)
+        elif key == 'contig_ids':
+            return self.registry.contig_ids_of(self.code)
+        raise KeyError(key)
+
+class ProteinRegistry:
+
+    __slots__ = (
+        'fig_index', 'figfams', 'function_index', 'functions', 'function_codes', 'contig_index', 'contigs',
+        'row_figs', 'row_contigs', 'feature_offsets', 'feature_blob', 'order', 'fig_offsets'
+    )
+
+    def __init__(self):
+        self.fig_index, self.figfams = {}, []
+        self.function_index, self.functions = {}, []
+        self.function_codes = array.array('I')
+        self.contig_index, self.contigs = {}, []
+        # one entry per feature row, in the order they were added
+        self.row_figs = array.array('I')
+        self.row_contigs = array.array('I')
+        self.feature_offsets = array.array('Q', [0])
+        self.feature_blob = bytearray()
+        # rows grouped by figfam, None until the registry is read after adding
+        self.order = None
+        self.fig_offsets = None
+
+    # the function of a figfam is the one it was first added with
+    def fig_code(self, fig, function):
+        fig_code = self.fig_index.get(fig)
+        if fig_code is None:
+            fig_code = intern(fig, self.fig_index, self.figfams)
+            self.function_codes.append(intern(function, self.function_index, self.functions))
+        return fig_code
+
+    def add(self, fig, function, contig_id, feature_ids):
+        fig_code = self.fig_code(fig, function)
+        contig_code = intern(contig_id, self.contig_index, self.contigs)
+        for feature_id in feature_ids:
+            self.feature_blob += feature_id.encode('utf-8')
+            self.feature_offsets.append(len(self.feature_blob))
+            self.row_figs.append(fig_code)
+            self.row_contigs.append(contig_code)
+        self.order = None
+
+    # appends all rows of another registry after the rows of this one, as if they were added one by one
+    #  in the order they were added to it, without decoding any feature ids
+    def extend(self, other):
+        fig_map = numpy.array([self.fig_code(fig, other.function_of(i)) for (i, fig) in enumerate(other.figfams)], dtype=numpy.uint32)
+        contig_map = numpy.array([intern(c, self.contig_index, self.contigs) for c in other.contigs], dtype=numpy.uint32)
+        base = len(self.feature_blob)
+        self.row_figs.frombytes(fig_map[numpy.asarray(other.row_figs, dtype=numpy.int64)].tobytes())
+        self.row_contigs.frombytes(contig_map[numpy.asarray(other.row_contigs, dtype=numpy.int64)].tobytes())
+        self.feature_offsets.frombytes((numpy.asarray(other.feature_offsets, dtype=numpy.uint64)[1:] + numpy.uint64(base)).tobytes())
+        self.feature_blob += other.feature_blob
+        self.order = None
+
+    def group_rows(self):
+        if self.order is not None:
+            return
+        row_figs = numpy.array(self.row_figs, dtype=numpy.uint32)
+        # mergesort is stable, rows of a figfam stay in the order they were added
+        self.order = numpy.argsort(row_figs, kind='mergesort').astype(numpy.uint32)
+        self.fig_offsets = numpy.zeros(len(self.figfams) + 1, dtype=numpy.int64)
+        self.fig_offsets[1:] = numpy.cumsum(numpy.bincount(row_figs, minlength=len(self.figfams)))
+
+    def rows_of(self, fig_code):
+        self.group_rows()
+        return self.order[self.fig_offsets[fig_code]:self.fig_offsets[fig_code + 1]].tolist()
+
+    def function_of(self, fig_code):
+        return self.functions[self.function_codes[fig_code]]
+
+    def feature_ids_of(self, fig_code):
+        (offsets, blob) = (self.feature_offsets, self.feature_blob)
+        return [blob[offsets[r]:offsets[r + 1]].decode('utf-8') for r in self.rows_of(fig_code)]
+
+    def contig_ids_of(self, fig_code):
+        (contigs, row_contigs) = (self.contigs, self.row_contigs)
+        return [contigs[row_contigs[r]] for r in self.rows_of(fig_code)]
+
+    def __len__(self):
+        return len(self.figfams)
+
+    def __iter__(self):
+        return iter(self.figfams)
+
+    def __contains__(self, fig):
+        return fig in self.fig_index
+
+    def __getitem__(self, fig):
+        return ProteinRecord(self, self.fig_index[fig])
+
+    def keys(self):
+        return iter(self.figfams)
+
+    # (figfam, {'function', 'feature_ids', 'contig_ids'}) in the order figfams were first added, the
+    #  dict of each figfam is only built when it is reached
+    def items(self):
+        for (fig_code, fig) in enumerate(self.figfams):
+            yield (fig, {
+                'function' : self.function_of(fig_code),
+                'feature_ids' : self.feature_ids_of(fig_code),
+                'contig_ids' : self.contig_ids_of(fig_code)
+            })
+
+    def values(self):
+        return (data for (fig, data) in self.items())
+
+    def total_features(self):
+        return len(self.row_figs)
+
+# a registry over columns read back from disk (see parse_cache.py), the integer columns and the feature
+#  bytes are copied over in bulk rather than added a row at a time
+def registry_from_columns(figfams, functions, function_codes, contigs, row_figs, row_contigs, feature_offsets, feature_blob):
+    registry = ProteinRegistry()
+    registry.figfams = list(figfams)
+    registry.fig_index = {fig : i for (i, fig) in enumerate(registry.figfams)}
+    registry.functions = list(functions)
+    registry.function_index = {function : i for (i, function) in enumerate(registry.functions)}
+    registry.function_codes.frombytes(function_codes)
+    registry.contigs = list(contigs)
+    registry.contig_index = {contig : i for (i, contig) in enumerate(registry.contigs)}
+    registry.row_figs.frombytes(row_figs)
+    registry.row_contigs.frombytes(row_contigs)
+    registry.feature_offsets = array.array('Q')
+    registry.feature_offsets.frombytes(feature_offsets)
+    registry.feature_blob = bytearray(feature_blob)
+    return registry
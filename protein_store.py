@@ -0,0 +1,193 @@
+import mmap
+import struct
+import numpy
+import contextlib
+
+# our utils
+import protein_registry
+
+# columnar binary store of all proteins, written by proteins.py and read by collate_data.py in place of
+#  all_proteins.csv, so no lists have to be joined into strings and split apart again.
+#
+#  every string column is a string table: uint64 offsets (one more than there are strings) followed by
+#  the utf-8 bytes of all strings. after the header come, in order:
+#
+#  figfams        - string table, one per figfam (row)
+#  functions      - string table of distinct functions, with a uint32 function code per figfam
+#  contigs        - string table of distinct contig ids, with a uint32 contig code per feature
+#  features       - string table, one per feature, the features of figfam i are the rows
+#                   feature_offsets[i] to feature_offsets[i + 1] (uint64, one more than there are figfams)
+#
+#  all integers are little endian, the file is read through a memory map and the integer columns are
+#  used in place.
+
+STORE_MAGIC = b'APS1'
+
+# magic, then: number of figfams, features, distinct functions and distinct contigs
+HEADER_FORMAT = '<4s4Q'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+def is_protein_store(path):
+    with open(path, 'rb') as f:
+        return f.read(len(STORE_MAGIC)) == STORE_MAGIC
+
+def pack_string_table(strings):
+    encoded_strings = [s.encode('utf-8') for s in strings]
+    offsets = numpy.zeros(len(encoded_strings) + 1, dtype=numpy.uint64)
+    offsets[1:] = numpy.cumsum([len(s) for s in encoded_strings], dtype=numpy.uint64)
+    return offsets.tobytes() + b''.join(encoded_strings)
+
+def write_protein_store(store_file_path, all_protein_data):
+
+    if isinstance(all_protein_data, protein_registry.ProteinRegistry):
+        write_registry_store(store_file_path, all_protein_data)
+        return
+
+    function_index, functions = {}, []
+    contig_index, contigs = {}, []
+    function_codes = numpy.zeros(len(all_protein_data), dtype=numpy.uint32)
+    feature_offsets = numpy.zeros(len(all_protein_data) + 1, dtype=numpy.uint64)
+    features = []
+    contig_codes = []
+
+    for (i, data) in enumerate(all_protein_data.values()):
+        function_codes[i] = protein_registry.intern(data['function'], function_index, functions)
+        features += data['feature_ids']
+        contig_codes += [protein_registry.intern(c, contig_index, contigs) for c in data['contig_ids']]
+        feature_offsets[i + 1] = len(features)
+
+    contig_codes = numpy.array(contig_codes, dtype=numpy.uint32)
+
+    with open(store_file_path, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, STORE_MAGIC, len(all_protein_data), len(features), len(functions), len(contigs)))
+        f.write(pack_string_table(all_protein_data))
+        f.write(pack_string_table(functions))
+        f.write(function_codes.tobytes())
+        f.write(pack_string_table(contigs))
+        f.write(contig_codes.tobytes())
+        f.write(pack_string_table(features))
+        f.write(feature_offsets.tobytes())
+
+# the same file from a protein_registry.ProteinRegistry, its columns are copied over as they are
+#  instead of being decoded into lists first
+def write_registry_store(store_file_path, registry, chunk_rows=1 << 16):
+
+    registry.group_rows()
+    order = registry.order
+    total_features = len(order)
+
+    # contig codes are renumbered in the order the contigs first occur in the figfam grouped rows,
+    #  as write_protein_store interns them
+    contig_codes = numpy.asarray(registry.row_contigs, dtype=numpy.uint32)[order]
+    (used_contigs, first_rows) = numpy.unique(contig_codes, return_index=True)
+    used_contigs = used_contigs[numpy.argsort(first_rows, kind='mergesort')]
+    contig_recode = numpy.zeros(len(registry.contigs), dtype=numpy.uint32)
+    contig_recode[used_contigs] = numpy.arange(len(used_contigs), dtype=numpy.uint32)
+    contigs = [registry.contigs[c] for c in used_contigs.tolist()]
+
+    offsets = numpy.asarray(registry.feature_offsets, dtype=numpy.uint64)
+    starts = offsets[:-1][order]
+    stops = offsets[1:][order]
+    del offsets
+    feature_table_offsets = numpy.zeros(total_features + 1, dtype=numpy.uint64)
+    feature_table_offsets[1:] = numpy.cumsum(stops - starts, dtype=numpy.uint64)
+
+    blob = numpy.frombuffer(registry.feature_blob, dtype=numpy.uint8)
+    with open(store_file_path, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, STORE_MAGIC, len(registry), total_features, len(registry.functions), len(contigs)))
+        f.write(pack_string_table(registry.figfams))
+        f.write(pack_string_table(registry.functions))
+        f.write(numpy.asarray(registry.function_codes, dtype=numpy.uint32).tobytes())
+        f.write(pack_string_table(contigs))
+        f.write(contig_recode[contig_codes].tobytes())
+        f.write(feature_table_offsets.tobytes())
+        # the bytes of the features in grouped order, gathered a chunk of rows at a time
+        for i in range(0, total_features, chunk_rows):
+            chunk_starts = starts[i:i + chunk_rows].astype(numpy.int64)
+            chunk_lengths = (stops[i:i + chunk_rows] - starts[i:i + chunk_rows]).astype(numpy.int64)
+            chunk_offsets = numpy.cumsum(chunk_lengths) - chunk_lengths
+            positions = numpy.repeat(chunk_starts - chunk_offsets, chunk_lengths) + numpy.arange(int(chunk_lengths.sum()), dtype=numpy.int64)
+            f.write(blob[positions].tobytes())
+        f.write(registry.fig_offsets.astype(numpy.uint64).tobytes())
+    del blob
+
+def decode_strings(table, start=0, stop=None):
+    (offsets, blob) = table
+    stop = len(offsets) - 1 if stop is None else stop
+    return [str(blob[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(start, stop)]
+
+# the columns of a store in the memory map buf, integer columns are numpy arrays over the map and string
+#  tables are (offsets, bytes) pairs to be decoded with decode_strings
+def map_columns(store_file_path, buf):
+
+    (magic, num_figs, num_features, num_functions, num_contigs) = struct.unpack_from(HEADER_FORMAT, buf, 0)
+    if magic != STORE_MAGIC:
+        raise Exception("%s is not a protein store, expected magic %s got %s" % (store_file_path, STORE_MAGIC, magic))
+
+    offset = HEADER_SIZE
+    def take(dtype, count):
+        nonlocal offset
+        arr = numpy.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+        offset += arr.nbytes
+        return arr
+
+    def take_string_table(count):
+        nonlocal offset
+        offsets = take(numpy.uint64, count + 1)
+        blob = memoryview(buf)[offset:offset + int(offsets[-1])]
+        offset += int(offsets[-1])
+        # plain ints index the blob faster than numpy scalars
+        return (offsets.tolist(), blob)
+
+    figfams = take_string_table(num_figs)
+    functions = take_string_table(num_functions)
+    function_codes = take(numpy.uint32, num_figs)
+    contigs = take_string_table(num_contigs)
+    contig_codes = take(numpy.uint32, num_features)
+    features = take_string_table(num_features)
+    feature_offsets = take(numpy.uint64, num_figs + 1)
+
+    return {
+        'figfams' : figfams,
+        'functions' : functions,
+        'function_codes' : function_codes,
+        'contigs' : contigs,
+        'contig_codes' : contig_codes,
+        'features' : features,
+        'feature_offsets' : feature_offsets
+    }
+
+# context manager giving the columns of a store (see map_columns), they are only valid inside the with
+#  block, the memory map is closed when it is left
+@contextlib.contextmanager
+def read_protein_store(store_file_path):
+
+    with open(store_file_path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    store = None
+    try:
+        store = map_columns(store_file_path, buf)
+        yield store
+    finally:
+        # the map can only be closed once nothing points into it
+        if store is not None:
+            for name in ['figfams', 'functions', 'contigs', 'features']:
+                store[name][1].release()
+            store.clear()
+        buf.close()
+
+# yields (figfam, function, feature ids, contig ids) for each figfam in the store, the store is decoded
+#  and closed before the first one
+def iter_proteins(store_file_path):
+    with read_protein_store(store_file_path) as store:
+        figfams = decode_strings(store['figfams'])
+        functions = decode_strings(store['functions'])
+        contigs = decode_strings(store['contigs'])
+        features = decode_strings(store['features'])
+        function_codes = store['function_codes'].tolist()
+        contig_codes = store['contig_codes'].tolist()
+        feature_offsets = store['feature_offsets'].tolist()
+    for (i, fig) in enumerate(figfams):
+        (start, stop) = (feature_offsets[i], feature_offsets[i + 1])
+        yield (fig, functions[function_codes[i]], features[start:stop], [contigs[c] for c in contig_codes[start:stop]])
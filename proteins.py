@@ -1,218 +1,265 @@
 import os
-import csv
 import argparse
+import numpy
 
 # our utils
 import util
-
-# contig id may look like 58282 but also 28582_5929_etc
-def get_leading_id(s):
-    return s.split("_", 1)[0]
-
-parser = argparse.ArgumentParser(description='Calculates proteins common to all genomes in directory, outputting a spreadsheet for the proteins common to all genomes and a spreadsheet which holds all the proteins unique to each genome, marked with which genome to which they are unique, if any.')
-parser.add_argument(
-    'directory', type=str, default=os.getcwd(), nargs="?",
-    help='the directory with the csv files of the genomes in it (defaults to current directory)'
-)
-
-args = parser.parse_args()
-cur_dir = os.getcwd()
-
-# first collect all proteins associated with each file
-all_genome_ids = {}
-all_protein_data = {}
-skipped_entries_with_figs = 0
-skipped_entries = 0
-total_entries = 0
-
-os.chdir(args.directory)
-csv_files = util.get_files_in_folder_with_ext(".csv")
-
-
-data_files = []
-for entry in csv_files:
-    with open(entry) as csvfile:
-
-        def has_valid_figfam_id(p):
-            return 'figfam' in p and not p['figfam'].isspace() and not p['figfam'] == ""
-
-        def is_hypothetical_protein(p):
-            return 'hypothetical' in p['function']
-
-        reader = csv.DictReader(csvfile)
-        proteins = set() # to automatically eliminate duplicates
-        have_fetched_contig_id = False
-        contig_id = -1
-
-        for row in reader:
-
-            # keep track of total number of entries
-            total_entries += 1
-            if not have_fetched_contig_id:
-                have_fetched_contig_id = True
-                contig_id = get_leading_id(row['contig_id'])
-
-            # we only care about the row if it has a figfam entry, and it is nonempty
-            if has_valid_figfam_id(row):
-
-                if is_hypothetical_protein(row):
-                    skipped_entries_with_figs +=1
-                    continue
-
-                fig = row['figfam']
-                proteins.add(fig)
-                # registry of proteins in set
-                if fig in all_protein_data:
-                    all_protein_data[fig]['feature_ids'].append(row['feature_id'])
-                    all_protein_data[fig]['contig_ids'].append(contig_id)
-                else:
-                    all_protein_data[fig] = {
-                        'function' : row['function'],
-                        'feature_ids' : [row['feature_id']],
-                        'contig_ids' : [contig_id]
-                    }
-            else:
-                skipped_entries += 1
-
-        if contig_id in all_genome_ids:
-            prev_file_name = all_genome_ids[contig_id]['file_name']
-            raise Exception("found duplicate id: %s in %s, previously encountered in file: %s" % (contig_id, entry, prev_file_name))
+import ingest
+import presence
+import parse_cache
+import protein_outputs
+
+# proteins common to all genomes, unique to each genome and the pan genome partitions of a directory of
+#  genome csv files. load_genomes, analyse_proteins and write_protein_outputs can be used from other
+#  scripts in the same process, they take and return plain dicts and lists, the command line below
+#  only strings them together.
+
+DEFAULT_CORE_THRESHOLD = 0.99
+DEFAULT_SOFT_CORE_THRESHOLD = 0.95
+DEFAULT_SHELL_THRESHOLD = 0.15
+
+# parses the csv files in directory (in worker processes when jobs > 1, through the cache when cache_dir
+#  is given), also .csv.gz and .csv.xz files and with recursive those in the directories below it, file
+#  names are kept relative to directory
+def load_genomes(directory, jobs=1, cache_dir=None, metrics=None, recursive=False):
+    metrics = metrics if metrics is not None else util.Metrics('protein')
+    csv_files = util.get_files_in_folder_with_ext(".csv", directory, recursive=recursive, compressed=True)
+    csv_paths = [os.path.join(directory, f) for f in csv_files]
+    with metrics.phase('ingest') as phase:
+        if cache_dir is not None:
+            parsed_files = parse_cache.parse_genome_csvs_cached(csv_paths, cache_dir, jobs=jobs)
         else:
-            all_genome_ids[contig_id] = {'file_name' : entry}
-            data_files.append({'file_name' : entry, 'contig_id' : contig_id, 'proteins' : proteins})
-
-# check that our data is now nonempty, else there were no data files in directory
-if len(data_files) == 0:
-    raise Exception("expected at least one data file in %s to read from! got none." % args.directory)
-
-# if output directory does not exist, create it
-util.create_output_directory_if_not_exists(cur_dir)
-
-# accumulate all proteins into a big list first
-all_proteins = []
-for data in data_files:
-    only_proteins = data['proteins']
-    all_proteins.append(only_proteins)
-
-# calculate how many unique proteins exist in total (not ones unique to each genome but overall)
-all_unique_proteins = set.union(*all_proteins)
-
-# calculate the intersection of the sets of proteins, gives us all which are common
-all_common_proteins = set.intersection(*all_proteins)
-
-percentage_skipped = (skipped_entries / total_entries) * 100
-percentage_skipped_with_figs = (skipped_entries_with_figs / total_entries) * 100
-total_entries_skipped = skipped_entries + skipped_entries_with_figs
-total_percentage_skipped = percentage_skipped_with_figs + percentage_skipped
-print("[protein] skipped entries (no figs): %d (%d %% of total)" % (skipped_entries, percentage_skipped))
-print("[protein] skipped entries (hypotheticals with figs): %d (%d %% of total)" % (skipped_entries_with_figs, percentage_skipped_with_figs))
-print("[protein] total skipped entries: %d (%d %% of total)" % (total_entries_skipped, total_percentage_skipped))
-print("[protein] total unique proteins: %d" % (len(all_unique_proteins)))
-print("[protein] total common proteins: %d" % (len(all_common_proteins)))
-
-# calculate and present the proteins which are unique to each genome, and to which
-unique_proteins = {}
-for e_cur in data_files:
-    cur_proteins = e_cur['proteins']
-    all_except_cur = [e['proteins'] for e in data_files if e != e_cur]
-    cur_unique_proteins = cur_proteins.difference(*all_except_cur)
-    cur_contig_id = e_cur['contig_id']
-    unique_proteins[e_cur['file_name']] = (cur_contig_id, cur_unique_proteins)
-
-for (file_name, (contig_id, proteins)) in unique_proteins.items():
-    print("[protein] file %s (id: %s) has %d unique proteins" % (file_name, contig_id, len(proteins)))
-
-# format and output the data
-
-# first all genes common to all the datasets passed in
-common_file_path = os.path.join(cur_dir, 'output/common_proteins.csv')
-with open(common_file_path, 'w') as csvfile:
-    print("[protein] wrote common proteins to: %s" % common_file_path)
-    writer = csv.DictWriter(csvfile, fieldnames=['figfam', 'function'], dialect="excel")
-    writer.writeheader()
-    for fig in all_common_proteins:
-        cur_fig_data = all_protein_data[fig]
-        writer.writerow(
-            {
-                'figfam' : fig,
-                'function' : cur_fig_data['function']
-            }
+            parsed_files = ingest.parse_genome_csvs(csv_paths, jobs=jobs)
+        for (result, file_name) in zip(parsed_files, csv_files):
+            result['file_name'] = file_name
+        phase['rows'] = sum(result['total_entries'] for result in parsed_files)
+        phase['bytes'] = sum(os.path.getsize(path) for path in csv_paths)
+    return parsed_files
+
+# takes the parsed genomes from load_genomes (or ingest.parse_genome_csvs), returns everything the
+#  spreadsheets are written from. the per file protein records are moved into all_protein_data (a
+#  protein_registry.ProteinRegistry), so parsed_files can only be analysed once
+def analyse_proteins(parsed_files, core_threshold=DEFAULT_CORE_THRESHOLD, soft_core_threshold=DEFAULT_SOFT_CORE_THRESHOLD, shell_threshold=DEFAULT_SHELL_THRESHOLD, metrics=None):
+
+    metrics = metrics if metrics is not None else util.Metrics('protein')
+
+    # merge the per file results in order
+    merged_data = ingest.merge_genome_results(parsed_files)
+
+    all_protein_data = merged_data['all_protein_data']
+    data_files = merged_data['data_files']
+    skipped_entries_with_figs = merged_data['skipped_entries_with_figs']
+    skipped_entries = merged_data['skipped_entries']
+    total_entries = merged_data['total_entries']
+
+    # check that our data is nonempty
+    if len(data_files) == 0:
+        raise Exception("expected at least one genome to analyse! got none.")
+
+    with metrics.phase('set algebra') as phase:
+
+        # intern figfams and build the genome x figfam presence matrix, common, unique and overall
+        #  sets then all fall out of the per figfam genome counts in one pass
+        fig_index, fig_list = presence.intern_figfams(all_protein_data)
+        presence_matrix = presence.build_presence_matrix([data['proteins'] for data in data_files], fig_index)
+        fig_genome_counts = presence.genome_counts(presence_matrix)
+        (common_idx, unique_idx, unique_owners, union_idx) = presence.common_unique_union(presence_matrix, len(data_files), fig_genome_counts)
+
+        # core/soft core/shell/cloud partitions and the histogram of in how many genomes each figfam is
+        total_genomes = len(data_files)
+        fig_partitions = presence.partition_by_frequency(
+            fig_genome_counts, total_genomes, core_threshold, soft_core_threshold, shell_threshold
+        )
+        partition_sizes = numpy.bincount(fig_partitions, minlength=len(presence.PARTITIONS))
+        histogram_counts = presence.frequency_histogram(fig_genome_counts, total_genomes)
+        histogram_partitions = presence.partition_by_frequency(
+            numpy.arange(total_genomes + 1), total_genomes, core_threshold, soft_core_threshold, shell_threshold
         )
+        phase['rows'] = len(fig_list)
+        phase['bytes'] = presence_matrix.nbytes
+
+    metrics.count('genomes', total_genomes)
+    metrics.count('proteins', len(fig_list))
+    metrics.count('features', all_protein_data.total_features())
+    metrics.count('common_proteins', len(common_idx))
+    metrics.count('skipped_entries', skipped_entries)
+    metrics.count('skipped_entries_with_figs', skipped_entries_with_figs)
+
+    # calculate how many unique proteins exist in total (not ones unique to each genome but overall)
+    all_unique_proteins = [fig_list[i] for i in union_idx]
+
+    # the figfams present in every genome, gives us all which are common
+    all_common_proteins = [fig_list[i] for i in common_idx]
+
+    # files without any rows have nothing to skip
+    percentage_skipped = (skipped_entries / total_entries) * 100 if total_entries > 0 else 0.0
+    percentage_skipped_with_figs = (skipped_entries_with_figs / total_entries) * 100 if total_entries > 0 else 0.0
+    total_entries_skipped = skipped_entries + skipped_entries_with_figs
+    total_percentage_skipped = percentage_skipped_with_figs + percentage_skipped
+    print("[protein] skipped entries (no figs): %d (%d %% of total)" % (skipped_entries, percentage_skipped))
+    print("[protein] skipped entries (hypotheticals with figs): %d (%d %% of total)" % (skipped_entries_with_figs, percentage_skipped_with_figs))
+    print("[protein] total skipped entries: %d (%d %% of total)" % (total_entries_skipped, total_percentage_skipped))
+    print("[protein] total unique proteins: %d" % (len(all_unique_proteins)))
+    print("[protein] total common proteins: %d" % (len(all_common_proteins)))
+    for (partition, size) in zip(presence.PARTITIONS, partition_sizes.tolist()):
+        print("[protein] total %s proteins: %d" % (partition, size))
+
+    # calculate and present the proteins which are unique to each genome, and to which
+    unique_proteins = {}
+    for e_cur in data_files:
+        unique_proteins[e_cur['file_name']] = (e_cur['contig_id'], [])
+    for (i, owner) in zip(unique_idx, unique_owners):
+        (_, cur_unique_proteins) = unique_proteins[data_files[owner]['file_name']]
+        cur_unique_proteins.append(fig_list[i])
 
-# then a sheet with all that are unique
-unique_file_path = os.path.join(cur_dir, 'output/unique_proteins.csv')
-with open(unique_file_path, 'w') as csvfile:
-    print("[protein] wrote unique proteins to: %s" % unique_file_path)
-    writer = csv.DictWriter(csvfile, fieldnames=['file_name', 'contig_id', 'figfam', 'function'], dialect="excel")
-    writer.writeheader()
-    for (file_name, (contig_id, proteins)) in unique_proteins.items():
-        for fig in proteins:
-            cur_fig_data = all_protein_data[fig]
-            writer.writerow(
-                {
-                    'file_name' : file_name,
-                    'contig_id' : contig_id,
-                    'figfam' : fig,
-                    'function' : cur_fig_data['function']
-                }
-            )
-
-# number of nonempty sets
-nonempty_unique_protein_sets = 0
-for (file_name, (contig_id, proteins)) in unique_proteins.items():
-    if len(proteins) > 0: nonempty_unique_protein_sets += 1
-
-# write in column form
-unique_column_file_path = os.path.join(cur_dir, 'output/unique_column_proteins.csv')
-with open(unique_column_file_path, 'w') as csvfile:
-    print("[protein] wrote unique proteins to: %s" % unique_column_file_path)
-    writer = csv.writer(csvfile, dialect="excel")
-    writer.writerow(['file_name', 'contig_id', 'figfam', 'function', ''] * nonempty_unique_protein_sets)
-    data_to_write = []
-    cur_column = 0
-    for (file_name, (contig_id, proteins)) in unique_proteins.items():
-        cur_row = 0
-        # nothing to write
-        if len(proteins) == 0: continue
-        for fig in proteins:
-            if cur_row >= len(data_to_write): data_to_write.append([])
-            cur_fig_data = all_protein_data[fig]
-            cur_row_len = len(data_to_write[cur_row])
-            if cur_row_len != cur_column * 5:
-                needed_padding = (cur_column * 5) - cur_row_len
-                data_to_write[cur_row] += [''] * needed_padding
-            data_to_write[cur_row] += [file_name, contig_id, fig, cur_fig_data['function'], '']
-            cur_row += 1
-        cur_column += 1
-    # finally write the data
-    for row in data_to_write:
-        writer.writerow(row)
-
-# output a sheet with the stats also shown in console
-stats_file_path = os.path.join(cur_dir, 'output/output_stats.csv')
-with open(stats_file_path, 'w') as csvfile:
-    print("[protein] wrote output stats to: %s" % stats_file_path)
-    writer = csv.writer(csvfile, dialect="excel")
-    writer.writerow(['Total Different Proteins', len(all_unique_proteins)])
-    writer.writerow(['Total Common Proteins', len(all_common_proteins)])
-    writer.writerow(['Total % of Discarded Proteins', percentage_skipped])
-    writer.writerow(['Filename', 'Genome', 'Unique Proteins'])
     for (file_name, (contig_id, proteins)) in unique_proteins.items():
-        writer.writerow([file_name, contig_id, len(proteins)])
-
-# also output _all proteins_ so we can do this same analysis in the browser (or well, most of it)
-all_file_path = os.path.join(cur_dir, 'output/all_proteins.csv')
-with open(all_file_path, 'w') as csvfile:
-    print("[protein] wrote all proteins to: %s (%d proteins)" % (all_file_path, len(all_protein_data)))
-    writer = csv.DictWriter(csvfile, dialect="excel", fieldnames=['figfam', 'function', 'feature_ids', 'contig_ids'])
-    writer.writeheader()
-    for fig in all_protein_data:
-        cur_fig_data = all_protein_data[fig]
-        cur_feature_ids = ';'.join(cur_fig_data['feature_ids'])
-        cur_contig_ids = ';'.join(cur_fig_data['contig_ids'])
-        writer.writerow({
-            'figfam' : fig,
-            'function' : cur_fig_data['function'],
-            'feature_ids' : cur_feature_ids,
-            'contig_ids' : cur_contig_ids
-        })
+        print("[protein] file %s (id: %s) has %d unique proteins" % (file_name, contig_id, len(proteins)))
+
+    return {
+        'all_genome_ids' : merged_data['all_genome_ids'],
+        'all_protein_data' : all_protein_data,
+        'data_files' : data_files,
+        'total_genomes' : total_genomes,
+        'all_common_proteins' : all_common_proteins,
+        'all_unique_proteins' : all_unique_proteins,
+        'unique_proteins' : unique_proteins,
+        'fig_list' : fig_list,
+        'fig_genome_counts' : fig_genome_counts,
+        'fig_partitions' : fig_partitions,
+        'partition_sizes' : partition_sizes,
+        'histogram_counts' : histogram_counts,
+        'histogram_partitions' : histogram_partitions,
+        'total_entries' : total_entries,
+        'skipped_entries' : skipped_entries,
+        'skipped_entries_with_figs' : skipped_entries_with_figs,
+        'percentage_skipped' : percentage_skipped
+    }
+
+def write_protein_outputs(analysis, output_dir, export_csv=False, metrics=None, compression=None):
+
+    metrics = metrics if metrics is not None else util.Metrics('protein')
+    all_protein_data = analysis['all_protein_data']
+    unique_proteins = analysis['unique_proteins']
+    fig_list = analysis['fig_list']
+    total_genomes = analysis['total_genomes']
+    total_unique = sum(len(proteins) for (contig_id, proteins) in unique_proteins.values())
+
+    output_file_path = util.compressed_path(os.path.join(output_dir, 'common_proteins.csv'), compression)
+    with metrics.phase('write common_proteins.csv', output=output_file_path) as phase:
+        protein_outputs.write_common_proteins(output_file_path, analysis['all_common_proteins'], all_protein_data)
+        phase['rows'] = len(analysis['all_common_proteins'])
+
+    output_file_path = util.compressed_path(os.path.join(output_dir, 'unique_proteins.csv'), compression)
+    with metrics.phase('write unique_proteins.csv', output=output_file_path) as phase:
+        protein_outputs.write_unique_proteins(output_file_path, unique_proteins, all_protein_data)
+        phase['rows'] = total_unique
+
+    output_file_path = util.compressed_path(os.path.join(output_dir, 'unique_column_proteins.csv'), compression)
+    with metrics.phase('write unique_column_proteins.csv', output=output_file_path) as phase:
+        protein_outputs.write_unique_column_proteins(output_file_path, unique_proteins, all_protein_data)
+        phase['rows'] = total_unique
+
+    output_file_path = util.compressed_path(os.path.join(output_dir, 'output_stats.csv'), compression)
+    with metrics.phase('write output_stats.csv', output=output_file_path) as phase:
+        protein_outputs.write_output_stats(
+            output_file_path, len(analysis['all_unique_proteins']), len(analysis['all_common_proteins']),
+            analysis['percentage_skipped'], unique_proteins
+        )
+        phase['rows'] = len(unique_proteins)
+
+    output_file_path = util.compressed_path(os.path.join(output_dir, 'partitions.csv'), compression)
+    with metrics.phase('write partitions.csv', output=output_file_path) as phase:
+        protein_outputs.write_partitions(
+            output_file_path,
+            zip(fig_list, analysis['fig_genome_counts'].tolist(), [presence.PARTITIONS[p] for p in analysis['fig_partitions']]),
+            total_genomes, all_protein_data
+        )
+        phase['rows'] = len(fig_list)
+
+    # genome count 0 never happens, every figfam comes from at least one genome
+    histogram_counts = analysis['histogram_counts']
+    histogram_partitions = analysis['histogram_partitions']
+    output_file_path = util.compressed_path(os.path.join(output_dir, 'frequency_histogram.csv'), compression)
+    with metrics.phase('write frequency_histogram.csv', output=output_file_path) as phase:
+        protein_outputs.write_frequency_histogram(
+            output_file_path,
+            [(n, histogram_counts[n], presence.PARTITIONS[histogram_partitions[n]]) for n in range(1, total_genomes + 1)]
+        )
+        phase['rows'] = total_genomes
+
+    output_file_path = os.path.join(output_dir, 'all_proteins.bin')
+    with metrics.phase('write all_proteins.bin', output=output_file_path) as phase:
+        protein_outputs.write_all_proteins_store(output_file_path, all_protein_data)
+        phase['rows'] = len(all_protein_data)
+
+    if export_csv:
+        output_file_path = util.compressed_path(os.path.join(output_dir, 'all_proteins.csv'), compression)
+        with metrics.phase('write all_proteins.csv', output=output_file_path) as phase:
+            protein_outputs.write_all_proteins(output_file_path, all_protein_data)
+            phase['rows'] = len(all_protein_data)
+
+def add_partition_arguments(parser):
+    parser.add_argument(
+        '--core-threshold', metavar='core_threshold', type=float, default=DEFAULT_CORE_THRESHOLD,
+        help='fraction of genomes a protein has to be in to be part of the core genome (defaults to %.2f)' % DEFAULT_CORE_THRESHOLD
+    )
+    parser.add_argument(
+        '--soft-core-threshold', metavar='soft_core_threshold', type=float, default=DEFAULT_SOFT_CORE_THRESHOLD,
+        help='fraction of genomes a protein has to be in to be part of the soft core genome (defaults to %.2f)' % DEFAULT_SOFT_CORE_THRESHOLD
+    )
+    parser.add_argument(
+        '--shell-threshold', metavar='shell_threshold', type=float, default=DEFAULT_SHELL_THRESHOLD,
+        help='fraction of genomes a protein has to be in to be part of the shell genome, the rest is cloud (defaults to %.2f)' % DEFAULT_SHELL_THRESHOLD
+    )
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Calculates proteins common to all genomes in directory, outputting a spreadsheet for the proteins common to all genomes and a spreadsheet which holds all the proteins unique to each genome, marked with which genome to which they are unique, if any.')
+    parser.add_argument(
+        'directory', type=str, default=os.getcwd(), nargs="?",
+        help='the directory with the csv files of the genomes in it (defaults to current directory)'
+    )
+    parser.add_argument(
+        '--jobs', metavar='jobs', type=int, default=1,
+        help='number of worker processes to parse the csv files with (defaults to 1, no worker processes)'
+    )
+    parser.add_argument(
+        '--cache-dir', metavar='cache_dir', type=str, default=None,
+        help='directory to cache parsed csv files in, only new or changed files are parsed on reruns (defaults to no cache)'
+    )
+    parser.add_argument(
+        '--recursive', default=False, action='store_true',
+        help='also read the csv files in the directories below directory'
+    )
+    add_partition_arguments(parser)
+
+    parser.add_argument(
+        '--export-csv', default=False, action='store_true',
+        help='also write all proteins as output/all_proteins.csv, next to the binary output/all_proteins.bin collate_data.py reads'
+    )
+    util.add_compression_arguments(parser)
+    util.add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    if not (0.0 <= args.shell_threshold <= args.soft_core_threshold <= args.core_threshold <= 1.0):
+        parser.error("expected 0 <= --shell-threshold <= --soft-core-threshold <= --core-threshold <= 1")
+    cur_dir = os.getcwd()
+    cache_dir = os.path.join(cur_dir, args.cache_dir) if args.cache_dir is not None else None
+    metrics = util.create_metrics('protein', args, cur_dir)
+
+    # first collect all proteins associated with each file
+    parsed_files = load_genomes(args.directory, jobs=args.jobs, cache_dir=cache_dir, metrics=metrics, recursive=args.recursive)
+
+    # check that our data is now nonempty, else there were no data files in directory
+    if len(parsed_files) == 0:
+        raise Exception("expected at least one data file in %s to read from! got none." % args.directory)
+
+    analysis = analyse_proteins(parsed_files, args.core_threshold, args.soft_core_threshold, args.shell_threshold, metrics=metrics)
+
+    # if output directory does not exist, create it
+    util.create_output_directory_if_not_exists(cur_dir)
+
+    # format and output the data
+    write_protein_outputs(analysis, os.path.join(cur_dir, 'output'), export_csv=args.export_csv, metrics=metrics, compression=args.compress)
+
+    metrics.write_report()
@@ -0,0 +1,397 @@
+import os
+import csv
+import time
+import sqlite3
+import argparse
+import numpy
+
+# our utils
+import util
+import ingest
+import proteins
+
+# optional sqlite database of the genomes, figfams, features and subsystem annotations, for questions
+#  the spreadsheets do not answer, ie. "which figfams in subsystem X are in genomes A and B but not C",
+#  without rerunning proteins.py and collate_data.py.
+#
+#  the classification rows are parsed as for proteins.py (only features with a figfam which are not
+#  hypothetical proteins), and the subsystem tables are joined onto them per feature, a row applies to
+#  every feature it lists that is in the database. the tables are:
+#
+#  genomes         - id, contig_id, file_name
+#  functions       - id, name
+#  figfams         - id, figfam, function_id (the function of its first feature, as in proteins.py)
+#  features        - id, feature_id, figfam_id, genome_id
+#  genome_figfams  - figfam_id, genome_id, number of features of the figfam in the genome
+#  categories, subcategories, subsystems, roles
+#                  - id, name and the id of the parent (category_id, subcategory_id, subsystem_id)
+#  feature_roles   - feature id, role id, one per feature and role annotated on it
+#  figfam_roles    - figfam id, role id, one per figfam and role annotated on any of its features
+#
+#  role_paths is a view of the full category/subcategory/subsystem/role path of every role. there are
+#  indexes on figfam, contig id, feature id and the names of every hierarchy level, presence questions
+#  are answered from genome_figfams and hierarchy questions from figfam_roles.
+
+HIERARCHY_LEVELS = ['category', 'subcategory', 'subsystem', 'role']
+
+SCHEMA = """
+CREATE TABLE genomes (id INTEGER PRIMARY KEY, contig_id TEXT NOT NULL UNIQUE, file_name TEXT);
+CREATE TABLE functions (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE figfams (id INTEGER PRIMARY KEY, figfam TEXT NOT NULL UNIQUE, function_id INTEGER NOT NULL REFERENCES functions(id));
+CREATE TABLE features (id INTEGER PRIMARY KEY, feature_id TEXT NOT NULL, figfam_id INTEGER NOT NULL REFERENCES figfams(id), genome_id INTEGER NOT NULL REFERENCES genomes(id));
+CREATE TABLE genome_figfams (figfam_id INTEGER NOT NULL, genome_id INTEGER NOT NULL, features INTEGER NOT NULL, PRIMARY KEY (figfam_id, genome_id)) WITHOUT ROWID;
+CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE subcategories (id INTEGER PRIMARY KEY, category_id INTEGER NOT NULL REFERENCES categories(id), name TEXT NOT NULL, UNIQUE (category_id, name));
+CREATE TABLE subsystems (id INTEGER PRIMARY KEY, subcategory_id INTEGER NOT NULL REFERENCES subcategories(id), name TEXT NOT NULL, UNIQUE (subcategory_id, name));
+CREATE TABLE roles (id INTEGER PRIMARY KEY, subsystem_id INTEGER NOT NULL REFERENCES subsystems(id), name TEXT NOT NULL, UNIQUE (subsystem_id, name));
+CREATE TABLE feature_roles (feature_id INTEGER NOT NULL, role_id INTEGER NOT NULL, PRIMARY KEY (feature_id, role_id)) WITHOUT ROWID;
+CREATE TABLE figfam_roles (figfam_id INTEGER NOT NULL, role_id INTEGER NOT NULL, PRIMARY KEY (figfam_id, role_id)) WITHOUT ROWID;
+CREATE VIEW role_paths AS
+    SELECT r.id AS role_id, c.name AS category, sc.name AS subcategory, s.name AS subsystem, r.name AS role
+    FROM roles r
+    JOIN subsystems s ON s.id = r.subsystem_id
+    JOIN subcategories sc ON sc.id = s.subcategory_id
+    JOIN categories c ON c.id = sc.category_id;
+"""
+
+# created once the tables are loaded, bulk inserts are faster without them
+INDEXES = """
+CREATE INDEX features_figfam ON features (figfam_id, genome_id);
+CREATE INDEX features_genome ON features (genome_id);
+CREATE INDEX genome_figfams_genome ON genome_figfams (genome_id, figfam_id);
+CREATE INDEX subcategories_name ON subcategories (name);
+CREATE INDEX subsystems_name ON subsystems (name);
+CREATE INDEX roles_name ON roles (name);
+CREATE INDEX figfam_roles_role ON figfam_roles (role_id, figfam_id);
+CREATE INDEX feature_roles_role ON feature_roles (role_id);
+"""
+
+def intern_node(nodes, key, insert):
+    node_id = nodes.get(key)
+    if node_id is None:
+        node_id = len(nodes) + 1
+        nodes[key] = node_id
+        insert(node_id)
+    return node_id
+
+def load_proteins(conn, merged_data, chunk_rows=1 << 16):
+
+    registry = merged_data['all_protein_data']
+    file_names = {data['contig_id'] : data['file_name'] for data in merged_data['data_files']}
+
+    # registry codes + 1 are the row ids
+    conn.executemany("INSERT INTO genomes VALUES (?, ?, ?)", (
+        (i + 1, contig_id, file_names.get(contig_id)) for (i, contig_id) in enumerate(registry.contigs)
+    ))
+    conn.executemany("INSERT INTO functions VALUES (?, ?)", ((i + 1, name) for (i, name) in enumerate(registry.functions)))
+    conn.executemany("INSERT INTO figfams VALUES (?, ?, ?)", (
+        (i + 1, fig, registry.function_codes[i] + 1) for (i, fig) in enumerate(registry.figfams)
+    ))
+
+    (offsets, blob) = (registry.feature_offsets, registry.feature_blob)
+    (row_figs, row_contigs) = (registry.row_figs, registry.row_contigs)
+    total_features = registry.total_features()
+    for start in range(0, total_features, chunk_rows):
+        conn.executemany("INSERT INTO features VALUES (?, ?, ?, ?)", (
+            (r + 1, blob[offsets[r]:offsets[r + 1]].decode('utf-8'), row_figs[r] + 1, row_contigs[r] + 1)
+            for r in range(start, min(start + chunk_rows, total_features))
+        ))
+
+    # number of features of every figfam in every genome it is in
+    pairs = numpy.asarray(row_figs, dtype=numpy.int64) * len(registry.contigs) + numpy.asarray(row_contigs, dtype=numpy.int64)
+    (pairs, counts) = numpy.unique(pairs, return_counts=True)
+    conn.executemany("INSERT INTO genome_figfams VALUES (?, ?, ?)", (
+        (fig + 1, contig + 1, count) for (fig, contig, count) in zip(
+            (pairs // len(registry.contigs)).tolist(), (pairs % len(registry.contigs)).tolist(), counts.tolist()
+        )
+    ))
+
+    return total_features
+
+def load_subsystems(conn, subsystems_dir, recursive=False):
+
+    conn.execute("CREATE TEMP TABLE subsystem_rows (row_id INTEGER NOT NULL, role_id INTEGER NOT NULL, feature_id TEXT NOT NULL)")
+
+    nodes = [{}, {}, {}, {}]
+    insert_node = [
+        lambda key: lambda i: conn.execute("INSERT INTO categories VALUES (?, ?)", (i, key[0])),
+        lambda key: lambda i: conn.execute("INSERT INTO subcategories VALUES (?, ?, ?)", (i, nodes[0][key[:1]], key[1])),
+        lambda key: lambda i: conn.execute("INSERT INTO subsystems VALUES (?, ?, ?)", (i, nodes[1][key[:2]], key[2])),
+        lambda key: lambda i: conn.execute("INSERT INTO roles VALUES (?, ?, ?)", (i, nodes[2][key[:3]], key[3]))
+    ]
+
+    # sorted, as collate_data.py reads them
+    tsv_files = sorted(util.get_files_in_folder_with_ext(".tsv", subsystems_dir, recursive=recursive, compressed=True))
+    total_rows = 0
+    for file_name in tsv_files:
+        rows = []
+        with util.open_text(os.path.join(subsystems_dir, file_name), 'r') as tsvfile:
+            for row in csv.DictReader(tsvfile, delimiter='\t'):
+                path = (row['Category'], row['Subcategory'], row['Subsystem'], row['Role'])
+                for depth in range(len(HIERARCHY_LEVELS)):
+                    role_id = intern_node(nodes[depth], path[:depth + 1], insert_node[depth](path[:depth + 1]))
+                total_rows += 1
+                rows += [(total_rows, role_id, f.strip()) for f in row['Features'].split(",")]
+        conn.executemany("INSERT INTO subsystem_rows VALUES (?, ?, ?)", rows)
+
+    # a row applies to every feature it lists which is in the database, rows with none are skipped
+    conn.execute("""
+        INSERT OR IGNORE INTO feature_roles
+        SELECT f.id, s.role_id FROM subsystem_rows s JOIN features f ON f.feature_id = s.feature_id
+    """)
+    (processed_rows,) = conn.execute("""
+        SELECT COUNT(DISTINCT s.row_id) FROM subsystem_rows s JOIN features f ON f.feature_id = s.feature_id
+    """).fetchone()
+    conn.execute("""
+        INSERT OR IGNORE INTO figfam_roles
+        SELECT DISTINCT f.figfam_id, fr.role_id FROM feature_roles fr JOIN features f ON f.id = fr.feature_id
+    """)
+    conn.execute("DROP TABLE subsystem_rows")
+
+    return {'files' : len(tsv_files), 'processed_rows' : processed_rows, 'skipped_rows' : total_rows - processed_rows}
+
+# builds the database at db_path from the parsed genomes (see proteins.load_genomes) and the subsystem
+#  tables in subsystems_dir, replacing any database there once it is complete
+def build_store(db_path, parsed_files, subsystems_dir, metrics=None, recursive=False):
+
+    metrics = metrics if metrics is not None else util.Metrics('query_store')
+    merged_data = ingest.merge_genome_results(parsed_files)
+
+    tmp_path = db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        # nothing to recover if the build fails half way, the temporary file is just built again
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.executescript(SCHEMA)
+
+        with metrics.phase('load features') as phase:
+            phase['rows'] = load_proteins(conn, merged_data)
+        with metrics.phase('index features'):
+            conn.execute("CREATE INDEX features_feature_id ON features (feature_id)")
+        with metrics.phase('load subsystems') as phase:
+            totals = load_subsystems(conn, subsystems_dir, recursive=recursive)
+            phase['rows'] = totals['processed_rows'] + totals['skipped_rows']
+        with metrics.phase('index'):
+            conn.executescript(INDEXES)
+            conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, db_path)
+
+    print("[query_store] loaded %d genomes, %d figfams and %d features" % (
+        len(merged_data['data_files']), len(merged_data['all_protein_data']), merged_data['all_protein_data'].total_features()
+    ))
+    print("[query_store] joined %d subsystem rows from %d files, skipped %d rows with no features in any figfam" % (
+        totals['processed_rows'], totals['files'], totals['skipped_rows']
+    ))
+    return totals
+
+def open_store(db_path):
+    if not os.path.exists(db_path):
+        raise Exception("no query store at: %s, build it with: python query_store.py build" % db_path)
+    return sqlite3.connect(db_path)
+
+# genome ids of contig ids or file names
+def genome_ids(conn, genomes):
+    ids = []
+    for genome in genomes:
+        row = conn.execute("SELECT id FROM genomes WHERE contig_id = ? OR file_name = ?", (genome, genome)).fetchone()
+        if row is None:
+            raise Exception("no genome with id or file name: %s in query store" % genome)
+        ids.append(row[0])
+    return ids
+
+# condition on the role_paths view for a hierarchy filter, level name -> value
+def hierarchy_condition(hierarchy):
+    unknown_levels = [level for level in hierarchy if level not in HIERARCHY_LEVELS]
+    if len(unknown_levels) > 0:
+        raise Exception("unknown hierarchy levels: %s, expected any of: %s" % (", ".join(unknown_levels), ", ".join(HIERARCHY_LEVELS)))
+    levels = [level for level in HIERARCHY_LEVELS if hierarchy.get(level) is not None]
+    return (" AND ".join("%s = ?" % level for level in levels), [hierarchy[level] for level in levels])
+
+# (figfam, function) of the figfams present in every genome in present, in none in absent and annotated
+#  with a role under the hierarchy filter (ie. {'subsystem' : 'X'}), sorted by figfam
+def figfams_matching(conn, present=(), absent=(), hierarchy=None):
+    conditions = []
+    params = []
+    present_ids = genome_ids(conn, present)
+    absent_ids = genome_ids(conn, absent)
+    if len(present_ids) > 0:
+        conditions.append("f.id IN (SELECT figfam_id FROM genome_figfams WHERE genome_id IN (%s) GROUP BY figfam_id HAVING COUNT(*) = ?)" % ", ".join("?" * len(present_ids)))
+        params += present_ids + [len(present_ids)]
+    if len(absent_ids) > 0:
+        conditions.append("f.id NOT IN (SELECT figfam_id FROM genome_figfams WHERE genome_id IN (%s))" % ", ".join("?" * len(absent_ids)))
+        params += absent_ids
+    if hierarchy:
+        (condition, values) = hierarchy_condition(hierarchy)
+        if condition:
+            conditions.append("f.id IN (SELECT figfam_id FROM figfam_roles WHERE role_id IN (SELECT role_id FROM role_paths WHERE %s))" % condition)
+            params += values
+    query = "SELECT f.figfam, fn.name FROM figfams f JOIN functions fn ON fn.id = f.function_id"
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+    return conn.execute(query + " ORDER BY f.figfam", params).fetchall()
+
+# (contig id, file name, number of features) of the genomes a figfam is in
+def figfam_genomes(conn, figfam):
+    return conn.execute("""
+        SELECT g.contig_id, g.file_name, gf.features FROM figfams f
+        JOIN genome_figfams gf ON gf.figfam_id = f.id
+        JOIN genomes g ON g.id = gf.genome_id
+        WHERE f.figfam = ? ORDER BY g.contig_id
+    """, (figfam,)).fetchall()
+
+# figfam, function, genome and (category, subcategory, subsystem, role) annotations of a feature
+def feature_info(conn, feature_id):
+    row = conn.execute("""
+        SELECT fe.id, f.figfam, fn.name, g.contig_id FROM features fe
+        JOIN figfams f ON f.id = fe.figfam_id
+        JOIN functions fn ON fn.id = f.function_id
+        JOIN genomes g ON g.id = fe.genome_id
+        WHERE fe.feature_id = ?
+    """, (feature_id,)).fetchone()
+    if row is None:
+        return None
+    annotations = conn.execute("""
+        SELECT p.category, p.subcategory, p.subsystem, p.role FROM feature_roles fr
+        JOIN role_paths p ON p.role_id = fr.role_id
+        WHERE fr.feature_id = ? ORDER BY p.category, p.subcategory, p.subsystem, p.role
+    """, (row[0],)).fetchall()
+    return {
+        'feature_id' : feature_id,
+        'figfam' : row[1],
+        'function' : row[2],
+        'contig_id' : row[3],
+        'annotations' : annotations
+    }
+
+# (name, number of figfams) of the children of the node at path (category, subcategory, ..), of all
+#  categories for an empty path, only counting figfams present in genome when given
+def hierarchy_children(conn, path=(), genome=None):
+    if len(path) >= len(HIERARCHY_LEVELS):
+        raise Exception("roles have no children, expected a path of at most %d levels" % (len(HIERARCHY_LEVELS) - 1))
+    (condition, params) = hierarchy_condition(dict(zip(HIERARCHY_LEVELS, path)))
+    child_level = HIERARCHY_LEVELS[len(path)]
+    query = """
+        SELECT p.%s, COUNT(DISTINCT fr.figfam_id) FROM role_paths p
+        JOIN figfam_roles fr ON fr.role_id = p.role_id
+    """ % child_level
+    conditions = [condition] if condition else []
+    if genome is not None:
+        query += " JOIN genome_figfams gf ON gf.figfam_id = fr.figfam_id"
+        conditions.append("gf.genome_id = ?")
+        params += genome_ids(conn, [genome])
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+    return conn.execute(query + " GROUP BY p.%s ORDER BY p.%s" % (child_level, child_level), params).fetchall()
+
+def add_hierarchy_arguments(parser):
+    for level in HIERARCHY_LEVELS:
+        parser.add_argument(
+            '--%s' % level, metavar=level, type=str, default=None,
+            help='only figfams annotated with a role under this %s' % level
+        )
+
+def split_genomes(value):
+    return [g.strip() for g in value.split(",") if g.strip() != ""] if value else []
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Builds and queries a sqlite database of the genomes, figfams, features and subsystem annotations.')
+    parser.add_argument(
+        '--db', metavar='db', type=str, default='output/query_store.sqlite',
+        help='the database to build or query (defaults to output/query_store.sqlite)'
+    )
+    util.add_metrics_arguments(parser)
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help='build the database from a directory of genome csv files and the subsystem tables')
+    build_parser.add_argument(
+        'directory', type=str, default=os.getcwd(), nargs="?",
+        help='the directory with the csv files of the genomes in it (defaults to current directory)'
+    )
+    build_parser.add_argument(
+        '--subsystems-dir', metavar='subsystems_dir', type=str, required=True,
+        help='the directory with the files containing the subsystem data in it'
+    )
+    build_parser.add_argument(
+        '--jobs', metavar='jobs', type=int, default=1,
+        help='number of worker processes to parse the csv files with (defaults to 1, no worker processes)'
+    )
+    build_parser.add_argument(
+        '--cache-dir', metavar='cache_dir', type=str, default=None,
+        help='directory to cache parsed csv files in, as for proteins.py (defaults to no cache)'
+    )
+    build_parser.add_argument(
+        '--recursive', default=False, action='store_true',
+        help='also read the csv and tsv files in the directories below directory and the subsystems directory'
+    )
+
+    figfams_parser = subparsers.add_parser('figfams', help='figfams present in and absent from genomes, under a category/subcategory/subsystem/role')
+    figfams_parser.add_argument(
+        '--present', metavar='present', type=str, default='',
+        help='comma separated contig ids or file names of genomes the figfams have to be in'
+    )
+    figfams_parser.add_argument(
+        '--absent', metavar='absent', type=str, default='',
+        help='comma separated contig ids or file names of genomes the figfams can not be in'
+    )
+    add_hierarchy_arguments(figfams_parser)
+
+    genomes_parser = subparsers.add_parser('genomes', help='genomes a figfam is in')
+    genomes_parser.add_argument('figfam', type=str, help='the figfam to look up')
+
+    feature_parser = subparsers.add_parser('feature', help='figfam, genome and subsystem annotations of a feature')
+    feature_parser.add_argument('feature_id', type=str, help='the feature id to look up, ie. fig|100000.peg.1')
+
+    hierarchy_parser = subparsers.add_parser('hierarchy', help='number of figfams in each child of a category/subcategory/subsystem')
+    hierarchy_parser.add_argument(
+        'path', type=str, nargs='*',
+        help='category, subcategory and subsystem of the node to show the children of (defaults to the top, all categories)'
+    )
+    hierarchy_parser.add_argument(
+        '--genome', metavar='genome', type=str, default=None,
+        help='contig id or file name of the genome to count figfams in (defaults to all genomes)'
+    )
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("expected one of: build, figfams, genomes, feature, hierarchy")
+
+    cur_dir = os.getcwd()
+    db_path = os.path.join(cur_dir, args.db)
+
+    if args.command == 'build':
+        metrics = util.create_metrics('query_store', args, cur_dir)
+        cache_dir = os.path.join(cur_dir, args.cache_dir) if args.cache_dir is not None else None
+        parsed_files = proteins.load_genomes(args.directory, jobs=args.jobs, cache_dir=cache_dir, metrics=metrics, recursive=args.recursive)
+        if len(parsed_files) == 0:
+            raise Exception("expected at least one data file in %s to read from! got none." % args.directory)
+        util.create_output_directory_if_not_exists(cur_dir)
+        build_store(db_path, parsed_files, args.subsystems_dir, metrics=metrics, recursive=args.recursive)
+        print("[query_store] wrote database to: %s (%.1f MB)" % (db_path, os.path.getsize(db_path) / float(1 << 20)))
+        metrics.write_report()
+    else:
+        conn = open_store(db_path)
+        start = time.perf_counter()
+        if args.command == 'figfams':
+            hierarchy = {level : getattr(args, level) for level in HIERARCHY_LEVELS}
+            rows = figfams_matching(conn, split_genomes(args.present), split_genomes(args.absent), hierarchy)
+        elif args.command == 'genomes':
+            rows = figfam_genomes(conn, args.figfam)
+        elif args.command == 'feature':
+            info = feature_info(conn, args.feature_id)
+            if info is None:
+                raise Exception("no feature with id: %s in query store" % args.feature_id)
+            rows = [(info['feature_id'], info['figfam'], info['function'], info['contig_id'])] + info['annotations']
+        elif args.command == 'hierarchy':
+            rows = hierarchy_children(conn, args.path, args.genome)
+        elapsed = time.perf_counter() - start
+        conn.close()
+        for row in rows:
+            print("\t".join(str(value) for value in row))
+        print("[query_store] %d rows in %.1f ms" % (len(rows), elapsed * 1000.0))
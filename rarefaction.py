@@ -0,0 +1,204 @@
+import os
+import csv
+import argparse
+import multiprocessing
+import numpy
+
+# our utils
+import util
+import presence
+import proteins
+
+# pan and core genome accumulation curves, for random orderings of the genomes the number of distinct
+#  proteins in (pan) and proteins common to (core) the first 1, 2, .. n genomes.
+#
+#  every genome is a row of bits, one per figfam, and a batch of orderings is walked one genome at a
+#  time: the running union and intersection of each ordering in the batch are or'ed and and'ed with the
+#  next genome in that ordering and their set bits counted, all as array operations over the batch.
+#
+#  whether the pan genome is open is judged with heaps' law: the mean number of new proteins the nth
+#  genome adds is fitted as k * n^-alpha, with alpha <= 1 the pan genome keeps growing (open), with
+#  alpha > 1 it approaches a fixed size (closed).
+
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+# genome x figfam bits, set in each worker before any batch is run
+genome_bits = None
+
+def set_genome_bits(bits):
+    global genome_bits
+    genome_bits = bits
+
+def accumulation_curves(orderings):
+    # returns (pan, core), each orderings x genomes
+    (total_orderings, total_genomes) = orderings.shape
+    pan = numpy.zeros((total_orderings, total_genomes), dtype=numpy.int64)
+    core = numpy.zeros((total_orderings, total_genomes), dtype=numpy.int64)
+    union = genome_bits[orderings[:, 0]]
+    intersection = union.copy()
+    for k in range(total_genomes):
+        if k > 0:
+            rows = genome_bits[orderings[:, k]]
+            union |= rows
+            intersection &= rows
+        pan[:, k] = presence.POPCOUNT_TABLE[union].sum(axis=1, dtype=numpy.int64)
+        core[:, k] = presence.POPCOUNT_TABLE[intersection].sum(axis=1, dtype=numpy.int64)
+    return pan, core
+
+def random_orderings(total_orderings, total_genomes, seed):
+    rng = numpy.random.RandomState(seed)
+    return numpy.array([rng.permutation(total_genomes) for _ in range(total_orderings)], dtype=numpy.int64)
+
+def run_accumulation(bits, orderings, batch_size, jobs=1):
+    batches = [orderings[i:i + batch_size] for i in range(0, len(orderings), batch_size)]
+    if jobs <= 1 or len(batches) <= 1:
+        set_genome_bits(bits)
+        results = [accumulation_curves(batch) for batch in batches]
+    else:
+        # the genome bits are handed to each worker once, not with every batch
+        with multiprocessing.Pool(processes=min(jobs, len(batches)), initializer=set_genome_bits, initargs=(bits,)) as pool:
+            results = pool.map(accumulation_curves, batches)
+    pan = numpy.concatenate([pan for (pan, core) in results])
+    core = numpy.concatenate([core for (pan, core) in results])
+    return pan, core
+
+def heaps_law_alpha(pan):
+    # fit of log(new proteins) against log(number of genomes), from the second genome on
+    new_proteins = numpy.diff(pan.mean(axis=0))
+    genomes = numpy.arange(2, pan.shape[1] + 1)
+    mask = new_proteins > 0
+    if mask.sum() < 2:
+        return None
+    (slope, intercept) = numpy.polyfit(numpy.log(genomes[mask]), numpy.log(new_proteins[mask]), 1)
+    return -slope
+
+def write_curves(curves_file_path, pan, core):
+    with open(curves_file_path, 'w') as csvfile:
+        writer = csv.writer(csvfile, dialect="excel")
+        quantile_names = ['q%02d' % round(q * 100) for q in QUANTILES]
+        writer.writerow(['genomes'] + ['pan_mean'] + ['pan_' + q for q in quantile_names] + ['core_mean'] + ['core_' + q for q in quantile_names])
+        pan_quantiles = numpy.percentile(pan, [q * 100 for q in QUANTILES], axis=0)
+        core_quantiles = numpy.percentile(core, [q * 100 for q in QUANTILES], axis=0)
+        pan_mean = pan.mean(axis=0)
+        core_mean = core.mean(axis=0)
+        for k in range(pan.shape[1]):
+            writer.writerow([k + 1, pan_mean[k]] + pan_quantiles[:, k].tolist() + [core_mean[k]] + core_quantiles[:, k].tolist())
+
+def generate_plot(pan, core, plot_title, output_filename):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(figsize=(12, 8))
+    genomes = numpy.arange(1, pan.shape[1] + 1)
+
+    # median with the 5-95% and 25-75% bands of the orderings around it
+    for (curve, label, colour) in [(pan, 'pan genome', 'tab:blue'), (core, 'core genome', 'tab:red')]:
+        (q05, q25, q50, q75, q95) = numpy.percentile(curve, [5, 25, 50, 75, 95], axis=0)
+        axes.fill_between(genomes, q05, q95, color=colour, alpha=0.15)
+        axes.fill_between(genomes, q25, q75, color=colour, alpha=0.3)
+        axes.plot(genomes, q50, color=colour, label=label)
+
+    axes.set_xlabel('genomes')
+    axes.set_ylabel('proteins')
+    axes.set_xlim(1, pan.shape[1])
+    axes.legend(loc='center right')
+    axes.set_title(plot_title)
+
+    plt.savefig(output_filename)
+    plt.close(fig)
+
+# the pan and core genome curves of permutations random orderings of the parsed genomes (see
+#  proteins.load_genomes), as (orderings x genomes) arrays of the number of proteins in the union and
+#  the intersection of the first 1, 2, .. n genomes of each ordering
+def rarefaction_curves(parsed_files, permutations=500, batch_size=64, seed=0, jobs=1, metrics=None):
+
+    metrics = metrics if metrics is not None else util.Metrics('rarefaction')
+    if len(parsed_files) < 2:
+        raise Exception("expected at least two genomes to compute curves for! got %d." % len(parsed_files))
+
+    protein_sets = [result['proteins'] for result in parsed_files]
+    with metrics.phase('presence matrix') as phase:
+        fig_index, fig_list = presence.intern_figfams(fig for proteins in protein_sets for fig in proteins)
+        bits = presence.genome_major(presence.build_presence_matrix(protein_sets, fig_index), len(protein_sets))
+        phase['rows'] = len(fig_list)
+        phase['bytes'] = bits.nbytes
+    print("[rarefaction] got %d genomes with %d proteins, computing %d orderings..." % (len(protein_sets), len(fig_list), permutations))
+
+    orderings = random_orderings(permutations, len(protein_sets), seed)
+    with metrics.phase('accumulation') as phase:
+        (pan, core) = run_accumulation(bits, orderings, batch_size, jobs=jobs)
+        phase['rows'] = permutations * len(protein_sets)
+
+    alpha = heaps_law_alpha(pan)
+    if alpha is not None:
+        print("[rarefaction] heaps' law alpha: %f, the pan genome looks %s" % (alpha, 'open' if alpha <= 1.0 else 'closed'))
+    else:
+        print("[rarefaction] too few genomes adding new proteins to fit heaps' law")
+
+    return (pan, core)
+
+# writes rarefaction_curves.csv and rarefaction_curves.png to output_dir
+def write_rarefaction_outputs(pan, core, output_dir, metrics=None):
+
+    metrics = metrics if metrics is not None else util.Metrics('rarefaction')
+    curves_file_path = os.path.join(output_dir, 'rarefaction_curves.csv')
+    with metrics.phase('write rarefaction_curves.csv', output=curves_file_path) as phase:
+        write_curves(curves_file_path, pan, core)
+        phase['rows'] = pan.shape[1]
+    print("[rarefaction] wrote curves over %d orderings to: %s" % (pan.shape[0], curves_file_path))
+
+    plot_file_path = os.path.join(output_dir, 'rarefaction_curves.png')
+    with metrics.phase('plotting', output=plot_file_path):
+        generate_plot(pan, core, plot_title="Pan and Core Genome Accumulation", output_filename=plot_file_path)
+    print("[rarefaction] wrote plot to: %s" % plot_file_path)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Computes pan and core genome accumulation curves over random orderings of the genomes in directory, writing their quantiles and a plot.')
+    parser.add_argument(
+        'directory', type=str, default=os.getcwd(), nargs="?",
+        help='the directory with the csv files of the genomes in it (defaults to current directory)'
+    )
+    parser.add_argument(
+        '--permutations', metavar='permutations', type=int, default=500,
+        help='number of random orderings of the genomes to compute curves for (defaults to 500)'
+    )
+    parser.add_argument(
+        '--batch-size', metavar='batch_size', type=int, default=64,
+        help='number of orderings to compute at once (defaults to 64)'
+    )
+    parser.add_argument(
+        '--seed', metavar='seed', type=int, default=0,
+        help='seed for the random orderings (defaults to 0)'
+    )
+    parser.add_argument(
+        '--jobs', metavar='jobs', type=int, default=1,
+        help='number of worker processes to parse the csv files and compute the curves with (defaults to 1, no worker processes)'
+    )
+    parser.add_argument(
+        '--cache-dir', metavar='cache_dir', type=str, default=None,
+        help='directory to cache parsed csv files in, as for proteins.py (defaults to no cache)'
+    )
+    parser.add_argument(
+        '--recursive', default=False, action='store_true',
+        help='also read the csv files in the directories below directory'
+    )
+    util.add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    cur_dir = os.getcwd()
+    metrics = util.create_metrics('rarefaction', args, cur_dir)
+    cache_dir = os.path.join(cur_dir, args.cache_dir) if args.cache_dir is not None else None
+
+    parsed_files = proteins.load_genomes(args.directory, jobs=args.jobs, cache_dir=cache_dir, metrics=metrics, recursive=args.recursive)
+
+    if len(parsed_files) < 2:
+        raise Exception("expected at least two data files in %s to compute curves for! got %d." % (args.directory, len(parsed_files)))
+
+    (pan, core) = rarefaction_curves(parsed_files, args.permutations, args.batch_size, args.seed, jobs=args.jobs, metrics=metrics)
+
+    util.create_output_directory_if_not_exists(cur_dir)
+    write_rarefaction_outputs(pan, core, os.path.join(cur_dir, 'output'), metrics=metrics)
+
+    metrics.write_report()
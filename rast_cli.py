@@ -0,0 +1,106 @@
+import os
+import re
+import csv
+import time
+import random
+import datetime
+import subprocess
+import shutil
+
+# wrappers around the RAST command line tools (svr_submit_RAST_job, svr_status_of_RAST_job and
+#  svr_retrieve_RAST_job), plus the append-only journal of submitted jobs
+
+fasta_job_output_regex = re.compile(r"'(\d+)'")
+job_status_output_regex = re.compile(r"(\d+):\s*(\S+)")
+
+# absolute path to one of the command line tools, given its name on PATH or a path to it
+def resolve_cmd(cmd, tool_name, flag_name):
+    resolved_cmd = shutil.which(cmd)
+    if resolved_cmd is None:
+        raise Exception("could not find: %s, pass %s with the path to %s" % (cmd, flag_name, tool_name))
+    return os.path.abspath(resolved_cmd)
+
+# the journal is only ever appended to, one row per submission attempt that finished (successful or not),
+#  a rerun skips all files which already have a successful job id in it
+def read_journal(journal_path):
+    submitted_files = {}
+    if not os.path.exists(journal_path):
+        return submitted_files
+    with open(journal_path, 'r') as csvfile:
+        reader = csv.DictReader(csvfile) # fieldnames=['job_id', 'file_name', 'success']
+        for row in reader:
+            if row['success'] == 'True':
+                submitted_files[row['file_name']] = row['job_id']
+    return submitted_files
+
+def open_journal(journal_path):
+    is_new_journal = not os.path.exists(journal_path)
+    journal_file = open(journal_path, 'a', newline='')
+    journal_writer = csv.writer(journal_file)
+    if is_new_journal:
+        print("[batch] writing job ids to new file: %s" % journal_path)
+        journal_writer.writerow(['job_id', 'file_name', 'success'])
+        journal_file.flush()
+    else:
+        print("[batch] writing job ids to existing file: %s" % journal_path)
+    return journal_file, journal_writer
+
+def write_job_id_to_journal(journal_file, journal_writer, job_id, file_name, success):
+    print("[batch] writing id: %s for %s" % (job_id, file_name))
+    journal_writer.writerow([job_id, file_name, success])
+    journal_file.flush()
+    os.fsync(journal_file.fileno())
+
+def submit_fasta_file(submit_cmd, username, password, entry):
+    submit_fasta_job_cmd = [submit_cmd, "--domain", "Bacteria", "--user", username, "--passwd", password, "--fasta", entry]
+    result = subprocess.run(submit_fasta_job_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    our_match = fasta_job_output_regex.search(result.stdout)
+    if result.returncode != 0 or our_match is None:
+        raise Exception("submitting %s failed with exit code %d, output: %s" % (entry, result.returncode, result.stdout.strip()))
+    return our_match.group(1)
+
+def submit_with_retries(submit_cmd, username, password, entry, retries, backoff):
+    attempt = 0
+    while True:
+        try:
+            print("[batch] trying to submit: %s at %s (attempt %d)" % (entry, datetime.datetime.now(), attempt + 1))
+            return submit_fasta_file(submit_cmd, username, password, entry)
+        except Exception as e:
+            if attempt >= retries:
+                raise
+            # exponential backoff, with some jitter so workers do not retry in lockstep
+            delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.0)
+            print("[batch] %s, retrying in %.1f seconds" % (e, delay))
+            time.sleep(delay)
+            attempt += 1
+
+
+# status of a job as reported by svr_status_of_RAST_job, ie. 'complete', 'running' or 'not_started'
+def job_status(status_cmd, username, password, job_id):
+    status_job_cmd = [status_cmd, "--user", username, "--passwd", password, str(job_id)]
+    result = subprocess.run(status_job_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    for (status_job_id, status) in job_status_output_regex.findall(result.stdout):
+        if status_job_id == str(job_id):
+            return status
+    raise Exception("could not get status of job %s, exit code %d, output: %s" % (job_id, result.returncode, result.stdout.strip()))
+
+def is_failed_job_status(status):
+    return status in ('error', 'failed', 'deleted')
+
+# the annotated genome of a finished job in the given format, as written to stdout by svr_retrieve_RAST_job
+def retrieve_job(retrieve_cmd, username, password, job_id, output_format):
+    retrieve_job_cmd = [retrieve_cmd, "--user", username, "--passwd", password, str(job_id), output_format]
+    result = subprocess.run(retrieve_job_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0 or result.stdout == '':
+        raise Exception("retrieving job %s failed with exit code %d, output: %s" % (job_id, result.returncode, result.stderr.strip()))
+    return result.stdout
+
+# the classification spreadsheet comes tab separated, proteins.py reads comma separated csv files
+def write_classification_csv(spreadsheet_tab, output_path):
+    reader = csv.reader(spreadsheet_tab.splitlines(), delimiter='\t')
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, dialect="excel")
+        for row in reader:
+            writer.writerow(row)
+    os.replace(tmp_path, output_path)
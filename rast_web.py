@@ -0,0 +1,99 @@
+import os
+import requests
+from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# the bits of the RAST web interface we need, logging in and downloading subsystem tables
+
+default_base_url = "https://rast.nmpdr.org/"
+login_page = "rast.cgi"
+job_page = "rast.cgi?page=JobDetails&job=%s"
+
+login_headers = {
+    'User-Agent': 'Mozilla/5.0'
+}
+
+# columns of the exported subsystem table
+subsystem_fields = ['Category', 'Subcategory', 'Subsystem', 'Role', 'Features']
+
+# bs4 is only imported once a page is parsed, so the pipeline can import this module without it when
+#  no subsystems are fetched
+def parse_page(text):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(text, "html.parser")
+
+# one keep-alive session shared by all workers, with enough pooled connections for every worker
+def create_session(concurrency, retries):
+    session = requests.Session()
+    session.headers.update(login_headers)
+    retry = Retry(total=retries, backoff_factor=1.0, status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# fills in and submits a form found on a page, keeping all its hidden fields
+def submit_form(session, page_url, form, extra_fields):
+    fields = {}
+    for e in form.find_all('input'):
+        if e.get('name') is not None and e.get('type', 'text') not in ('submit', 'button', 'image'):
+            fields[e['name']] = e.get('value', '')
+    fields.update(extra_fields)
+    action_url = urljoin(page_url, form.get('action', ''))
+    if form.get('method', 'get').lower() == 'post':
+        response = session.post(action_url, data=fields)
+    else:
+        response = session.get(action_url, params=fields)
+    response.raise_for_status()
+    return response
+
+def login_to_rast(session, base_url, username, password):
+    login_url = urljoin(base_url, login_page)
+    response = session.get(login_url)
+    response.raise_for_status()
+    soup = parse_page(response.text)
+    userfield = soup.find('input', attrs={'name' : 'login'})
+    if userfield is None or userfield.find_parent('form') is None:
+        raise Exception("could not find login form at: %s" % login_url)
+    response = submit_form(session, login_url, userfield.find_parent('form'), {'login' : username, 'password' : password})
+    if parse_page(response.text).find('input', attrs={'name' : 'password'}) is not None:
+        raise Exception("login to %s as %s failed, still got the login form back" % (login_url, username))
+
+def extract_genome_url_for_job_id(session, base_url, job_id):
+    job_url = urljoin(base_url, job_page % job_id)
+    response = session.get(job_url)
+    response.raise_for_status()
+    soup = parse_page(response.text)
+    e = soup.find('a', string="Browse annotated genome in SEED Viewer")
+    if e is None:
+        raise Exception("no SEED Viewer link on page for job: %s, is the job finished?" % job_id)
+    return urljoin(job_url, e['href'])
+
+# the "export to file" button of the "Features in Subsystems" tab submits a form, which we submit directly
+def extract_subsystem_data(session, url):
+    response = session.get(url)
+    response.raise_for_status()
+    soup = parse_page(response.text)
+    export_button = soup.find('input', attrs={'value' : 'export to file'})
+    if export_button is None or export_button.find_parent('form') is None:
+        raise Exception("no subsystem export form on page: %s" % url)
+    extra_fields = {export_button['name'] : export_button['value']} if export_button.get('name') else {}
+    return submit_form(session, url, export_button.find_parent('form'), extra_fields)
+
+def fetch_subsystems_for_job(session, base_url, job_id, output_dir):
+    genome_url = extract_genome_url_for_job_id(session, base_url, job_id)
+    response = extract_subsystem_data(session, genome_url)
+    # an expired session or an error page can come back with a 200 too, only keep what has the columns
+    #  subsystems.py reads
+    header = response.content.split(b'\n', 1)[0].decode('utf-8-sig', 'replace').rstrip('\r').split('\t')
+    if not all(field in header for field in subsystem_fields):
+        raise Exception("expected a subsystem table for job %s, got %s starting with: %r" % (job_id, response.headers.get('Content-Type', 'no content type'), response.content[:80]))
+    # named after the job, the name the server gives the table need not differ between jobs fetched at once
+    output_path = os.path.join(output_dir, "%s_subsystems.tsv" % job_id)
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(response.content)
+    os.replace(tmp_path, output_path)
+    return output_path
+
@@ -1,11 +1,18 @@
 import os
+import csv
 import json
+import argparse
 import numpy
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+import hashlib
 import itertools
 
+# our utils
+import util
+import presence
+
+# scipy and matplotlib are only imported by the functions which use them, so importing this module
+#  to compute similarities in an already running process does not pay for the plotting
+
 def set_similarity(a, b):
     a_size, b_size = len(a), len(b)
     c = a.intersection(b)
@@ -14,52 +21,532 @@ def set_similarity(a, b):
     elif a_size < b_size:
         return len(c) / b_size
 
-def generate_plot(similarity_map, x_labels, y_labels, plot_title, output_filename):
+# minhash sketches, an approximate alternative to set_similarity for collections too large
+#  for exact all pairs similarity.
+#
+#  every genome gets a signature of num_hashes minimum hash values over its figfams, the fraction
+#  of equal signature values of two genomes estimates their jaccard index J, which together with
+#  the exact set sizes gives the same similarity as set_similarity: |A & B| = J * (|A| + |B|) / (1 + J).
+#
+#  error bound: the estimate of J is the mean of num_hashes independent indicators, so by hoeffding
+#  P(|J_est - J| >= e) <= 2 * exp(-2 * num_hashes * e^2), ie. with 128 hashes |J_est - J| <= 0.12 for 95%
+#  of pairs. the similarity changes by at most 2x the change in J, so its error is at most 2e.
+#  figfams are hashed to 31 bits first, collisions between figfams add a small extra error.
+#
+#  candidate pairs come from locality sensitive hashing with num_bands bands of num_hashes / num_bands
+#  rows, a pair with jaccard J becomes a candidate with probability 1 - (1 - J^rows)^bands, pairs that
+#  never do are left out of the sparse matrix (with 128 hashes in 32 bands, pairs with J above ~0.42
+#  are very likely found).
+
+# universal hashing (a * x + b) mod p, with x and a below p = 2^31 - 1 so a * x fits in 64 bits
+MINHASH_PRIME = (1 << 31) - 1
+
+def minhash_parameters(num_hashes, seed):
+    rng = numpy.random.RandomState(seed)
+    a = rng.randint(1, MINHASH_PRIME, size=num_hashes).astype(numpy.uint64)
+    b = rng.randint(0, MINHASH_PRIME, size=num_hashes).astype(numpy.uint64)
+    return a, b
+
+def figfam_hash(fig):
+    return int.from_bytes(hashlib.blake2b(fig.encode('utf-8'), digest_size=4).digest(), 'little') % MINHASH_PRIME
+
+def minhash_signature(fig_hashes, a, b):
+    if len(fig_hashes) == 0:
+        return numpy.full(len(a), MINHASH_PRIME, dtype=numpy.uint64)
+    x = numpy.array(fig_hashes, dtype=numpy.uint64)
+    return ((numpy.outer(a, x) + b[:, None]) % numpy.uint64(MINHASH_PRIME)).min(axis=1)
+
+# one pass over (contig id, {'proteins' : [..]}) pairs, one genome at a time, as read from genomes.json
+#  by util.iter_json_object_items or the items of collate_data.genome_data
+def compute_sketches(genome_items, num_hashes, seed):
+    a, b = minhash_parameters(num_hashes, seed)
+    fig_hashes = {}
+    labels = []
+    sizes = []
+    signatures = []
+    for (contig_id, data) in genome_items:
+        proteins = set(data['proteins'])
+        for fig in proteins:
+            if fig not in fig_hashes:
+                fig_hashes[fig] = figfam_hash(fig)
+        labels.append(contig_id)
+        sizes.append(len(proteins))
+        signatures.append(minhash_signature([fig_hashes[fig] for fig in proteins], a, b))
+    signatures = numpy.array(signatures, dtype=numpy.uint64).reshape(len(labels), num_hashes)
+    return {'labels' : labels, 'sizes' : numpy.array(sizes, dtype=numpy.int64), 'signatures' : signatures, 'seed' : seed}
+
+def save_sketches(sketch_file_path, sketches):
+    numpy.savez(
+        sketch_file_path, labels=numpy.array(sketches['labels']),
+        sizes=sketches['sizes'], signatures=sketches['signatures'], seed=sketches['seed']
+    )
+
+def load_sketches(sketch_file_path):
+    with numpy.load(sketch_file_path) as data:
+        return {'labels' : data['labels'].tolist(), 'sizes' : data['sizes'], 'signatures' : data['signatures'], 'seed' : int(data['seed'])}
+
+def lsh_candidate_pairs(signatures, num_bands):
+    (total_genomes, num_hashes) = signatures.shape
+    if num_hashes % num_bands != 0:
+        raise Exception("number of hashes: %d must be divisible by number of bands: %d" % (num_hashes, num_bands))
+    rows = num_hashes // num_bands
+    pairs = []
+    for band in range(num_bands):
+        band_signatures = signatures[:, band * rows:(band + 1) * rows]
+        _, buckets = numpy.unique(band_signatures, axis=0, return_inverse=True)
+        buckets = buckets.reshape(-1)
+        order = numpy.argsort(buckets, kind='stable')
+        boundaries = numpy.flatnonzero(numpy.diff(buckets[order])) + 1
+        for members in numpy.split(order, boundaries):
+            if len(members) > 1:
+                (i, j) = numpy.triu_indices(len(members), k=1)
+                pairs.append(members[i] * total_genomes + members[j])
+                pairs.append(members[j] * total_genomes + members[i])
+    if len(pairs) == 0:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    pairs = numpy.unique(numpy.concatenate(pairs))
+    return pairs // total_genomes, pairs % total_genomes
+
+def estimate_similarities(sketches, left, right, chunk_size=1 << 16):
+    signatures = sketches['signatures']
+    sizes = sketches['sizes']
+    jaccard = numpy.zeros(len(left), dtype=numpy.float32)
+    for start in range(0, len(left), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        jaccard[chunk] = (signatures[left[chunk]] == signatures[right[chunk]]).mean(axis=1)
+    intersections = jaccard * (sizes[left] + sizes[right]) / (1.0 + jaccard)
+    largest = numpy.maximum(sizes[left], sizes[right])
+    similarity = numpy.zeros(len(left), dtype=numpy.float32)
+    numpy.divide(intersections, largest, out=similarity, where=largest > 0, casting='unsafe')
+    return jaccard, similarity
+
+# returns the sparse similarity matrix (rows and columns in the order of the sketch labels) and
+#  the top k most similar genomes of every genome as (genome, other, jaccard, similarity) index tuples
+def sketch_similarity(sketches, num_bands, top_k):
+    import scipy.sparse
+    total_genomes = len(sketches['labels'])
+    (left, right) = lsh_candidate_pairs(sketches['signatures'], num_bands)
+    (jaccard, similarity) = estimate_similarities(sketches, left, right)
+
+    diagonal = numpy.arange(total_genomes)
+    matrix = scipy.sparse.coo_matrix(
+        (numpy.concatenate([similarity, numpy.ones(total_genomes, dtype=numpy.float32)]),
+            (numpy.concatenate([left, diagonal]), numpy.concatenate([right, diagonal]))),
+        shape=(total_genomes, total_genomes)
+    ).tocsr()
+
+    # most similar first within each genome, then the first top_k of each
+    order = numpy.lexsort((-similarity, left))
+    (left, right, jaccard, similarity) = (left[order], right[order], jaccard[order], similarity[order])
+    group_starts = numpy.searchsorted(left, left)
+    keep = (numpy.arange(len(left)) - group_starts) < top_k
+    nearest = list(zip(left[keep].tolist(), right[keep].tolist(), jaccard[keep].tolist(), similarity[keep].tolist()))
+
+    return matrix, nearest
+
+# genome x figfam incidence matrix, one row per genome in the order of labels
+def build_incidence_matrix(genomes, labels):
+    import scipy.sparse
+    fig_index, _ = presence.intern_figfams(itertools.chain.from_iterable(genomes[label] for label in labels))
+    indptr = numpy.zeros(len(labels) + 1, dtype=numpy.int64)
+    indices = []
+    for (i, label) in enumerate(labels):
+        indices += [fig_index[fig] for fig in genomes[label]]
+        indptr[i + 1] = len(indices)
+    data = numpy.ones(len(indices), dtype=numpy.float32)
+    return scipy.sparse.csr_matrix((data, numpy.array(indices, dtype=numpy.int64), indptr), shape=(len(labels), len(fig_index)))
 
-    fig, axes = plt.subplots(figsize=(24, 24))
-    im = axes.imshow(similarity_map)
+# same as set_similarity for every pair, intersection sizes over the size of the larger set
+def similarity_tile(incidence, sizes, rows, cols):
+    intersections = (incidence[rows] @ incidence[cols].T).toarray()
+    largest = numpy.maximum.outer(sizes[rows], sizes[cols]).astype(numpy.float32)
+    return numpy.divide(intersections, largest, out=numpy.zeros_like(intersections), where=largest > 0)
+
+def similarity_matrix(incidence):
+    sizes = incidence.getnnz(axis=1)
+    everything = slice(0, incidence.shape[0])
+    return similarity_tile(incidence, sizes, everything, everything)
+
+# computes the matrix in tiles written to a memory mapped .npy file, so it never has to fit in memory,
+#  only tiles on or above the diagonal are computed, the ones below are their transpose
+def blocked_similarity_matrix(incidence, output_path, block_size):
+    total_genomes = incidence.shape[0]
+    sizes = incidence.getnnz(axis=1)
+    result = numpy.lib.format.open_memmap(output_path, mode='w+', dtype=numpy.float32, shape=(total_genomes, total_genomes))
+    for row_start in range(0, total_genomes, block_size):
+        rows = slice(row_start, min(row_start + block_size, total_genomes))
+        for col_start in range(row_start, total_genomes, block_size):
+            cols = slice(col_start, min(col_start + block_size, total_genomes))
+            tile = similarity_tile(incidence, sizes, rows, cols)
+            result[rows, cols] = tile
+            result[cols, rows] = tile.T
+        print("[similarity_heatmap] computed rows %d to %d of %d" % (rows.start, rows.stop, total_genomes))
+    result.flush()
+    return result
+
+# 1 - similarity of every pair i < j, in the order scipy expects a condensed distance matrix. as
+#  float32 it takes half the memory of the square matrix, which is read a row at a time so it can
+#  stay memory mapped
+def condensed_distances(similarity_map):
+    total_genomes = similarity_map.shape[0]
+    distances = numpy.empty(total_genomes * (total_genomes - 1) // 2, dtype=numpy.float32)
+    offset = 0
+    for i in range(total_genomes - 1):
+        row = numpy.asarray(similarity_map[i, i + 1:], dtype=numpy.float32)
+        numpy.subtract(1.0, row, out=distances[offset:offset + len(row)])
+        offset += len(row)
+    return distances
+
+# bytes clustering total_genomes takes at its peak, the float32 distances and the float64 copies
+#  scipy works on (one for single linkage, two for the others, measured with scipy 1.17)
+def cluster_memory_bytes(total_genomes, method):
+    pairs = total_genomes * (total_genomes - 1) // 2
+    return pairs * (4 + 8 * (1 if method == 'single' else 2))
+
+# hierarchical clustering of the genomes on 1 - similarity, returns the positions of the genomes in
+#  leaf order (similar genomes next to each other) and the linkage matrix
+def cluster_order(similarity_map, method='average'):
+    from scipy.cluster.hierarchy import linkage, leaves_list
+    total_genomes = similarity_map.shape[0]
+    if total_genomes < 2:
+        return numpy.arange(total_genomes), numpy.zeros((0, 4))
+    tree = linkage(condensed_distances(similarity_map), method=method)
+    return leaves_list(tree), tree
+
+# [start, stop) genome positions of each of pixels pixels over span genomes from start, a pixel covers
+#  at least one genome, so when span < pixels genomes cover several pixels
+def pixel_ranges(start, span, pixels, total_genomes):
+    edges = start + numpy.arange(pixels + 1) * (span / float(pixels))
+    starts = numpy.floor(edges[:-1]).astype(numpy.int64)
+    stops = numpy.maximum(numpy.floor(edges[1:]).astype(numpy.int64), starts + 1)
+    return numpy.minimum(starts, total_genomes), numpy.minimum(stops, total_genomes)
+
+# mean similarity in every (row range, column range) of the matrix with rows and columns in order,
+#  the ranges being positions in order, ie. every pixel of a downsampled image of it. rows are read in
+#  chunks of about chunk_cells values and summed up through prefix sums, so memory stays the same
+#  whatever the number of genomes
+def range_means(similarity_map, order, row_ranges, col_ranges, chunk_cells=1 << 22):
+    (row_starts, row_stops) = row_ranges
+    (col_starts, col_stops) = col_ranges
+    total_genomes = len(order)
+    col_counts = (col_stops - col_starts).astype(numpy.float64)
+    image = numpy.full((len(row_starts), len(col_starts)), numpy.nan, dtype=numpy.float32)
+    rows_per_chunk = max(1, chunk_cells // max(1, total_genomes))
+
+    first = 0
+    while first < len(row_starts):
+        last = first + 1
+        while last < len(row_starts) and row_stops[last] - row_starts[first] <= rows_per_chunk:
+            last += 1
+        (low, high) = (row_starts[first], row_stops[last - 1])
+        if high > low:
+            # memory mapped rows are read in file order, then put back in the order asked for
+            rows = order[low:high]
+            by_position = numpy.argsort(rows)
+            block = numpy.empty((len(rows), total_genomes), dtype=numpy.float32)
+            block[by_position] = similarity_map[rows[by_position]]
+            col_sums = numpy.zeros((len(rows), total_genomes + 1), dtype=numpy.float64)
+            numpy.cumsum(block[:, order], axis=1, out=col_sums[:, 1:])
+            col_sums = col_sums[:, col_stops] - col_sums[:, col_starts]
+            row_sums = numpy.zeros((len(rows) + 1, len(col_starts)), dtype=numpy.float64)
+            numpy.cumsum(col_sums, axis=0, out=row_sums[1:])
+            starts = row_starts[first:last] - low
+            stops = row_stops[first:last] - low
+            counts = numpy.outer(stops - starts, col_counts)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                image[first:last] = (row_sums[stops] - row_sums[starts]) / counts
+        first = last
+
+    return image
+
+def generate_plot(similarity_map, labels, plot_title, output_filename, order=None, max_pixels=2000, max_labels=200):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    total_genomes = len(labels)
+    order = numpy.arange(total_genomes) if order is None else numpy.asarray(order)
+
+    # past max_pixels genomes every pixel is the mean of a block of genomes
+    pixels = max(1, min(total_genomes, max_pixels))
+    ranges = pixel_ranges(0, total_genomes, pixels, total_genomes)
+    image = range_means(similarity_map, order, ranges, ranges)
+
+    # one label per genome only while they can still be read
+    show_labels = total_genomes <= max_labels
+    if show_labels:
+        fig, axes = plt.subplots(figsize=(24, 24))
+    else:
+        fig, axes = plt.subplots(figsize=(12, 12), dpi=max(100, pixels // 9))
+    im = axes.imshow(image, interpolation='nearest', extent=(0, total_genomes, total_genomes, 0), rasterized=True)
     axes.tick_params(axis='both', pad=10)
 
     # show color bar
     plt.colorbar(im)
 
     # set up ticks and labels
-    axes.set_xticks(numpy.arange(len(x_labels)))
-    axes.set_yticks(numpy.arange(len(y_labels)))
-    axes.set_xticklabels(x_labels, fontsize=8)
-    axes.set_yticklabels(y_labels, fontsize=8)
+    if show_labels:
+        ordered_labels = [labels[i] for i in order]
+        axes.set_xticks(numpy.arange(total_genomes) + 0.5)
+        axes.set_yticks(numpy.arange(total_genomes) + 0.5)
+        axes.set_xticklabels(ordered_labels, fontsize=8)
+        axes.set_yticklabels(ordered_labels, fontsize=8)
+        plt.setp(axes.get_xticklabels(), rotation=90)
+        plt.setp(axes.get_yticklabels(), rotation=0)
+    else:
+        axes.set_xlabel('genome')
+        axes.set_ylabel('genome')
     axes.xaxis.set_label_position('top')
     axes.xaxis.tick_top()
-
-    plt.setp(axes.get_xticklabels(), rotation=90)
-    plt.setp(axes.get_yticklabels(), rotation=0)
     axes.set_title(plot_title)
 
     plt.savefig(output_filename)
+    plt.close(fig)
+
+# tiles of tile_size x tile_size pixels of the matrix in order for zooming into it, level 0 is one tile
+#  of the whole matrix, every level after splits each tile in four, up to the level where a pixel is a
+#  genome. tiles are written to tiles_dir/<level>/<row>/<column>.png, with the labels in the order of
+#  the rows and columns and the number of levels in tiles_dir/tiles.json
+def write_tile_pyramid(similarity_map, labels, order, tiles_dir, tile_size=256):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    total_genomes = len(labels)
+    levels = 1 + max(0, int(numpy.ceil(numpy.log2(max(1.0, total_genomes / float(tile_size))))))
+    total_tiles = 0
+    for level in range(levels):
+        tiles_across = 1 << level
+        span = total_genomes / float(tiles_across)
+        # one strip of tiles at a time, so the matrix is read once per level
+        col_ranges = pixel_ranges(0, total_genomes, tile_size * tiles_across, total_genomes)
+        for y in range(tiles_across):
+            strip = range_means(similarity_map, order, pixel_ranges(y * span, span, tile_size, total_genomes), col_ranges)
+            row_dir = os.path.join(tiles_dir, str(level), str(y))
+            if not os.path.exists(row_dir):
+                os.makedirs(row_dir)
+            for x in range(tiles_across):
+                tile = strip[:, x * tile_size:(x + 1) * tile_size]
+                plt.imsave(os.path.join(row_dir, '%d.png' % x), tile, vmin=0.0, vmax=1.0)
+                total_tiles += 1
+        print("[similarity_heatmap] wrote %d tiles of level %d" % (tiles_across * tiles_across, level))
 
+    with open(os.path.join(tiles_dir, 'tiles.json'), 'w') as f:
+        json.dump({
+            'genomes' : total_genomes,
+            'tile_size' : tile_size,
+            'levels' : levels,
+            'path' : '{level}/{row}/{column}.png',
+            'labels' : [labels[i] for i in order]
+        }, f)
+    return total_tiles
 
-with open('output/genomes.json', 'r') as f:
+# exact similarity of every pair of genomes, genomes maps each contig id to its figfams. returns the
+#  sorted labels and the matrix with rows and columns in their order, above blocked_threshold genomes
+#  it is computed in tiles into a memory mapped similarity_file_path, which is required then
+def exact_similarity(genomes, similarity_file_path=None, blocked_threshold=4000, block_size=1024):
+    labels = sorted(genomes)
+    incidence = build_incidence_matrix(genomes, labels)
+    if len(labels) > blocked_threshold:
+        if similarity_file_path is None:
+            raise Exception("expected a file to compute the similarity matrix of %d genomes into, above %d genomes it is done in tiles" % (len(labels), blocked_threshold))
+        return labels, blocked_similarity_matrix(incidence, similarity_file_path, block_size)
+    similarity_map = similarity_matrix(incidence)
+    if similarity_file_path is not None:
+        numpy.save(similarity_file_path, similarity_map)
+    return labels, similarity_map
 
-    genomes = {contig_id:set(data['proteins']) for (contig_id, data) in json.load(f).items()}
-    similarity = {}
+def write_nearest(nearest_file_path, labels, nearest):
+    with open(nearest_file_path, 'w') as csvfile:
+        writer = csv.writer(csvfile, dialect="excel")
+        writer.writerow(['contig_id', 'rank', 'other_contig_id', 'estimated_jaccard', 'estimated_similarity'])
+        rank = 0
+        prev_genome = None
+        for (i, j, jaccard, similarity) in nearest:
+            rank = rank + 1 if i == prev_genome else 1
+            prev_genome = i
+            writer.writerow([labels[i], rank, labels[j], jaccard, similarity])
 
-    for (contig_id, proteins) in genomes.items():
-        for (other_id, other_proteins) in genomes.items():
-            if contig_id not in similarity:
-                similarity[contig_id] = {other_id : set_similarity(proteins, other_proteins)}
-            else:
-                similarity[contig_id][other_id] = set_similarity(proteins, other_proteins)
+# sketch mode: minhash sketches of the genomes in genomes_file_path (as written by collate_data.py) and
+#  the estimated similarity of the candidate pairs found by locality sensitive hashing, written to
+#  output_dir as genome_sketches.npz, similarity_sparse.npz, similarity_labels.json and similarity_nearest.csv
+def run_sketch_similarity(genomes_file_path, output_dir, num_hashes=128, num_bands=32, top_k=10, seed=0, metrics=None):
+
+    import scipy.sparse
+
+    metrics = metrics if metrics is not None else util.Metrics('similarity_heatmap')
+    with metrics.phase('sketch genomes', output=genomes_file_path) as phase, util.open_text(genomes_file_path, 'r') as f:
+        sketches = compute_sketches(util.iter_json_object_items(f), num_hashes, seed)
+        phase['rows'] = len(sketches['labels'])
+
+    sketch_file_path = os.path.join(output_dir, 'genome_sketches.npz')
+    with metrics.phase('write genome_sketches.npz', output=sketch_file_path):
+        save_sketches(sketch_file_path, sketches)
+    print("[similarity_heatmap] wrote %d genome sketches of %d hashes to: %s" % (len(sketches['labels']), num_hashes, sketch_file_path))
+
+    with metrics.phase('similarity') as phase:
+        (sparse_similarity, nearest) = sketch_similarity(sketches, num_bands, top_k)
+        phase['rows'] = sparse_similarity.nnz
+    labels = sketches['labels']
+
+    sparse_file_path = os.path.join(output_dir, 'similarity_sparse.npz')
+    with metrics.phase('write similarity_sparse.npz', output=sparse_file_path) as phase:
+        scipy.sparse.save_npz(sparse_file_path, sparse_similarity)
+        phase['rows'] = sparse_similarity.nnz
+    with open(os.path.join(output_dir, 'similarity_labels.json'), 'w') as labels_file:
+        json.dump(labels, labels_file)
+    print("[similarity_heatmap] wrote sparse similarity matrix with %d entries to: %s" % (sparse_similarity.nnz, sparse_file_path))
+
+    nearest_file_path = os.path.join(output_dir, 'similarity_nearest.csv')
+    with metrics.phase('write similarity_nearest.csv', output=nearest_file_path) as phase:
+        write_nearest(nearest_file_path, labels, nearest)
+        phase['rows'] = len(nearest)
+    print("[similarity_heatmap] wrote the %d most similar genomes of each genome to: %s" % (top_k, nearest_file_path))
+
+    return (labels, sparse_similarity, nearest)
+
+# exact mode: the similarity of every pair of genomes in genomes_file_path, written to output_dir as
+#  similarity_matrix.npy and similarity_labels.json and plotted into plot_dir, with order 'cluster' in
+#  the leaf order of a hierarchical clustering (whose linkage and order also go to output_dir)
+def run_exact_similarity(genomes_file_path, output_dir, plot_dir='', blocked_threshold=4000, block_size=1024, order='label', cluster_method='average', memory_budget=1024, max_pixels=2000, max_labels=200, tiles_dir=None, tile_size=256, metrics=None):
+
+    metrics = metrics if metrics is not None else util.Metrics('similarity_heatmap')
+    with metrics.phase('load genomes', output=genomes_file_path) as phase, util.open_text(genomes_file_path, 'r') as f:
+        genomes = {contig_id:set(data['proteins']) for (contig_id, data) in json.load(f).items()}
+        phase['rows'] = len(genomes)
+
+    # rows and columns of the matrix are in the order of the sorted labels
+    similarity_file_path = os.path.join(output_dir, 'similarity_matrix.npy')
+    with metrics.phase('similarity', output=similarity_file_path) as phase:
+        (genome_labels, similarity_map) = exact_similarity(genomes, similarity_file_path, blocked_threshold, block_size)
+        phase['rows'] = len(genome_labels) * len(genome_labels)
+    print("[similarity_heatmap] wrote %d x %d similarity matrix to: %s" % (len(genome_labels), len(genome_labels), similarity_file_path))
+
+    with open(os.path.join(output_dir, 'similarity_labels.json'), 'w') as labels_file:
+        json.dump(genome_labels, labels_file)
+
+    plot_order = None
+    plot_file_path = os.path.join(plot_dir, "similarity_order_by_genome.png")
+    if order == 'cluster':
+        needed_bytes = cluster_memory_bytes(len(genome_labels), cluster_method)
+        if needed_bytes > memory_budget * (1 << 20):
+            raise Exception("clustering %d genomes with %s linkage takes about %d MB, above the memory budget of %d MB, pass a larger --memory-budget%s" \
+                            % (len(genome_labels), cluster_method, needed_bytes >> 20, memory_budget, "" if cluster_method == 'single' else " or --cluster-method single, which takes about half"))
+        with metrics.phase('clustering') as phase:
+            (plot_order, tree) = cluster_order(similarity_map, method=cluster_method)
+            phase['rows'] = len(genome_labels)
+        numpy.save(os.path.join(output_dir, 'similarity_linkage.npy'), tree)
+        order_file_path = os.path.join(output_dir, 'similarity_cluster_order.json')
+        with open(order_file_path, 'w') as order_file:
+            json.dump([genome_labels[i] for i in plot_order], order_file)
+        print("[similarity_heatmap] clustered %d genomes with %s linkage, wrote their order to: %s" % (len(genome_labels), cluster_method, order_file_path))
+        plot_file_path = os.path.join(plot_dir, "similarity_order_by_cluster.png")
 
     # now the plotting...
-    genome_labels = [contig_id for contig_id in similarity]
-    genome_labels.sort()
+    with metrics.phase('plotting', output=plot_file_path):
+        generate_plot(
+            similarity_map,
+            genome_labels,
+            plot_title="Pairwise Sample Similarity",
+            output_filename=plot_file_path,
+            order=plot_order,
+            max_pixels=max_pixels,
+            max_labels=max_labels
+        )
+
+    if tiles_dir is not None:
+        with metrics.phase('write tiles') as phase:
+            phase['rows'] = write_tile_pyramid(
+                similarity_map, genome_labels, plot_order if plot_order is not None else numpy.arange(len(genome_labels)), tiles_dir, tile_size=tile_size
+            )
+        print("[similarity_heatmap] wrote %d tiles to: %s" % (phase['rows'], tiles_dir))
 
-    similarity_map = [[similarity[x][y] for y in genome_labels] for x in genome_labels]
+    return (genome_labels, similarity_map, plot_order)
 
-    generate_plot(
-        similarity_map,
-        x_labels = genome_labels,
-        y_labels = genome_labels,
-        plot_title="Pairwise Sample Similarity",
-        output_filename="similarity_order_by_genome.png"
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Calculates the pairwise similarity of all genomes in output/genomes.json (or --genomes) and plots it as a heatmap.')
+    parser.add_argument(
+        '--genomes', metavar='genomes', type=str, default='output/genomes.json',
+        help='the genomes to compare, as written by collate_data.py, can be .json.gz or .json.xz (defaults to output/genomes.json)'
+    )
+    parser.add_argument(
+        '--output-dir', metavar='output_dir', type=str, default='output',
+        help='the directory to write the similarity matrix, labels, sketches and clustering to, created if it does not exist (defaults to output)'
+    )
+    parser.add_argument(
+        '--blocked-threshold', metavar='blocked_threshold', type=int, default=4000,
+        help='above this many genomes the similarity matrix is computed in tiles into a memory mapped file (defaults to 4000)'
+    )
+    parser.add_argument(
+        '--block-size', metavar='block_size', type=int, default=1024,
+        help='number of genomes per tile when computing the similarity matrix in tiles (defaults to 1024)'
     )
+
+    parser.add_argument(
+        '--mode', metavar='mode', type=str, choices=['exact', 'sketch'], default='exact',
+        help='exact computes the similarity of every pair and plots it, sketch estimates it from minhash sketches for the most similar genomes of each genome only (defaults to exact)'
+    )
+    parser.add_argument(
+        '--num-hashes', metavar='num_hashes', type=int, default=128,
+        help='size of the minhash signature of each genome in sketch mode (defaults to 128)'
+    )
+    parser.add_argument(
+        '--num-bands', metavar='num_bands', type=int, default=32,
+        help='number of locality sensitive hashing bands in sketch mode, must divide the number of hashes (defaults to 32)'
+    )
+    parser.add_argument(
+        '--top-k', metavar='top_k', type=int, default=10,
+        help='number of most similar genomes to report for each genome in sketch mode (defaults to 10)'
+    )
+    parser.add_argument(
+        '--seed', metavar='seed', type=int, default=0,
+        help='seed for the minhash functions in sketch mode (defaults to 0)'
+    )
+    parser.add_argument(
+        '--order', metavar='order', type=str, choices=['label', 'cluster'], default='label',
+        help='label plots the genomes sorted by contig id, cluster in the leaf order of a hierarchical clustering so similar genomes are next to each other (defaults to label)'
+    )
+    parser.add_argument(
+        '--cluster-method', metavar='cluster_method', type=str, choices=['average', 'single', 'complete', 'weighted'], default='average',
+        help='linkage method to cluster the genomes with (defaults to average)'
+    )
+    parser.add_argument(
+        '--memory-budget', metavar='memory_budget', type=int, default=1024,
+        help='megabytes the clustering may take at most, it refuses to start otherwise (defaults to 1024, enough for average linkage of 10000 genomes)'
+    )
+    parser.add_argument(
+        '--max-pixels', metavar='max_pixels', type=int, default=2000,
+        help='largest side of the plotted image in pixels, above this many genomes each pixel is the mean of a block of them (defaults to 2000)'
+    )
+    parser.add_argument(
+        '--max-labels', metavar='max_labels', type=int, default=200,
+        help='above this many genomes the plot has no genome labels (defaults to 200)'
+    )
+    parser.add_argument(
+        '--tiles-dir', metavar='tiles_dir', type=str, default=None,
+        help='also write an image pyramid of the plot for zooming into it to this directory (defaults to none)'
+    )
+    parser.add_argument(
+        '--tile-size', metavar='tile_size', type=int, default=256,
+        help='side of the tiles of the image pyramid in pixels (defaults to 256)'
+    )
+    util.add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    cur_dir = os.getcwd()
+    metrics = util.create_metrics('similarity_heatmap', args, cur_dir)
+    util.create_output_directory_if_not_exists(cur_dir, args.output_dir)
+    output_dir = os.path.join(cur_dir, args.output_dir)
+
+    if args.mode == 'sketch':
+        run_sketch_similarity(args.genomes, output_dir, args.num_hashes, args.num_bands, args.top_k, args.seed, metrics=metrics)
+    else:
+        run_exact_similarity(
+            args.genomes, output_dir, blocked_threshold=args.blocked_threshold, block_size=args.block_size,
+            order=args.order, cluster_method=args.cluster_method, memory_budget=args.memory_budget,
+            max_pixels=args.max_pixels, max_labels=args.max_labels, tiles_dir=args.tiles_dir, tile_size=args.tile_size,
+            metrics=metrics
+        )
+
+    metrics.write_report()
@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import subprocess
+import concurrent.futures
+
+# our utils
+import util
+import parse_cache
+
+# runs the analysis chain (proteins.py -> output/all_proteins.bin -> collate_data.py -> output/genomes.json
+#  -> similarity_heatmap.py, and rarefaction.py next to them) as stages with declared input and output
+#  files, skipping every stage whose outputs are up to date.
+#
+#  a stage is up to date when its fingerprint, a hash of its command line, the contents of its inputs and
+#  of the scripts in this directory, is the one it last ran with and all outputs it wrote then are still
+#  there unchanged. contents are hashed rather than compared by mtime, so a stage whose upstream stage ran
+#  again but wrote the same files does not run again. file hashes are remembered by size and mtime, so
+#  unchanged inputs are not read again on every run.
+#
+#  a stage depends on the stages which write any of its input files and is started as soon as they are
+#  done, up to --concurrency stages run at once, each as its own process with its output going to
+#  output/logs/<stage>.log. fingerprints, file hashes and outputs are kept in output/stage_cache.json.
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+def recursive_args(args):
+    return ['--recursive'] if args.recursive else []
+
+# name, script and arguments, inputs as (path, extension) where the extension is None for a file and
+#  picks the files of a directory otherwise (compressed ones too, and those below it with --recursive),
+#  and every file the stage may write
+STAGES = [
+    {
+        'name' : 'proteins',
+        'args' : lambda a: ['proteins.py', a.directory, '--jobs', str(a.jobs)] + recursive_args(a) + a.proteins_args.split(),
+        'inputs' : lambda a: [(a.directory, '.csv')],
+        'outputs' : [
+            'output/common_proteins.csv', 'output/unique_proteins.csv', 'output/unique_column_proteins.csv', 'output/output_stats.csv',
+            'output/partitions.csv', 'output/frequency_histogram.csv', 'output/all_proteins.bin', 'output/all_proteins.csv'
+        ]
+    },
+    {
+        'name' : 'collate_data',
+        'args' : lambda a: ['collate_data.py', '--all-proteins', 'output/all_proteins.bin', '--subsystems-dir', a.subsystems_dir, '--jobs', str(a.jobs)] + recursive_args(a) + a.collate_args.split(),
+        'inputs' : lambda a: [('output/all_proteins.bin', None), (a.subsystems_dir, '.tsv')],
+        'outputs' : [
+            'output/proteins.json', 'output/proteins.manifest.json', 'output/proteins.bin', 'output/categories.json',
+            'output/genomes.json', 'output/aggregate_cube.npz'
+        ]
+    },
+    {
+        'name' : 'similarity_heatmap',
+        'args' : lambda a: ['similarity_heatmap.py', '--genomes', 'output/genomes.json'] + a.similarity_args.split(),
+        'inputs' : lambda a: [('output/genomes.json', None)],
+        'outputs' : [
+            'output/similarity_matrix.npy', 'output/similarity_labels.json', 'output/similarity_sparse.npz',
+            'output/similarity_nearest.csv', 'output/genome_sketches.npz', 'output/similarity_linkage.npy',
+            'output/similarity_cluster_order.json', 'similarity_order_by_genome.png', 'similarity_order_by_cluster.png'
+        ]
+    },
+    {
+        'name' : 'rarefaction',
+        'args' : lambda a: ['rarefaction.py', a.directory, '--jobs', str(a.jobs)] + recursive_args(a) + a.rarefaction_args.split(),
+        'inputs' : lambda a: [(a.directory, '.csv')],
+        'outputs' : ['output/rarefaction_curves.csv', 'output/rarefaction_curves.png']
+    }
+]
+
+# stage name -> names of the stages among stages writing any of its input files
+def stage_dependencies(stages, args):
+    writers = {}
+    for stage in stages:
+        for output in stage['outputs']:
+            writers[os.path.normpath(output)] = stage['name']
+    return {
+        stage['name'] : sorted(set(
+            writers[os.path.normpath(path)] for (path, ext) in stage['inputs'](args)
+            if ext is None and os.path.normpath(path) in writers and writers[os.path.normpath(path)] != stage['name']
+        ))
+        for stage in stages
+    }
+
+class StageCache:
+
+    def __init__(self, cache_file_path):
+        self.cache_file_path = cache_file_path
+        self.lock = threading.Lock()
+        self.data = {'files' : {}, 'stages' : {}}
+        if os.path.exists(cache_file_path):
+            with open(cache_file_path, 'r') as f:
+                self.data = json.load(f)
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.cache_file_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.data, f)
+            os.replace(tmp_path, self.cache_file_path)
+
+    # content hash of a file, only read again when its size or mtime changed
+    def file_hash(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            cached = self.data['files'].get(path)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime_ns:
+            return cached['sha1']
+        sha1 = parse_cache.hash_file_contents(path)
+        with self.lock:
+            self.data['files'][path] = {'size' : stat.st_size, 'mtime' : stat.st_mtime_ns, 'sha1' : sha1}
+        return sha1
+
+    def input_hashes(self, path, ext, recursive=False):
+        if ext is None:
+            if not os.path.exists(path):
+                raise Exception("missing input: %s" % path)
+            return {path : self.file_hash(path)}
+        if not os.path.isdir(path):
+            raise Exception("missing input directory: %s" % path)
+        file_names = util.get_files_in_folder_with_ext(ext, path, recursive=recursive, compressed=True)
+        return {os.path.join(path, f) : self.file_hash(os.path.join(path, f)) for f in sorted(file_names)}
+
+    def stage(self, name):
+        with self.lock:
+            return self.data['stages'].get(name)
+
+    def record_stage(self, name, entry):
+        with self.lock:
+            self.data['stages'][name] = entry
+
+# the scripts of this directory are part of every fingerprint, a change to any of them (ie. ingest.py,
+#  which all the scripts parsing csv files use) runs every stage again
+def code_hash(cache):
+    h = hashlib.sha1()
+    for f in sorted(util.get_files_in_folder_with_ext(".py", script_dir)):
+        h.update(f.encode('utf-8'))
+        h.update(cache.file_hash(os.path.join(script_dir, f)).encode('utf-8'))
+    return h.hexdigest()
+
+def stage_fingerprint(stage, args, cache, code):
+    inputs = {}
+    for (path, ext) in stage['inputs'](args):
+        inputs.update(cache.input_hashes(path, ext, recursive=args.recursive))
+    description = {'command' : stage['args'](args), 'code' : code, 'inputs' : inputs}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+def outputs_unchanged(recorded_outputs):
+    for (path, recorded) in recorded_outputs.items():
+        if not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        if stat.st_size != recorded['size'] or stat.st_mtime_ns != recorded['mtime']:
+            return False
+    return True
+
+def run_stage(stage, args, cache, code, log_dir, force=False):
+
+    start = time.perf_counter()
+    fingerprint = stage_fingerprint(stage, args, cache, code)
+    fingerprint_seconds = time.perf_counter() - start
+
+    previous = cache.stage(stage['name'])
+    if not force and previous is not None and previous['fingerprint'] == fingerprint and outputs_unchanged(previous['outputs']):
+        return {'name' : stage['name'], 'status' : 'cached', 'seconds' : 0.0, 'fingerprint_seconds' : fingerprint_seconds}
+
+    stage_args = stage['args'](args)
+    command = [sys.executable, os.path.join(script_dir, stage_args[0])] + stage_args[1:]
+    log_file_path = os.path.join(log_dir, '%s.log' % stage['name'])
+    started_at = time.time()
+    with open(log_file_path, 'w') as log_file:
+        log_file.write("[stage_runner] running: %s\n" % " ".join(command))
+        log_file.flush()
+        returncode = subprocess.call(command, stdout=log_file, stderr=subprocess.STDOUT)
+    seconds = time.perf_counter() - start - fingerprint_seconds
+    if returncode != 0:
+        raise Exception("stage %s failed with status %d, see %s" % (stage['name'], returncode, log_file_path))
+
+    # only the outputs written by this run, not ones left from earlier runs with other arguments
+    outputs = {}
+    for path in stage['outputs']:
+        if os.path.exists(path) and os.path.getmtime(path) >= started_at - 1.0:
+            stat = os.stat(path)
+            outputs[path] = {'size' : stat.st_size, 'mtime' : stat.st_mtime_ns}
+    cache.record_stage(stage['name'], {'fingerprint' : fingerprint, 'outputs' : outputs, 'seconds' : seconds})
+
+    return {'name' : stage['name'], 'status' : 'ran', 'seconds' : seconds, 'fingerprint_seconds' : fingerprint_seconds}
+
+# runs the stages (in dependency order, independent ones concurrently), returns a result per stage
+def run_stages(stages, args, cache, concurrency=2, force=False, log_dir='output/logs'):
+
+    dependencies = stage_dependencies(stages, args)
+    code = code_hash(cache)
+
+    pending = list(stages)
+    running = {}
+    results = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while len(pending) > 0 or len(running) > 0:
+
+            for stage in list(pending):
+                stage_deps = [results.get(name) for name in dependencies[stage['name']]]
+                if any(r is not None and r['status'] in ('failed', 'skipped') for r in stage_deps):
+                    pending.remove(stage)
+                    results[stage['name']] = {'name' : stage['name'], 'status' : 'skipped', 'seconds' : 0.0, 'fingerprint_seconds' : 0.0}
+                    print("[stage_runner] skipping %s, a stage it depends on failed" % stage['name'])
+                elif all(r is not None for r in stage_deps) and len(running) < concurrency:
+                    pending.remove(stage)
+                    print("[stage_runner] starting %s" % stage['name'])
+                    running[executor.submit(run_stage, stage, args, cache, code, log_dir, force)] = stage
+
+            if len(running) == 0:
+                if len(pending) > 0:
+                    raise Exception("stages: %s depend on each other, can not run them" % ", ".join(stage['name'] for stage in pending))
+                break
+
+            (finished, _) = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print("[stage_runner] %s" % e)
+                    result = {'name' : stage['name'], 'status' : 'failed', 'seconds' : 0.0, 'fingerprint_seconds' : 0.0}
+                results[stage['name']] = result
+                if result['status'] == 'cached':
+                    print("[stage_runner] %s is up to date (checked in %.2fs)" % (stage['name'], result['fingerprint_seconds']))
+                elif result['status'] == 'ran':
+                    print("[stage_runner] %s ran in %.2fs" % (stage['name'], result['seconds']))
+                # saved after every stage, so the stages done so far are kept if a later one fails
+                cache.save()
+
+    return [results[stage['name']] for stage in stages]
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Runs proteins.py, collate_data.py, similarity_heatmap.py and rarefaction.py, skipping the ones whose outputs are up to date.')
+    parser.add_argument(
+        'directory', type=str, default=os.getcwd(), nargs="?",
+        help='the directory with the csv files of the genomes in it (defaults to current directory)'
+    )
+    parser.add_argument(
+        '--subsystems-dir', metavar='subsystems_dir', type=str, default=None,
+        help='the directory with the files containing the subsystem data in it, needed for collate_data'
+    )
+    parser.add_argument(
+        '--recursive', default=False, action='store_true',
+        help='also read the csv and tsv files in the directories below directory and the subsystems directory'
+    )
+    parser.add_argument(
+        '--stages', metavar='stages', type=str, default=",".join(stage['name'] for stage in STAGES),
+        help='comma separated stages to run (defaults to all: %s)' % ",".join(stage['name'] for stage in STAGES)
+    )
+    parser.add_argument(
+        '--concurrency', metavar='concurrency', type=int, default=2,
+        help='number of stages to run at once when they do not depend on each other (defaults to 2)'
+    )
+    parser.add_argument(
+        '--jobs', metavar='jobs', type=int, default=1,
+        help='number of worker processes for every stage which takes --jobs (defaults to 1)'
+    )
+    parser.add_argument(
+        '--proteins-args', metavar='proteins_args', type=str, default='',
+        help='further arguments to run proteins.py with, ie. "--core-threshold 0.9" (defaults to none)'
+    )
+    parser.add_argument(
+        '--collate-args', metavar='collate_args', type=str, default='',
+        help='further arguments to run collate_data.py with (defaults to none)'
+    )
+    parser.add_argument(
+        '--similarity-args', metavar='similarity_args', type=str, default='',
+        help='further arguments to run similarity_heatmap.py with, ie. "--mode sketch" (defaults to none)'
+    )
+    parser.add_argument(
+        '--rarefaction-args', metavar='rarefaction_args', type=str, default='',
+        help='further arguments to run rarefaction.py with (defaults to none)'
+    )
+    parser.add_argument(
+        '--cache', metavar='cache', type=str, default='output/stage_cache.json',
+        help='file to keep the fingerprints and outputs of the stages in (defaults to output/stage_cache.json)'
+    )
+    parser.add_argument(
+        '--report', metavar='report', type=str, default='output/stage_report.json',
+        help='file to write whether each stage ran or was up to date, and how long it took, to (defaults to output/stage_report.json)'
+    )
+    parser.add_argument(
+        '--force', default=False, action='store_true',
+        help='run every stage even if its outputs are up to date'
+    )
+
+    args = parser.parse_args()
+    cur_dir = os.getcwd()
+
+    stage_names = args.stages.split(",")
+    unknown_stages = [name for name in stage_names if name not in [stage['name'] for stage in STAGES]]
+    if len(unknown_stages) > 0:
+        parser.error("unknown stages: %s, expected any of: %s" % (", ".join(unknown_stages), ", ".join(stage['name'] for stage in STAGES)))
+    if 'collate_data' in stage_names and args.subsystems_dir is None:
+        parser.error("the collate_data stage needs --subsystems-dir")
+
+    util.create_output_directory_if_not_exists(cur_dir)
+    log_dir = os.path.join(cur_dir, 'output', 'logs')
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    # only dependencies between the stages being run count, the inputs of a stage left out have to exist
+    stages = [stage for stage in STAGES if stage['name'] in stage_names]
+    cache = StageCache(os.path.join(cur_dir, args.cache))
+
+    start = time.perf_counter()
+    results = run_stages(stages, args, cache, concurrency=args.concurrency, force=args.force, log_dir=log_dir)
+    total_seconds = time.perf_counter() - start
+
+    for result in results:
+        print("[stage_runner] %-20s %-8s %8.2fs (fingerprint %.2fs)" % (result['name'], result['status'], result['seconds'], result['fingerprint_seconds']))
+    print("[stage_runner] %d of %d stages up to date, %d ran, took %.2fs" % (
+        sum(1 for r in results if r['status'] == 'cached'), len(results), sum(1 for r in results if r['status'] == 'ran'), total_seconds
+    ))
+
+    with open(os.path.join(cur_dir, args.report), 'w') as f:
+        json.dump({'seconds' : total_seconds, 'stages' : results}, f, indent=2)
+
+    if any(r['status'] in ('failed', 'skipped') for r in results):
+        sys.exit(1)
@@ -0,0 +1,88 @@
+import csv
+import multiprocessing
+
+# our utils
+import util
+
+# joins the subsystem tables (.tsv) of each genome onto the figfams of all proteins, every file is
+#  read and joined on its own (in worker processes when asked to) and the results are merged in the
+#  order of the files after.
+#
+#  a row of a subsystem table lists the features it was annotated on, every one of them is looked up,
+#  so a row applies to each distinct figfam among its features. a row none of whose features are in
+#  any figfam is skipped.
+
+# feature id -> figfam, set in each worker before any file is joined
+feature_id_to_fig_mapping = {}
+
+def set_feature_mapping(mapping):
+    global feature_id_to_fig_mapping
+    feature_id_to_fig_mapping = mapping
+
+def join_subsystems_tsv(file_name):
+
+    annotations = {}
+    processed_rows = 0
+    skipped_rows = 0
+
+    with util.open_text(file_name, 'r') as csvfile:
+
+        reader = csv.DictReader(csvfile, delimiter='\t')
+
+        for row in reader:
+
+            annotation = (row['Category'], row['Subcategory'], row['Subsystem'], row['Role'])
+            features = [f.strip() for f in row['Features'].split(",")]
+            figs = dict.fromkeys(feature_id_to_fig_mapping[f] for f in features if f in feature_id_to_fig_mapping)
+
+            if len(figs) == 0:
+                skipped_rows += 1
+                continue
+
+            processed_rows += 1
+            for fig in figs:
+                annotations.setdefault(fig, []).append(annotation)
+
+    return {
+        'file_name' : file_name,
+        'annotations' : annotations,
+        'processed_rows' : processed_rows,
+        'skipped_rows' : skipped_rows
+    }
+
+def join_subsystems_tsvs(file_names, mapping, jobs=1):
+    if jobs <= 1 or len(file_names) <= 1:
+        set_feature_mapping(mapping)
+        return [join_subsystems_tsv(f) for f in file_names]
+    # the mapping is handed to each worker once, not with every file
+    with multiprocessing.Pool(processes=min(jobs, len(file_names)), initializer=set_feature_mapping, initargs=(mapping,)) as pool:
+        return pool.map(join_subsystems_tsv, file_names, chunksize=max(1, len(file_names) // (jobs * 4)))
+
+# applies the joined annotations to all_protein_data and all_category_data in file order, every figfam
+#  keeps the category/subcategory/subsystem/role of the last row joined onto it (as before) and the
+#  distinct annotations of all rows joined onto it in 'annotations'
+def merge_subsystem_results(results, all_protein_data, all_category_data):
+
+    totals = {'processed_rows' : 0, 'skipped_rows' : 0}
+
+    for result in results:
+
+        for (fig, annotations) in result['annotations'].items():
+            data = all_protein_data[fig]
+            recorded = data.setdefault('annotations', [])
+            for (category, subcategory, subsystem, role) in annotations:
+                data['category'] = category
+                data['subcategory'] = subcategory
+                data['subsystem'] = subsystem
+                data['role'] = role
+                if [category, subcategory, subsystem, role] not in recorded:
+                    recorded.append([category, subcategory, subsystem, role])
+
+                all_category_data[subcategory] = category
+                all_category_data[subsystem] = subcategory
+                all_category_data[role] = subsystem
+
+        totals['processed_rows'] += result['processed_rows']
+        totals['skipped_rows'] += result['skipped_rows']
+
+    return totals
@@ -0,0 +1,186 @@
+import os
+import csv
+import argparse
+import multiprocessing
+import numpy
+
+# seeded generator of RAST classification csv files and subsystem tables, with the same columns as the
+#  real ones, for benchmarking at scales we have no shareable data for.
+#
+#  there is a pool of figfams, each with how common it is across genomes drawn from a u-shaped beta
+#  distribution (most figfams are in nearly all or nearly no genomes, as in real pan genomes), and each
+#  genome has each figfam with that probability, sometimes more than once (paralogs). a fraction of the
+#  features with a figfam are hypothetical proteins, and every genome also has features with no figfam
+#  at all. a fraction of the figfams belong to a role in the category/subcategory/subsystem/role
+#  hierarchy, and the subsystem table of a genome lists the features of its figfams in each role.
+#
+#  the same seed and sizes always give the same files, each genome is generated from its own seed so
+#  genomes can be generated in worker processes.
+
+CLASSIFICATION_FIELDS = ['contig_id', 'feature_id', 'type', 'location', 'start', 'stop', 'strand', 'function', 'aliases', 'figfam', 'evidence_codes', 'nucleotide_sequence', 'aa_sequence']
+SUBSYSTEM_FIELDS = ['Category', 'Subcategory', 'Subsystem', 'Role', 'Features']
+
+FIRST_GENOME_ID = 100000
+
+def default_parameters():
+    return {
+        'genomes' : 100,
+        'proteins' : 5000,
+        'seed' : 0,
+        'prevalence_alpha' : 0.25,
+        'paralog_fraction' : 0.03,
+        'hypothetical_fraction' : 0.15,
+        'no_figfam_fraction' : 0.05,
+        'subsystem_fraction' : 0.4,
+        'contigs_per_genome' : 50
+    }
+
+# the figfam pool and hierarchy, the same for every genome
+def generate_pool(params):
+    rng = numpy.random.RandomState(params['seed'])
+    total_proteins = params['proteins']
+    prevalence = rng.beta(params['prevalence_alpha'], params['prevalence_alpha'], size=total_proteins)
+    is_hypothetical = rng.rand(total_proteins) < params['hypothetical_fraction']
+    functions = ['hypothetical protein' if is_hypothetical[i] else 'Synthetic protein %d' % i for i in range(total_proteins)]
+
+    # roughly 30 categories of 4 subcategories of 5 subsystems of 6 roles, a role has one or more figfams
+    roles = {}
+    for i in numpy.flatnonzero(rng.rand(total_proteins) < params['subsystem_fraction']).tolist():
+        role = int(rng.randint(0, max(1, total_proteins // 3)))
+        subsystem = role // 6
+        subcategory = subsystem // 5
+        category = subcategory // 4
+        roles[i] = (
+            'Category %d' % category,
+            'Subcategory %d' % subcategory,
+            'Subsystem %d' % subsystem,
+            'Role %d' % role
+        )
+
+    return {
+        'prevalence' : prevalence,
+        'functions' : functions,
+        'roles' : roles
+    }
+
+def generate_genome(params, pool, genome_idx, classification_dir, subsystems_dir):
+
+    rng = numpy.random.RandomState([params['seed'], genome_idx])
+    genome_id = FIRST_GENOME_ID + genome_idx
+    total_proteins = params['proteins']
+
+    present = numpy.flatnonzero(rng.rand(total_proteins) < pool['prevalence'])
+    copies = 1 + (rng.rand(len(present)) < params['paralog_fraction'])
+    total_no_figfam = int(len(present) * params['no_figfam_fraction'])
+
+    # shuffled so paralogs and features without figfams are spread over the genome
+    fig_rows = numpy.repeat(present, copies)
+    rows = numpy.concatenate([fig_rows, numpy.full(total_no_figfam, -1, dtype=fig_rows.dtype)])
+    rng.shuffle(rows)
+    contigs = numpy.sort(rng.randint(1, params['contigs_per_genome'] + 1, size=len(rows)))
+
+    fig_features = {}
+    rows_written = 0
+
+    classification_path = os.path.join(classification_dir, '%d.csv' % genome_id)
+    with open(classification_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, dialect="excel")
+        writer.writerow(CLASSIFICATION_FIELDS)
+        position = 0
+        for (n, (fig, contig)) in enumerate(zip(rows.tolist(), contigs.tolist())):
+            feature_id = 'fig|%d.peg.%d' % (genome_id, n + 1)
+            length = 300 + (n * 7919) % 2700
+            if fig >= 0:
+                figfam = 'FIG%08d' % fig
+                function = pool['functions'][fig]
+                fig_features.setdefault(fig, []).append(feature_id)
+            else:
+                figfam = ''
+                function = 'tRNA-Synthetic-%d' % (n % 40)
+            writer.writerow([
+                '%d_%d' % (genome_id, contig), feature_id, 'peg', '%d_%d_%d_%d' % (genome_id, contig, position + 1, position + length),
+                position + 1, position + length, '+', function, '', figfam, '', '', ''
+            ])
+            position += length + 50
+            rows_written += 1
+
+    # one row per role, with the features of all figfams of that role in this genome
+    role_features = {}
+    for (fig, features) in fig_features.items():
+        if fig in pool['roles']:
+            role_features.setdefault(pool['roles'][fig], []).extend(features)
+
+    subsystems_path = os.path.join(subsystems_dir, '%d_subsystems.tsv' % genome_id)
+    with open(subsystems_path, 'w', newline='') as tsvfile:
+        writer = csv.writer(tsvfile, delimiter='\t')
+        writer.writerow(SUBSYSTEM_FIELDS)
+        for (hierarchy, features) in sorted(role_features.items()):
+            writer.writerow(list(hierarchy) + [', '.join(features)])
+
+    return (rows_written, len(role_features))
+
+def generate_genome_job(job):
+    return generate_genome(*job)
+
+# writes <genome id>.csv files to classification_dir and <genome id>_subsystems.tsv files to
+#  subsystems_dir, returns the total number of classification and subsystem rows written
+def generate_dataset(params, classification_dir, subsystems_dir, jobs=1):
+    for d in (classification_dir, subsystems_dir):
+        if not os.path.exists(d):
+            os.makedirs(d)
+    pool = generate_pool(params)
+    genome_jobs = [(params, pool, g, classification_dir, subsystems_dir) for g in range(params['genomes'])]
+    if jobs <= 1:
+        results = [generate_genome_job(job) for job in genome_jobs]
+    else:
+        with multiprocessing.Pool(processes=jobs) as worker_pool:
+            results = worker_pool.map(generate_genome_job, genome_jobs, chunksize=max(1, len(genome_jobs) // (jobs * 4)))
+    return (sum(r[0] for r in results), sum(r[1] for r in results))
+
+if __name__ == '__main__':
+
+    defaults = default_parameters()
+
+    parser = argparse.ArgumentParser(description='Generates synthetic RAST classification csv files and subsystem tables for benchmarking.')
+    parser.add_argument(
+        'directory', type=str,
+        help='the directory to write to, classification csv files go in it and subsystem tables in its subsystems directory'
+    )
+    parser.add_argument(
+        '--genomes', metavar='genomes', type=int, default=defaults['genomes'],
+        help='number of genomes to generate (defaults to %d)' % defaults['genomes']
+    )
+    parser.add_argument(
+        '--proteins', metavar='proteins', type=int, default=defaults['proteins'],
+        help='number of distinct figfams in the pan genome to draw from (defaults to %d)' % defaults['proteins']
+    )
+    parser.add_argument(
+        '--seed', metavar='seed', type=int, default=defaults['seed'],
+        help='seed to generate from, the same seed and sizes give the same files (defaults to %d)' % defaults['seed']
+    )
+    parser.add_argument(
+        '--hypothetical-fraction', metavar='hypothetical_fraction', type=float, default=defaults['hypothetical_fraction'],
+        help='fraction of figfams that are hypothetical proteins (defaults to %.2f)' % defaults['hypothetical_fraction']
+    )
+    parser.add_argument(
+        '--subsystem-fraction', metavar='subsystem_fraction', type=float, default=defaults['subsystem_fraction'],
+        help='fraction of figfams that are in a subsystem (defaults to %.2f)' % defaults['subsystem_fraction']
+    )
+    parser.add_argument(
+        '--jobs', metavar='jobs', type=int, default=1,
+        help='number of worker processes to generate genomes with (defaults to 1, no worker processes)'
+    )
+
+    args = parser.parse_args()
+
+    params = default_parameters()
+    params['genomes'] = args.genomes
+    params['proteins'] = args.proteins
+    params['seed'] = args.seed
+    params['hypothetical_fraction'] = args.hypothetical_fraction
+    params['subsystem_fraction'] = args.subsystem_fraction
+
+    (classification_rows, subsystem_rows) = generate_dataset(
+        params, args.directory, os.path.join(args.directory, 'subsystems'), jobs=args.jobs
+    )
+    print("[synthetic_data] wrote %d genomes (%d classification rows, %d subsystem rows) to: %s" % (args.genomes, classification_rows, subsystem_rows, args.directory))
@@ -0,0 +1,221 @@
+import os
+import io
+import csv
+import sys
+import time
+import argparse
+import tempfile
+import http.server
+import socketserver
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# our utils
+import synthetic_data
+
+# local stand-ins for the RAST command line tools and the pages of the RAST web site rast_cli.py and
+#  rast_web.py use, so the submit, fetch and pipeline scripts can be run without a RAST account.
+#
+#  svr_submit_RAST_job, svr_status_of_RAST_job and svr_retrieve_RAST_job in this directory call the
+#  functions below. jobs are files job_<id> in the directory in FAKE_RAST_DIR, created when a fasta
+#  file is submitted, and a job is complete FAKE_RAST_RUN_SECONDS after that. submitting a file whose
+#  name contains FAKE_RAST_FAIL fails, like a rejected upload, and the export of the jobs listed in
+#  FAKE_RAST_EXPIRED_EXPORTS (comma separated) gives the login form back, like an expired session.
+#
+#  job n is genome n of synthetic_data.py (always with the same parameters), the classification it
+#  retrieves and the subsystem table the web site exports for it are that genome's files, so the
+#  features of both agree as they do for real jobs. every export is served under the same file name.
+
+FIRST_JOB_ID = 1
+EXPORT_FILE_NAME = 'Subsystems.tsv'
+
+def synthetic_parameters():
+    params = synthetic_data.default_parameters()
+    params['proteins'] = 200
+    params['contigs_per_genome'] = 5
+    return params
+
+def state_dir():
+    if 'FAKE_RAST_DIR' not in os.environ:
+        raise Exception("expected FAKE_RAST_DIR to be set to the directory to keep the jobs in")
+    return os.environ['FAKE_RAST_DIR']
+
+def job_path(job_id):
+    return os.path.join(state_dir(), 'job_%d' % job_id)
+
+def is_complete(job_id):
+    path = job_path(job_id)
+    run_seconds = float(os.environ.get('FAKE_RAST_RUN_SECONDS', '0'))
+    return os.path.exists(path) and time.time() - os.path.getmtime(path) >= run_seconds
+
+# the classification csv and subsystem table of the genome of a job, as (csv text, tsv text)
+def job_files(job_id):
+    params = synthetic_parameters()
+    genome_idx = job_id - FIRST_JOB_ID
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        synthetic_data.generate_genome(params, synthetic_data.generate_pool(params), genome_idx, tmp_dir, tmp_dir)
+        genome_id = synthetic_data.FIRST_GENOME_ID + genome_idx
+        with open(os.path.join(tmp_dir, '%d.csv' % genome_id), 'r', newline='') as f:
+            classification = f.read()
+        with open(os.path.join(tmp_dir, '%d_subsystems.tsv' % genome_id), 'r', newline='') as f:
+            subsystems = f.read()
+    return (classification, subsystems)
+
+def parse_tool_args(description, positional):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--user', type=str, required=True)
+    parser.add_argument('--passwd', type=str, required=True)
+    for name in positional:
+        parser.add_argument(name, type=str)
+    return parser
+
+def submit_main():
+    parser = parse_tool_args('Stand-in for svr_submit_RAST_job.', [])
+    parser.add_argument('--domain', type=str, required=True)
+    parser.add_argument('--fasta', type=str, required=True)
+    args = parser.parse_args()
+
+    time.sleep(float(os.environ.get('FAKE_RAST_SUBMIT_SECONDS', '0.1')))
+    if not os.path.exists(args.fasta):
+        print("fasta file %s does not exist" % args.fasta)
+        sys.exit(1)
+    fail_pattern = os.environ.get('FAKE_RAST_FAIL')
+    if fail_pattern and fail_pattern in os.path.basename(args.fasta):
+        print("upload of %s failed" % args.fasta)
+        sys.exit(1)
+
+    # the first free job id, creating the job file claims it even with submissions running at once
+    job_id = FIRST_JOB_ID
+    while True:
+        try:
+            fd = os.open(job_path(job_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            job_id += 1
+    with os.fdopen(fd, 'w') as f:
+        f.write(os.path.abspath(args.fasta) + '\n')
+    print("job id '%d'" % job_id)
+
+def status_main():
+    args = parse_tool_args('Stand-in for svr_status_of_RAST_job.', ['job_id']).parse_args()
+    job_id = int(args.job_id)
+    if not os.path.exists(job_path(job_id)):
+        print("%d: deleted" % job_id)
+    else:
+        print("%d: %s" % (job_id, 'complete' if is_complete(job_id) else 'running'))
+
+def retrieve_main():
+    args = parse_tool_args('Stand-in for svr_retrieve_RAST_job.', ['job_id', 'format']).parse_args()
+    job_id = int(args.job_id)
+    if not is_complete(job_id) or args.format != 'spreadsheet_tab':
+        sys.stderr.write("job %d is not complete or format %s is not supported\n" % (job_id, args.format))
+        sys.exit(1)
+    (classification, _) = job_files(job_id)
+    writer = csv.writer(sys.stdout, delimiter='\t', lineterminator='\n')
+    for row in csv.reader(io.StringIO(classification)):
+        writer.writerow(row)
+
+# pages of the web site, just enough of them for rast_web.py: the login form, the job details page
+#  linking to the SEED viewer, the viewer page with the export form and the export itself
+
+login_form = """<html><form method="post" action="rast.cgi">
+<input type="hidden" name="action" value="perform_login">
+<input type="text" name="login"><input type="password" name="password">
+<input type="submit" value="Login">
+</form></html>"""
+
+job_details_page = """<html><h1>Job %d</h1>
+<a href="seedviewer.cgi?page=Organism&amp;organism=%d.3">Browse annotated genome in SEED Viewer</a>
+</html>"""
+
+job_running_page = """<html><h1>Job %d</h1><p>not finished yet</p></html>"""
+
+organism_page = """<html><h2>Features in Subsystems</h2>
+<form method="get" action="seedviewer.cgi">
+<input type="hidden" name="page" value="Organism"><input type="hidden" name="organism" value="%s">
+<input type="button" name="export" value="export to file">
+</form></html>"""
+
+class FakeRastServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class FakeRastRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    # set up before the server starts
+    username = None
+    password = None
+
+    def send_page(self, status, body, content_type='text/html', headers=None):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def logged_in(self):
+        return 'session=%s' % self.username in self.headers.get('Cookie', '')
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/rast.cgi' and params.get('page') == 'JobDetails':
+            if not self.logged_in():
+                return self.send_page(200, login_form)
+            job_id = int(params['job'])
+            if not is_complete(job_id):
+                return self.send_page(200, job_running_page % job_id)
+            return self.send_page(200, job_details_page % (job_id, synthetic_data.FIRST_GENOME_ID + job_id - FIRST_JOB_ID))
+        elif url.path == '/rast.cgi':
+            return self.send_page(200, login_form)
+        elif url.path == '/seedviewer.cgi' and self.logged_in() and 'organism' in params:
+            genome_id = int(params['organism'].split('.')[0])
+            if params.get('export') != 'export to file':
+                return self.send_page(200, organism_page % params['organism'])
+            job_id = genome_id - synthetic_data.FIRST_GENOME_ID + FIRST_JOB_ID
+            if str(job_id) in os.environ.get('FAKE_RAST_EXPIRED_EXPORTS', '').split(','):
+                return self.send_page(200, login_form)
+            (_, subsystems) = job_files(job_id)
+            return self.send_page(200, subsystems, 'text/tab-separated-values', {
+                'Content-Disposition' : 'attachment; filename="%s"' % EXPORT_FILE_NAME
+            })
+        self.send_page(404, "not found")
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', '0'))
+        fields = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode('utf-8')))
+        if fields.get('action') == 'perform_login' and fields.get('login') == self.username and fields.get('password') == self.password:
+            return self.send_page(200, "<html>logged in</html>", headers={'Set-Cookie' : 'session=%s' % self.username})
+        self.send_page(200, login_form)
+
+    def log_message(self, format, *args):
+        pass
+
+# serves the pages on host:port (port 0 for any free port), the real port is server.server_address[1]
+def create_server(host, port, username, password):
+    handler = type('Handler', (FakeRastRequestHandler,), {'username' : username, 'password' : password})
+    return FakeRastServer((host, port), handler)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serves stand-ins for the pages of the RAST web site, for the jobs in FAKE_RAST_DIR.')
+    parser.add_argument(
+        '--port', metavar='port', type=int, default=8001,
+        help='port to listen on (defaults to 8001)'
+    )
+    parser.add_argument(
+        '--username', metavar='username', type=str, default='user',
+        help='username to accept (defaults to user)'
+    )
+    parser.add_argument(
+        '--password', metavar='password', type=str, default='password',
+        help='password to accept (defaults to password)'
+    )
+
+    args = parser.parse_args()
+    server = create_server('127.0.0.1', args.port, args.username, args.password)
+    print("[fake_rast] serving on http://127.0.0.1:%d/" % server.server_address[1])
+    server.serve_forever()
@@ -0,0 +1,83 @@
+import os
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+import ingest
+import proteins
+import pangenome
+import synthetic_data
+
+# adding genomes to or removing them from a pan-genome state has to give the same spreadsheets as
+#  building a new state from the genomes it ends up with, in the order it keeps them in (added genomes
+#  last). states are built from genomes in a given order, load_genomes reads them in directory order
+
+TOTAL_GENOMES = 6
+
+def read_outputs(output_dir):
+    outputs = {}
+    for name in sorted(os.listdir(output_dir)):
+        if name != 'pangenome_delta.csv':
+            with open(os.path.join(output_dir, name), 'rb') as f:
+                outputs[name] = f.read()
+    return outputs
+
+class PangenomeUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.genomes_dir = os.path.join(self.tmp.name, 'genomes')
+        params = synthetic_data.default_parameters()
+        params['genomes'] = TOTAL_GENOMES
+        params['proteins'] = 300
+        synthetic_data.generate_dataset(params, self.genomes_dir, os.path.join(self.tmp.name, 'subsystems'))
+        self.file_names = sorted(f for f in os.listdir(self.genomes_dir) if f.endswith('.csv'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    # builds a state of the genome files in the given order in a directory of its own, returns (state
+    #  path, output dir)
+    def build(self, name, file_names):
+        work_dir = os.path.join(self.tmp.name, name)
+        output_dir = os.path.join(work_dir, 'output')
+        os.makedirs(output_dir)
+        parsed_files = [ingest.parse_genome_csv(os.path.join(self.genomes_dir, file_name)) for file_name in file_names]
+        for (result, file_name) in zip(parsed_files, file_names):
+            result['file_name'] = file_name
+        state_file_path = os.path.join(work_dir, 'state.sqlite')
+        analysis = pangenome.build_state(state_file_path, parsed_files)
+        proteins.write_protein_outputs(analysis, output_dir, export_csv=True)
+        return (state_file_path, output_dir)
+
+    def assert_same_outputs(self, output_dir, file_names):
+        (_, rebuilt_output_dir) = self.build('rebuilt_%d' % len(os.listdir(self.tmp.name)), file_names)
+        rebuilt = read_outputs(rebuilt_output_dir)
+        updated = read_outputs(output_dir)
+        self.assertEqual(sorted(updated), sorted(rebuilt))
+        for name in rebuilt:
+            self.assertEqual(updated[name], rebuilt[name], name)
+
+    def test_add(self):
+        (state_file_path, output_dir) = self.build('updated', self.file_names[:-1])
+        pangenome.update_state(state_file_path, output_dir, add_files=[os.path.join(self.genomes_dir, self.file_names[-1])], write_all=True, export_csv=True)
+        self.assert_same_outputs(output_dir, self.file_names)
+
+    def test_remove(self):
+        for removed in [self.file_names[0], self.file_names[TOTAL_GENOMES // 2], self.file_names[-1]]:
+            with self.subTest(removed=removed):
+                (state_file_path, output_dir) = self.build('updated_%s' % removed, self.file_names)
+                pangenome.update_state(state_file_path, output_dir, remove_genomes=[removed], write_all=True, export_csv=True)
+                self.assert_same_outputs(output_dir, [f for f in self.file_names if f != removed])
+
+    def test_add_then_remove(self):
+        (state_file_path, output_dir) = self.build('updated', self.file_names[:-1])
+        pangenome.update_state(state_file_path, output_dir, add_files=[os.path.join(self.genomes_dir, self.file_names[-1])])
+        pangenome.update_state(state_file_path, output_dir, remove_genomes=[self.file_names[1]], write_all=True, export_csv=True)
+        self.assert_same_outputs(output_dir, [f for f in self.file_names if f != self.file_names[1]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+import proteins
+import synthetic_data
+
+# genomes read through the parse cache, when it is filled and when it is read back, have to give the
+#  same spreadsheets as genomes parsed without it
+
+def read_outputs(output_dir):
+    outputs = {}
+    for name in sorted(os.listdir(output_dir)):
+        with open(os.path.join(output_dir, name), 'rb') as f:
+            outputs[name] = f.read()
+    return outputs
+
+class ParseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.genomes_dir = os.path.join(self.tmp.name, 'genomes')
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+        params = synthetic_data.default_parameters()
+        params['genomes'] = 5
+        params['proteins'] = 300
+        synthetic_data.generate_dataset(params, self.genomes_dir, os.path.join(self.tmp.name, 'subsystems'))
+        # a compressed genome goes through the cache too
+        with open(os.path.join(self.genomes_dir, '100004.csv'), 'rb') as f, gzip.open(os.path.join(self.genomes_dir, '100004.csv.gz'), 'wb') as gz:
+            shutil.copyfileobj(f, gz)
+        os.remove(os.path.join(self.genomes_dir, '100004.csv'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def outputs(self, name, cache_dir=None, jobs=1):
+        output_dir = os.path.join(self.tmp.name, name)
+        os.mkdir(output_dir)
+        parsed_files = proteins.load_genomes(self.genomes_dir, jobs=jobs, cache_dir=cache_dir)
+        proteins.write_protein_outputs(proteins.analyse_proteins(parsed_files), output_dir, export_csv=True)
+        return read_outputs(output_dir)
+
+    def assert_same_outputs(self, outputs, expected):
+        self.assertEqual(sorted(outputs), sorted(expected))
+        for name in expected:
+            self.assertEqual(outputs[name], expected[name], name)
+
+    def test_cached_outputs(self):
+        uncached = self.outputs('uncached')
+        self.assert_same_outputs(self.outputs('cold', self.cache_dir), uncached)
+        self.assertGreater(len(os.listdir(self.cache_dir)), 1)
+        self.assert_same_outputs(self.outputs('warm', self.cache_dir), uncached)
+        self.assert_same_outputs(self.outputs('warm_jobs', self.cache_dir, jobs=2), uncached)
+
+    def test_changed_file(self):
+        self.outputs('cold', self.cache_dir)
+        # a genome changed after it was cached is parsed again
+        path = os.path.join(self.genomes_dir, '100001.csv')
+        with open(path, 'r') as f:
+            lines = f.readlines()
+        with open(path, 'w') as f:
+            f.writelines(lines[:len(lines) // 2])
+        self.assert_same_outputs(self.outputs('warm', self.cache_dir), self.outputs('uncached'))
+
+if __name__ == '__main__':
+    unittest.main()
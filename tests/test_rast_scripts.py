@@ -0,0 +1,232 @@
+import os
+import csv
+import sys
+import random
+import sqlite3
+import tempfile
+import threading
+import subprocess
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+FAKE_RAST_DIR = os.path.join(TESTS_DIR, 'fake_rast')
+
+sys.path.insert(0, FAKE_RAST_DIR)
+import fake_rast
+
+# runs fasta_submit_bacteria.py, fetch_subsystems.py and pipeline.py against the stand-ins in
+#  tests/fake_rast, the tools on PATH and the web site on a local port
+
+USERNAME = 'user'
+PASSWORD = 'secret'
+
+def write_fasta(path, seed, contigs=3, contig_length=40000):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for c in range(contigs):
+            f.write(">contig_%d\n" % (c + 1))
+            sequence = ''.join(rng.choice('ACGT') for _ in range(contig_length))
+            for i in range(0, len(sequence), 80):
+                f.write(sequence[i:i + 80] + "\n")
+
+def read_journal_rows(journal_path):
+    with open(journal_path, 'r') as f:
+        return list(csv.DictReader(f))
+
+class RastScriptsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = fake_rast.create_server('127.0.0.1', 0, USERNAME, PASSWORD)
+        cls.base_url = 'http://127.0.0.1:%d/' % cls.server.server_address[1]
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.work_dir = self.tmp.name
+        self.fasta_dir = os.path.join(self.work_dir, 'fasta')
+        self.jobs_dir = os.path.join(self.work_dir, 'jobs')
+        os.mkdir(self.fasta_dir)
+        os.mkdir(self.jobs_dir)
+        for n in range(3):
+            write_fasta(os.path.join(self.fasta_dir, 'genome_%d.fa' % n), n)
+        # the server runs in this process, the tools in subprocesses, both keep the jobs in FAKE_RAST_DIR
+        self.env = dict(os.environ)
+        self.env['PATH'] = FAKE_RAST_DIR + os.pathsep + self.env.get('PATH', '')
+        self.env['FAKE_RAST_DIR'] = self.jobs_dir
+        self.env['FAKE_RAST_RUN_SECONDS'] = '0.5'
+        self.env['FAKE_RAST_SUBMIT_SECONDS'] = '0.05'
+        os.environ['FAKE_RAST_DIR'] = self.jobs_dir
+        os.environ['FAKE_RAST_RUN_SECONDS'] = '0'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_script(self, script, args, env=None):
+        result = subprocess.run(
+            [sys.executable, os.path.join(REPO_DIR, script)] + args, cwd=self.work_dir, env=env or self.env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True
+        )
+        self.assertEqual(result.returncode, 0, result.stdout)
+        return result.stdout
+
+    def submit(self, env=None):
+        return self.run_script('fasta_submit_bacteria.py', [
+            '--username', USERNAME, '--password', PASSWORD, '--retries', '0', '--backoff', '0', self.fasta_dir
+        ], env)
+
+    def test_submit_journal_and_resume(self):
+        journal_path = os.path.join(self.work_dir, 'output', 'submitted_jobs.csv')
+
+        # a failed upload is journaled as such
+        failing_env = dict(self.env, FAKE_RAST_FAIL='genome_2')
+        self.submit(failing_env)
+        rows = read_journal_rows(journal_path)
+        self.assertEqual(sorted((r['file_name'], r['success']) for r in rows), [('genome_0.fa', 'True'), ('genome_1.fa', 'True'), ('genome_2.fa', 'False')])
+        self.assertEqual([r['job_id'] for r in rows if r['success'] == 'False'], ['-1'])
+        first_jobs = {r['file_name'] : r['job_id'] for r in rows if r['success'] == 'True'}
+        self.assertEqual(len(set(first_jobs.values())), 2)
+
+        # a rerun only submits the file which failed, the others keep their jobs
+        output = self.submit()
+        self.assertIn("total jobs to submit: 1", output)
+        rows = read_journal_rows(journal_path)
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[-1]['file_name'], 'genome_2.fa')
+        self.assertEqual(rows[-1]['success'], 'True')
+        self.assertNotIn(rows[-1]['job_id'], first_jobs.values())
+
+        # and with nothing left, nothing is submitted
+        output = self.submit()
+        self.assertIn("total jobs to submit: 0", output)
+        self.assertEqual(len(read_journal_rows(journal_path)), 4)
+        self.assertEqual(len(os.listdir(self.jobs_dir)), 3)
+
+    # worker processes started with spawn (the default on macOS and Windows) import the script again
+    def test_submit_with_spawned_preflight_workers(self):
+        spawn_and_run = "; ".join([
+            "import sys, runpy, multiprocessing",
+            "multiprocessing.set_start_method('spawn')",
+            "sys.path.insert(0, %r)" % REPO_DIR,
+            "sys.argv = sys.argv[1:]",
+            "runpy.run_path(sys.argv[0], run_name='__main__')"
+        ])
+        result = subprocess.run(
+            [sys.executable, '-c', spawn_and_run, os.path.join(REPO_DIR, 'fasta_submit_bacteria.py'),
+             '--username', USERNAME, '--password', PASSWORD, '--preflight-jobs', '2', self.fasta_dir],
+            cwd=self.work_dir, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=60
+        )
+        self.assertEqual(result.returncode, 0, result.stdout)
+        self.assertEqual(len(read_journal_rows(os.path.join(self.work_dir, 'output', 'submitted_jobs.csv'))), 3)
+        self.assertEqual(len(os.listdir(self.jobs_dir)), 3)
+
+    def test_fetch_subsystems(self):
+        self.submit(dict(self.env, FAKE_RAST_RUN_SECONDS='0'))
+        journal_path = os.path.join(self.work_dir, 'output', 'submitted_jobs.csv')
+        job_ids = [r['job_id'] for r in read_journal_rows(journal_path)]
+
+        subsystems_dir = os.path.join(self.work_dir, 'subsystems')
+        os.mkdir(subsystems_dir)
+        output = self.run_script('fetch_subsystems.py', [
+            '--username', USERNAME, '--password', PASSWORD, '--filename', journal_path,
+            '--output-dir', subsystems_dir, '--base-url', self.base_url
+        ])
+        self.assertIn("fetched 3 tables, 0 failed", output)
+
+        # every job gets its own table, although the server names all of them the same
+        self.assertEqual(sorted(os.listdir(subsystems_dir)), sorted('%s_subsystems.tsv' % job_id for job_id in job_ids))
+        for job_id in job_ids:
+            with open(os.path.join(subsystems_dir, '%s_subsystems.tsv' % job_id), 'r', newline='') as f:
+                self.assertEqual(f.read(), fake_rast.job_files(int(job_id))[1])
+
+    def test_fetch_subsystems_expired_export(self):
+        self.submit(dict(self.env, FAKE_RAST_RUN_SECONDS='0'))
+        journal_path = os.path.join(self.work_dir, 'output', 'submitted_jobs.csv')
+        job_ids = sorted(r['job_id'] for r in read_journal_rows(journal_path))
+
+        # a login form instead of the table is a failed fetch, not a table
+        os.environ['FAKE_RAST_EXPIRED_EXPORTS'] = job_ids[0]
+        try:
+            output = self.run_script('fetch_subsystems.py', [
+                '--username', USERNAME, '--password', PASSWORD, '--filename', journal_path,
+                '--output-dir', self.work_dir, '--base-url', self.base_url
+            ])
+        finally:
+            del os.environ['FAKE_RAST_EXPIRED_EXPORTS']
+        self.assertIn("fetched 2 tables, 1 failed", output)
+        self.assertIn("expected a subsystem table for job %s" % job_ids[0], output)
+        self.assertEqual(sorted(f for f in os.listdir(self.work_dir) if 'subsystems' in f), ['%s_subsystems.tsv' % job_id for job_id in job_ids[1:]])
+
+    def test_fetch_subsystems_bad_login(self):
+        self.submit(dict(self.env, FAKE_RAST_RUN_SECONDS='0'))
+        result = subprocess.run(
+            [sys.executable, os.path.join(REPO_DIR, 'fetch_subsystems.py'), '--username', USERNAME, '--password', 'wrong',
+             '--filename', os.path.join('output', 'submitted_jobs.csv'), '--base-url', self.base_url],
+            cwd=self.work_dir, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True
+        )
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("login to", result.stdout)
+
+    def run_pipeline(self):
+        return self.run_script('pipeline.py', [
+            '--username', USERNAME, '--password', PASSWORD, '--poll-interval', '0.1', '--retries', '0', '--backoff', '0',
+            '--base-url', self.base_url, '--collate', self.fasta_dir
+        ])
+
+    def genomes_in_state(self, state_path):
+        with sqlite3.connect(state_path) as conn:
+            return conn.execute("SELECT COUNT(*) FROM genomes").fetchone()[0]
+
+    def test_pipeline(self):
+        output_dir = os.path.join(self.work_dir, 'output')
+        journal_path = os.path.join(output_dir, 'submitted_jobs.csv')
+        state_path = os.path.join(output_dir, 'pipeline_state.sqlite')
+
+        # a state of pangenome.py in its default place is left alone
+        os.mkdir(output_dir)
+        pangenome_state_path = os.path.join(output_dir, 'pangenome_state.sqlite')
+        with open(pangenome_state_path, 'wb') as f:
+            f.write(b'not ours')
+
+        output = self.run_pipeline()
+        self.assertIn("stage analyse finished", output)
+        rows = read_journal_rows(journal_path)
+        self.assertEqual(sorted(r['file_name'] for r in rows), ['genome_0.fa', 'genome_1.fa', 'genome_2.fa'])
+        self.assertTrue(all(r['success'] == 'True' for r in rows))
+
+        # the classification and subsystem table of every job, as the tools and the site gave them
+        jobs = {r['file_name'] : int(r['job_id']) for r in rows}
+        for (file_name, job_id) in jobs.items():
+            (classification, subsystems) = fake_rast.job_files(job_id)
+            with open(os.path.join(output_dir, 'classifications', file_name[:-len('.fa')] + '.csv'), 'r', newline='') as f:
+                self.assertEqual(list(csv.reader(f)), list(csv.reader(classification.splitlines())))
+            with open(os.path.join(output_dir, 'subsystems', '%d_subsystems.tsv' % job_id), 'r', newline='') as f:
+                self.assertEqual(f.read(), subsystems)
+
+        self.assertEqual(self.genomes_in_state(state_path), 3)
+        for name in ['common_proteins.csv', 'unique_proteins.csv', 'partitions.csv', 'proteins.json', 'categories.json']:
+            self.assertTrue(os.path.exists(os.path.join(output_dir, name)), name)
+        with open(pangenome_state_path, 'rb') as f:
+            self.assertEqual(f.read(), b'not ours')
+
+        # a rerun skips the genomes already analysed and goes on with submitted jobs which are not
+        write_fasta(os.path.join(self.fasta_dir, 'genome_3.fa'), 3)
+        self.submit()
+        new_job_id = int(read_journal_rows(journal_path)[-1]['job_id'])
+        output = self.run_pipeline()
+        for file_name in jobs:
+            self.assertIn("%s already in the analysis, skipping it" % file_name, output)
+        self.assertIn("genome_3.fa already submitted as job %d" % new_job_id, output)
+        self.assertEqual(len(read_journal_rows(journal_path)), 4)
+        self.assertEqual(len(os.listdir(self.jobs_dir)), 4)
+        self.assertEqual(self.genomes_in_state(state_path), 4)
+
+if __name__ == '__main__':
+    unittest.main()
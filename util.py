@@ -1,5 +1,20 @@
 import os
 import csv
+import gzip
+import json
+import lzma
+import time
+import pstats
+import cProfile
+import datetime
+import contextlib
+import tracemalloc
+
+# resource is unix only, elsewhere the metrics go without peak memory and worker cpu time
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # reused functions
 
@@ -12,18 +27,263 @@ def collect_job_ids_from_csv(job_csv_file_path):
                 job_ids.append(row['job_id'])
     return job_ids
 
-def create_output_directory_if_not_exists(cwd):
-    output_dir_path = os.path.join(cwd, 'output')
+# output_dir is relative to cwd unless it is absolute, its parents are created too
+def create_output_directory_if_not_exists(cwd, output_dir='output'):
+    output_dir_path = os.path.join(cwd, output_dir)
     if os.path.exists(output_dir_path) and os.path.isfile(output_dir_path):
-        raise Exception("output exists but is a file, expected output to be a directory!")
+        raise Exception("%s exists but is a file, expected %s to be a directory!" % (output_dir, output_dir))
     elif not os.path.exists(output_dir_path):
-        os.mkdir(output_dir_path)
+        os.makedirs(output_dir_path)
+
+# files ending in these are read and written through the module, ie. genome_1.csv.gz
+COMPRESSED_EXTENSIONS = {'.gz' : gzip, '.xz' : lzma}
+
+def strip_compressed_extension(path):
+    (name, ext) = os.path.splitext(path)
+    return name if ext in COMPRESSED_EXTENSIONS else path
+
+# opens path as text, decompressing or compressing on the fly when it ends in .gz or .xz
+def open_text(path, mode='r', newline=None):
+    ext = os.path.splitext(path)[1]
+    if ext in COMPRESSED_EXTENSIONS:
+        return COMPRESSED_EXTENSIONS[ext].open(path, mode + 't', newline=newline)
+    return open(path, mode, newline=newline)
 
-def get_files_in_folder_with_ext(extension):
+# path of an output written with compression ('gz' or 'xz', None for none)
+def compressed_path(path, compression=None):
+    return path + '.' + compression if compression else path
+
+# names of the files in directory (the current one by default) with the extension, with compressed
+#  also the ones with it followed by .gz or .xz, with recursive also those in the directories below
+#  it (as paths relative to directory)
+def get_files_in_folder_with_ext(extension, directory=None, recursive=False, compressed=False):
     paths = []
-    for entry in os.listdir():
-        name, ext = os.path.splitext(entry)
-        if os.path.isfile(entry) and ext == extension:
-            paths.append(entry)
+    pending = ['']
+    while len(pending) > 0:
+        relative_dir = pending.pop()
+        with os.scandir(os.path.join(directory or '.', relative_dir)) as entries:
+            for entry in entries:
+                # links to directories are not followed, so links back up the tree can not loop
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        pending.append(os.path.join(relative_dir, entry.name))
+                    continue
+                name = strip_compressed_extension(entry.name) if compressed else entry.name
+                if entry.is_file() and os.path.splitext(name)[1] == extension:
+                    paths.append(os.path.join(relative_dir, entry.name))
     return paths
 
+def add_compression_arguments(parser):
+    parser.add_argument(
+        '--compress', metavar='compress', type=str, choices=['gz', 'xz'], default=None,
+        help='write the csv and json outputs compressed, with .gz or .xz added to their names (defaults to not compressed)'
+    )
+
+# writes (key, value) pairs as one json object a member at a time, the same as json.dump of the
+#  dict they came from (with string keys), returns the number of members written
+def write_json_object(f, items):
+    f.write('{')
+    total = 0
+    for (key, value) in items:
+        if total > 0:
+            f.write(', ')
+        f.write(json.dumps(key))
+        f.write(': ')
+        f.write(json.dumps(value))
+        total += 1
+    f.write('}')
+    return total
+
+
+# yields (key, value) for each member of the top level json object in a file, reading it in
+#  chunks so the whole document is never decoded (or held) at once
+def iter_json_object_items(f, chunk_size=1 << 20):
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        if chunk == '':
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill()
+
+    def decode():
+        nonlocal pos
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                # a value ending exactly at the end of the buffer may continue in the next chunk
+                if end < len(buf) or eof:
+                    pos = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+
+    def expect(c):
+        nonlocal pos
+        skip_whitespace()
+        if pos >= len(buf) or buf[pos] != c:
+            raise Exception("expected '%s' at offset %d while reading json object" % (c, pos))
+        pos += 1
+
+    expect('{')
+    skip_whitespace()
+    if pos < len(buf) and buf[pos] == '}':
+        return
+    while True:
+        skip_whitespace()
+        key = decode()
+        expect(':')
+        skip_whitespace()
+        value = decode()
+        yield key, value
+        skip_whitespace()
+        if pos < len(buf) and buf[pos] == ',':
+            pos += 1
+            continue
+        expect('}')
+        return
+
+
+# instrumentation of the phases of a script, wall and cpu time (including worker processes), peak
+#  memory and rows/bytes processed per phase, written as a json report. does nothing unless the
+#  script was run with --metrics-out or --profile, see add_metrics_arguments and create_metrics.
+#
+#  with --profile every phase also runs under cProfile and tracemalloc, and the profile and top
+#  allocations of the slowest phase are written next to the report.
+
+# None where it can not be read
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class Metrics:
+
+    # without a metrics_file_path it records nothing, library functions use one of those by default
+    def __init__(self, script_name, metrics_file_path=None, profile=False):
+        self.script_name = script_name
+        self.metrics_file_path = metrics_file_path
+        self.enabled = metrics_file_path is not None
+        self.profile = profile
+        self.phases = []
+        self.counters = {}
+        self.started_at = datetime.datetime.now()
+        self.start_wall = time.perf_counter()
+        self.hottest = None
+        if profile:
+            tracemalloc.start()
+
+    def cpu_time(self):
+        if resource is None:
+            return time.process_time()
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+    # times the block, the yielded dict can be given 'rows' and 'bytes' processed, when output is
+    #  given its size once the block is done is taken as the bytes
+    @contextlib.contextmanager
+    def phase(self, name, output=None):
+        record = {'name' : name}
+        if not self.enabled:
+            yield record
+            return
+        profiler = cProfile.Profile() if self.profile else None
+        start_wall = time.perf_counter()
+        start_cpu = self.cpu_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record['wall_seconds'] = time.perf_counter() - start_wall
+            record['cpu_seconds'] = self.cpu_time() - start_cpu
+            # the peak of the process up to the end of the phase
+            record['peak_rss_bytes'] = peak_rss_bytes()
+            if output is not None and os.path.exists(output):
+                record['bytes'] = os.path.getsize(output)
+            if 'rows' in record and record['wall_seconds'] > 0:
+                record['rows_per_second'] = record['rows'] / record['wall_seconds']
+            if profiler is not None and (self.hottest is None or record['wall_seconds'] > self.hottest[0]['wall_seconds']):
+                self.hottest = (record, profiler, tracemalloc.take_snapshot())
+            self.phases.append(record)
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def write_report(self):
+        if not self.enabled:
+            return
+        report = {
+            'script' : self.script_name,
+            'started_at' : self.started_at.isoformat(),
+            'wall_seconds' : time.perf_counter() - self.start_wall,
+            'cpu_seconds' : self.cpu_time(),
+            'peak_rss_bytes' : peak_rss_bytes(),
+            'phases' : self.phases,
+            'counters' : self.counters
+        }
+        if self.hottest is not None:
+            (record, profiler, snapshot) = self.hottest
+            base_path = os.path.splitext(self.metrics_file_path)[0]
+            profile_file_path = base_path + '.prof'
+            profiler.dump_stats(profile_file_path)
+            allocations_file_path = base_path + '_allocations.txt'
+            with open(allocations_file_path, 'w') as f:
+                f.write("top allocations alive at the end of phase: %s\n" % record['name'])
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write("%s\n" % stat)
+            report['profile'] = {
+                'phase' : record['name'],
+                'cprofile' : profile_file_path,
+                'allocations' : allocations_file_path,
+                'top_functions' : top_functions(profiler)
+            }
+        with open(self.metrics_file_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("[%s] wrote metrics of %d phases to: %s" % (self.script_name, len(self.phases), self.metrics_file_path))
+
+def top_functions(profiler, count=10):
+    stats = pstats.Stats(profiler)
+    entries = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:count]
+    return [
+        {'function' : "%s:%d(%s)" % func, 'calls' : calls, 'cumulative_seconds' : cumulative}
+        for (func, (primitive_calls, calls, total, cumulative, callers)) in entries
+    ]
+
+def add_metrics_arguments(parser):
+    parser.add_argument(
+        '--metrics-out', metavar='metrics_out', type=str, default=None,
+        help='write timing, memory and row counts of each phase as json to this file (defaults to no metrics)'
+    )
+    parser.add_argument(
+        '--profile', default=False, action='store_true',
+        help='also profile every phase, writing the cProfile stats and top allocations of the slowest one next to the metrics (to output/<script>_metrics.json unless --metrics-out is given)'
+    )
+
+def create_metrics(script_name, args, cwd):
+    metrics_file_path = args.metrics_out
+    if metrics_file_path is None and args.profile:
+        metrics_file_path = os.path.join(cwd, 'output', '%s_metrics.json' % script_name)
+    if metrics_file_path is not None:
+        metrics_file_path = os.path.join(cwd, metrics_file_path)
+    return Metrics(script_name, metrics_file_path, profile=args.profile)